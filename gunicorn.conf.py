@@ -0,0 +1,19 @@
+# gunicorn 設定：preload 讓 master 先載入 sv94 (資料、預建模板)，worker fork 後以 copy-on-write 共用
+import os
+
+os.environ.setdefault("SV94_DEFER_WORKERS", "1")
+preload_app = True
+
+
+def post_fork(server, worker):
+    # 執行緒不會跟著 fork 過去，背景工作與連線預熱要在 worker 內啟動
+    # 上一個行程留下的工作階段快照在 worker 接流量前載入
+    import sv94
+    sv94.load_handoff()
+    sv94.start_background_workers()
+
+
+def worker_exit(server, worker):
+    # SIGTERM 後 worker 處理完手上的請求才會走到這裡，此時寫快照不會和事件處理交錯
+    import sv94
+    sv94.save_handoff()
@@ -1,4 +1,9 @@
 #!/bin/bash
 
+if [ "${SERVER_MODE}" = "asgi" ]; then
+    echo "=== Starting uvicorn (ASGI) ==="
+    exec uvicorn sv94_asgi:app --host 0.0.0.0 --port ${PORT:-10000}
+fi
+
 echo "=== Starting gunicorn ==="
-exec gunicorn sv94:app --bind 0.0.0.0:${PORT:-10000} --timeout 120 --workers 1
+exec gunicorn sv94:app --bind 0.0.0.0:${PORT:-10000} --timeout 120 --workers 1 --preload
@@ -1,18 +1,33 @@
+import time
+_IMPORT_STARTED = time.time()
 import json
 import requests
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, jsonify, abort, send_from_directory, Response
 import os
+import io
+import sys
 import uuid
 from datetime import datetime, timedelta, timezone
 import traceback
-import random
 import threading
 import hmac
 import hashlib
 import base64
-from collections import Counter
+import bisect
+import heapq
+import itertools
+import signal
+from collections import Counter, OrderedDict, deque
+from array import array
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
+# 舊卡片仍引用 /static/*.jpg，至少讓客戶端快取一天
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 86400
 
 print("[BOOT] sv94.py 模組載入中...", flush=True)
 
@@ -26,49 +41,383 @@ ADMIN_UIDS = ["Ub9a0ddfd2b9fd49e3500fa08e2fbbbe7", "U543d02a7d79565a14d475bff5b3
 
 USER_DATA_FILE = "user_data.json"
 TIME_CARDS_FILE = "time_cards.json"
+# 推播工作：追加式紀錄 (建立工作一行、每批結果一行)，舊版整份 JSON 只在啟動時讀一次
+BROADCAST_JOBS_FILE = "broadcast_jobs.jsonl"
+BROADCAST_JOBS_LEGACY_FILE = "broadcast_jobs.json"
+EXPORT_DIR = "exports"
+# 已使用序號的冷儲存：gzip 多 member 追加檔 + 「序號\t位移」索引
+CARD_ARCHIVE_FILE = "used_cards_archive.jsonl.gz"
+CARD_ARCHIVE_INDEX_FILE = "used_cards_archive.idx"
+
+# 對外網址 (Flex 圖片、下載連結)
+BASE_URL = os.environ.get("BASE_URL", "https://bc-line-kmh9.onrender.com")
+
+# webhook 請求本文上限 (bytes)，超過直接拒絕
+WEBHOOK_MAX_BYTES = int(os.environ.get("WEBHOOK_MAX_BYTES", str(1024 * 1024)))
+
+# 管理端 HTTP 介面 (metrics 等) 的存取金鑰，未設定時僅允許本機呼叫
+ADMIN_API_TOKEN = os.environ.get("ADMIN_API_TOKEN", "")
+
+# Webhook 重送去重：保留時間 (秒) 與最多筆數
+DEDUP_TTL_SEC = int(os.environ.get("DEDUP_TTL_SEC", "600"))
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", "20000"))
+
+# 開牌結果限流：每位用戶的令牌桶容量、每秒補充量，以及合併視窗 (秒，0=關閉合併)
+RESULT_BUCKET_CAPACITY = float(os.environ.get("RESULT_BUCKET_CAPACITY", "1"))
+RESULT_BUCKET_RATE = float(os.environ.get("RESULT_BUCKET_RATE", "0.5"))
+COALESCE_WINDOW_SEC = float(os.environ.get("COALESCE_WINDOW_SEC", "0.8"))
+
+# 到期掃描：掃描間隔 (秒，0=關閉) 與「即將到期」提醒的提前量 (秒)
+# EXPIRY_NOTIFY=1 才推播提醒：推播計入每月訊息額度，部署後第一次掃描就會送給區間內的所有用戶，因此預設關閉
+EXPIRY_SWEEP_SEC = int(os.environ.get("EXPIRY_SWEEP_SEC", "60"))
+EXPIRY_NOTICE_AHEAD_SEC = int(os.environ.get("EXPIRY_NOTICE_AHEAD_SEC", str(24 * 3600)))
+EXPIRY_NOTIFY = os.environ.get("EXPIRY_NOTIFY", "0") == "1"
+
+# 分析卡渲染行程池：行程數 (0=關閉，在請求執行緒內渲染)、排隊上限、逾時秒數
+ANALYSIS_PROCESSES = int(os.environ.get("ANALYSIS_PROCESSES", "0"))
+ANALYSIS_QUEUE_MAX = int(os.environ.get("ANALYSIS_QUEUE_MAX", "64"))
+ANALYSIS_TIMEOUT_SEC = float(os.environ.get("ANALYSIS_TIMEOUT_SEC", "8"))
+
+# 電子預測批次排名：機台數據有效期、排名快取秒數、上傳大小上限、每個遊戲推薦幾間
+SLOT_FEED_TTL_SEC = int(os.environ.get("SLOT_FEED_TTL_SEC", "3600"))
+SLOT_RANK_TTL_SEC = int(os.environ.get("SLOT_RANK_TTL_SEC", "300"))
+SLOT_FEED_MAX_BYTES = int(os.environ.get("SLOT_FEED_MAX_BYTES", str(20 * 1024 * 1024)))
+SLOT_TOP_K = 10
+
+# 效能分析：堆疊取樣間隔 (毫秒)、cProfile 模式的取樣比例、單次最長秒數
+PROFILE_SAMPLE_MS = float(os.environ.get("PROFILE_SAMPLE_MS", "5"))
+PROFILE_CPROFILE_RATE = float(os.environ.get("PROFILE_CPROFILE_RATE", "0.2"))
+PROFILE_MAX_SEC = 600
+
+# 記憶體統計：背景檢查間隔 (秒，0=關閉)、警示門檻 (MB)、大型結構的抽樣筆數
+MEMORY_CHECK_SEC = int(os.environ.get("MEMORY_CHECK_SEC", "300"))
+MEMORY_ALERT_RSS_MB = float(os.environ.get("MEMORY_ALERT_RSS_MB", "400"))
+MEMORY_ALERT_STRUCT_MB = float(os.environ.get("MEMORY_ALERT_STRUCT_MB", "64"))
+MEMORY_ALERT_COOLDOWN_SEC = 3600
+MEMORY_SAMPLE_SIZE = 500
+
+# Reply token 期限：LINE 未公開確切時效，預設以事件發生後 60 秒計；
+# 剩餘時間少於 REPLY_MIN_BUDGET_SEC 或回覆被判定 token 無效時，改用 push API 送給用戶
+# push 會計入每月訊息額度 (連「處理中」之類的提示也算)，因此預設關閉；設 REPLY_PUSH_FALLBACK=1 才啟用
+REPLY_TOKEN_TTL_SEC = float(os.environ.get("REPLY_TOKEN_TTL_SEC", "60"))
+REPLY_MIN_BUDGET_SEC = float(os.environ.get("REPLY_MIN_BUDGET_SEC", "5"))
+REPLY_PUSH_FALLBACK = os.environ.get("REPLY_PUSH_FALLBACK", "0") == "1"
+
+# 負載控制：待處理事件數 / 近期延遲 (秒，EWMA) 達到第 N 個門檻就降到第 N 級
+# 1 縮小牌路、2 不附分析文字、3 純文字預測、4 再加上略過非必要指令 (UID 查詢、房間總覽)
+# 事件停止進來時，層級與延遲估計也會隨時間降回 (讀取層級時重新評估)
+LOAD_QUEUE_STEPS = [int(x) for x in os.environ.get("LOAD_QUEUE_STEPS", "20,50,100,200").split(",")]
+LOAD_LATENCY_STEPS = [float(x) for x in os.environ.get("LOAD_LATENCY_STEPS", "1.5,3,6,10").split(",")]
+LOAD_RECOVER_SEC = float(os.environ.get("LOAD_RECOVER_SEC", "10"))
+
+# 房間總覽：近期命中率的計算窗口 (最近 N 次有效預測)；回報人數只算最近 N 秒內回報過的用戶
+ROOM_HIT_WINDOW = int(os.environ.get("ROOM_HIT_WINDOW", "100"))
+ROOM_REPORTER_WINDOW_SEC = int(os.environ.get("ROOM_REPORTER_WINDOW_SEC", "3600"))
+
+# 部署交接：SIGTERM 時把進行中的工作階段寫成快照，新行程開始接流量前載入；
+# 存 / 讀各有時間預算，超過就只交接已處理的部分；快照超過 HANDOFF_MAX_AGE_SEC 視為過期不載入
+HANDOFF_FILE = os.environ.get("HANDOFF_FILE", "session_handoff.json.gz")
+HANDOFF_SAVE_BUDGET_SEC = float(os.environ.get("HANDOFF_SAVE_BUDGET_SEC", "10"))
+HANDOFF_LOAD_BUDGET_SEC = float(os.environ.get("HANDOFF_LOAD_BUDGET_SEC", "10"))
+HANDOFF_MAX_AGE_SEC = int(os.environ.get("HANDOFF_MAX_AGE_SEC", "900"))
+
+# 多頻道：LINE_ACCESS_TOKEN / LINE_CHANNEL_SECRET 為預設頻道；其他官方帳號由 LINE_CHANNELS (JSON) 或 LINE_CHANNELS_FILE 設定，
+# 每項 {"id", "access_token", "secret", "destination" (該 bot 的 user id，選填), "admins" (選填)}
+LINE_CHANNELS_FILE = os.environ.get("LINE_CHANNELS_FILE", "line_channels.json")
+DEFAULT_CHANNEL_ID = "default"
+
+# 分析快取：牌路相同 (同一張桌) 的用戶共用 AI 預測與牌路元件，不分頻道；保留最近 N 份
+ANALYSIS_CACHE_SIZE = int(os.environ.get("ANALYSIS_CACHE_SIZE", "2048"))
+
+# 牌路圖片：伺服器端把五路 (含三條衍生路) 畫成一張 PNG，分析卡只引用網址；預設 0 = 沿用 Flex 方格
+# (第一次畫圖在處理事件的路徑上執行，開啟前先確認負載)。
+# 圖片依牌路內容的 HMAC 命名 (/roads/<指紋>.png)，網址不含牌路；記憶體保留最近 N 張、磁碟超過上限時刪掉最久沒用到的，
+# 被刪掉的圖片不再重畫 (回 404)
+ROAD_IMAGE = os.environ.get("ROAD_IMAGE", "0") == "1"
+ROAD_IMAGE_DIR = os.environ.get("ROAD_IMAGE_DIR", "road_images")
+ROAD_IMAGE_MEM_ITEMS = int(os.environ.get("ROAD_IMAGE_MEM_ITEMS", "512"))
+ROAD_IMAGE_DISK_MB = float(os.environ.get("ROAD_IMAGE_DISK_MB", "200"))
+
+# 牌路保存：整靴以連續段編碼 (幾十 bytes)，大路 / 衍生路不再因只留最後 90 局而變動；
+# 只有連續回報好幾靴都沒清除時，超過 SHOE_MAX_HANDS 局才從最舊的開始丟。
+# 注意：只有牌路用整靴，AI 預測仍只看最後 AI_WINDOW_HANDS 局 (見 /metrics 的 startup.shoe_analysis)
+SHOE_MAX_HANDS = int(os.environ.get("SHOE_MAX_HANDS", "500"))
+
+# 預先渲染 (選用)：分析卡送出後，趁空閒 (沒有待處理事件且在層級 0) 先算好下一局莊 / 閒 / 和三種結果的分析卡，
+# 結果進來時直接命中分析快取，只補上損益。每個工作階段最多花 SPECULATE_BUDGET_MS，排隊超過上限丟掉最舊的
+SPECULATE = os.environ.get("SPECULATE", "0") == "1"
+SPECULATE_BUDGET_MS = float(os.environ.get("SPECULATE_BUDGET_MS", "150"))
+SPECULATE_QUEUE_MAX = int(os.environ.get("SPECULATE_QUEUE_MAX", "256"))
+
+# 批次推播：multicast 每次最多 500 人；併發數與每秒請求上限
+MULTICAST_CHUNK_SIZE = 500
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "4"))
+BROADCAST_RATE_PER_SEC = float(os.environ.get("BROADCAST_RATE_PER_SEC", "100"))
+BROADCAST_MAX_ATTEMPTS = 5
+# 完成超過 N 天的推播工作不再保留；紀錄檔超過 N 行時改寫成只含保留中的工作
+BROADCAST_JOB_RETAIN_DAYS = float(os.environ.get("BROADCAST_JOB_RETAIN_DAYS", "7"))
+BROADCAST_LOG_COMPACT_LINES = int(os.environ.get("BROADCAST_LOG_COMPACT_LINES", "2000"))
 
 # 允許的序號期限
 VALID_DURATIONS = {"10M": "10分鐘", "1H": "1小時", "2D": "2天", "7D": "7天", "12D": "12天", "30D": "30天"}
 
+# 序號產生：超過 CARD_INLINE_MAX 組改用下載檔，單次上限 CARD_MINT_MAX 組
+CARD_INLINE_MAX = 100
+CARD_MINT_MAX = 200000
+EXPORT_LINK_TTL_SEC = 24 * 3600
+# 結算後保留帳本供下載：超過連結時效或超過 N 位用戶 (最舊的先丟) 就移除
+SETTLED_LEDGERS_MAX = int(os.environ.get("SETTLED_LEDGERS_MAX", "10000"))
+
+# 已使用序號壓縮歸檔：定期執行間隔 (秒，0=關閉)，熱檔中超過此數量也會立即歸檔
+CARD_COMPACT_SEC = int(os.environ.get("CARD_COMPACT_SEC", str(6 * 3600)))
+CARD_HOT_USED_MAX = int(os.environ.get("CARD_HOT_USED_MAX", "500"))
+
 # --- 全局變數初始化 ---
 baccarat_history_dict = {}
 chat_modes = {}
 user_access_data = {}
 time_cards_data = {"active_cards": {}, "used_cards": {}}
-profit_tracker = {}  # uid -> {bankroll, unit, bet_side, history[], total_profit, rounds}
+profit_tracker = {}  # uid -> {unit, ledger: ProfitLedger, last_prediction, round_text, round_profit}
+settled_ledgers = OrderedDict()  # uid -> (結算時間, 帳本)：最近一次【結算】的帳本 (報表中的下載連結用)，依結算時間排序
 
 user_data_lock = threading.RLock()
 time_cards_data_lock = threading.RLock()
 
+# --- 執行期計數器 ---
+metrics = Counter()
+metrics_lock = threading.Lock()
+
+def metrics_inc(name, n=1):
+    with metrics_lock:
+        metrics[name] += n
+
+def metrics_set(name, value):
+    with metrics_lock:
+        metrics[name] = value
+
+def metrics_snapshot():
+    with metrics_lock:
+        return dict(metrics)
+
+# --- JSON 後端：有 orjson 就用，否則用標準庫 ---
+# 對外 (LINE API) 與存檔一律輸出緊湊、不跳脫中文的 UTF-8 bytes
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps_bytes(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass  # orjson 不支援的型別 (例如非字串 key) 交給標準庫
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+
 # --- 資料存取 ---
 def load_data(f, default_val=None):
     if os.path.exists(f):
         try:
-            with open(f, 'r', encoding='utf-8') as file:
-                return json.load(file)
+            with open(f, 'rb') as file:
+                return json_loads(file.read())
         except:
             pass
     return default_val if default_val is not None else {}
 
 def save_data(f, d):
+    """先寫暫存檔再 os.replace：寫到一半當機時留下的是舊檔，不會是截斷的檔案"""
+    tmp = f"{f}.tmp"
     try:
-        with open(f, 'w', encoding='utf-8') as file:
-            json.dump(d, file, ensure_ascii=False, indent=4)
-    except:
-        pass
+        with open(tmp, 'wb') as file:
+            file.write(json_dumps_bytes(d))
+        os.replace(tmp, f)
+    except Exception as e:
+        print(f"[DATA] save {f} failed: {e}")
 
-# 模組載入時讀取資料
+# 模組載入時讀取資料 (只讀一次；gunicorn --preload 時由 master 讀取後 fork 共用)
+_t = time.time()
 user_access_data = load_data(USER_DATA_FILE)
 time_cards_data = load_data(TIME_CARDS_FILE, {"active_cards": {}, "used_cards": {}})
+_DATA_LOAD_SEC = time.time() - _t
+
+# --- 到期時間快取與索引 ---
+user_expiry_ts = {}   # uid -> 到期 epoch 秒 (int)
+expiry_index = []     # 依到期時間排序的 (ts, uid)
+
+def parse_expiry(iso_str):
+    return int(datetime.fromisoformat(iso_str.replace('Z', '+00:00')).timestamp())
+
+def _index_remove(uid):
+    old = user_expiry_ts.get(uid)
+    if old is None:
+        return
+    i = bisect.bisect_left(expiry_index, (old, uid))
+    if i < len(expiry_index) and expiry_index[i] == (old, uid):
+        del expiry_index[i]
+
+def set_user_expiry(uid, ts):
+    """更新單一用戶的到期時間 (快取 + 排序索引)"""
+    with user_data_lock:
+        _index_remove(uid)
+        user_expiry_ts[uid] = ts
+        bisect.insort(expiry_index, (ts, uid))
+
+def rebuild_expiry_index():
+    """由 user_access_data 重建快取；舊資料沒有 expiry_ts 時補上"""
+    with user_data_lock:
+        user_expiry_ts.clear()
+        for uid, user in user_access_data.items():
+            ts = user.get("expiry_ts")
+            if ts is None:
+                try:
+                    ts = user["expiry_ts"] = parse_expiry(user["expiry_date"])
+                except Exception:
+                    continue
+            user_expiry_ts[uid] = int(ts)
+        expiry_index[:] = sorted((ts, uid) for uid, ts in user_expiry_ts.items())
+
+def users_expiring_between(start_ts, end_ts):
+    """回傳到期時間落在 [start_ts, end_ts) 的 (ts, uid)，O(log n + k)"""
+    with user_data_lock:
+        lo = bisect.bisect_left(expiry_index, (start_ts, ""))
+        hi = bisect.bisect_left(expiry_index, (end_ts, ""))
+        return expiry_index[lo:hi]
+
+rebuild_expiry_index()
 
 # --- 房間清單 ---
 MT_ROOMS = [f"百家樂 {i}" if i != 4 else "百家樂 3A" for i in range(1, 14)]
 DG_ROOMS = [f"RB0{i}" for i in range(1, 8)] + [f"S0{i}" for i in range(1, 8)]
 
 # --- 安全驗證 ---
-def verify_signature(body, signature):
-    hash = hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
-    return base64.b64encode(hash).decode('utf-8') == signature
+def verify_signature(body, signature, channel=None):
+    """對原始 bytes 做 HMAC，常數時間比對 (body 為 str 時才編碼)；channel 省略時用預設頻道的 secret"""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    digest = hmac.new((channel or default_channel).secret_key, body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest), signature.encode('latin-1', 'replace'))
+
+def parse_webhook(body, signature, channel_id=None):
+    """以所屬頻道的 secret 驗簽並解析，回傳 events；頻道不明、驗簽或解析失敗回傳 None
+
+    路徑指定頻道時先驗簽再解析。沒有指定時要先解析本文才知道 destination，
+    此時本文尚未驗證，解析失敗一律算驗簽失敗 (webhook_bad_signature)
+    """
+    payload = None
+    if channel_id is not None:
+        channel = resolve_channel(channel_id)
+    else:
+        try:
+            payload = json_loads(body)
+            channel = resolve_channel(destination=payload.get("destination"))
+        except (ValueError, AttributeError):
+            metrics_inc("webhook_bad_signature")
+            return None
+    if channel is None:
+        metrics_inc("webhook_unknown_channel")
+        return None
+    if not verify_signature(body, signature, channel):
+        metrics_inc("webhook_bad_signature")
+        return None
+    try:
+        if payload is None:
+            payload = json_loads(body)
+        events = payload.get("events", [])
+    except (ValueError, AttributeError):
+        metrics_inc("webhook_bad_json")
+        return None
+    # 收到時間跟著事件走，後續 (合併視窗、行程池) 才知道 reply token 還剩多少時間
+    now = time.time()
+    for event in events:
+        event["_received_at"] = now
+        event["_channel"] = channel.id
+        source = event.get("source")
+        if channel.prefix and source and source.get("userId"):
+            source["userId"] = channel.prefix + source["userId"]
+    if channel is not default_channel:
+        metrics_inc(f"webhook_events_{channel.id}", len(events))
+    return events
+
+# ==================== Webhook 去重 ====================
+class IdempotencyCache:
+    """有時間與容量上限的已處理事件集合 (環形佇列 + 雜湊表)"""
+
+    def __init__(self, ttl_sec=DEDUP_TTL_SEC, max_entries=DEDUP_MAX_ENTRIES):
+        self.ttl = ttl_sec
+        self.max_entries = max_entries
+        self._ring = deque()   # (key, 加入時間)，依時間排序
+        self._seen = {}        # key -> 加入時間
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        ring, seen = self._ring, self._seen
+        while ring and (len(ring) > self.max_entries or now - ring[0][1] > self.ttl):
+            key, ts = ring.popleft()
+            if seen.get(key) == ts:
+                del seen[key]
+
+    def check_and_add(self, key, now=None):
+        """已見過回傳 True；否則記錄下來並回傳 False"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._evict(now)
+            ts = self._seen.get(key)
+            if ts is not None and now - ts <= self.ttl:
+                return True
+            self._seen[key] = now
+            self._ring.append((key, now))
+            if len(self._ring) > self.max_entries:
+                self._evict(now)
+            return False
+
+    def discard(self, key):
+        """撤銷記錄 (處理失敗時)，之後的重送才不會被當成重複；環形佇列裡的舊項目由 _evict 略過"""
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def export(self, now=None):
+        """[(key, 已過秒數)]，由舊到新；部署交接時帶到新行程"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._evict(now)
+            return [(key, round(now - ts, 3)) for key, ts in self._ring if self._seen.get(key) == ts]
+
+    def restore(self, items, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for key, age in items:
+                if age <= self.ttl and key not in self._seen:
+                    self._seen[key] = now - age
+                    self._ring.append((key, now - age))
+            self._evict(now)
+
+    def __len__(self):
+        return len(self._seen)
+
+processed_events = IdempotencyCache()
+
+def event_dedup_key(event):
+    """LINE 事件的冪等鍵：優先用 webhookEventId，其次訊息 id；非預設頻道的鍵加上頻道前綴"""
+    channel = event.get("_channel", DEFAULT_CHANNEL_ID)
+    prefix = "" if channel == DEFAULT_CHANNEL_ID else channel + ":"
+    if event.get("webhookEventId"):
+        return prefix + "ev:" + event["webhookEventId"]
+    msg_id = (event.get("message") or {}).get("id")
+    if msg_id:
+        return prefix + "msg:" + msg_id
+    return None
+
+def is_duplicate_event(event):
+    metrics_inc("dedup_checked")
+    if (event.get("deliveryContext") or {}).get("isRedelivery"):
+        metrics_inc("dedup_redelivery_flagged")
+    key = event_dedup_key(event)
+    if key is None:
+        return False
+    if processed_events.check_and_add(key):
+        metrics_inc("dedup_hits")
+        return True
+    return False
 
 # ==================== 核心邏輯：電子預測 ====================
 def calculate_slot_logic(total_bet, score_rate):
@@ -91,6 +440,89 @@ def calculate_slot_logic(total_bet, score_rate):
             level, color, desc = "☁️ 觀望", "#7F8C8D", "數據趨於平衡，建議更換房間或等待下一個週期。"
     return {"space": bonus_space, "level": level, "color": color, "desc": desc}
 
+# ==================== 電子預測：批次排名 ====================
+# 等級代碼與 calculate_slot_logic 的判斷順序一致；排名只用代碼與 space，文字在顯示時才產生
+SLOT_LEVEL_NAMES = ["⚠️ 高位震盪", "🌟 熱機中", "🔥 極致推薦", "✅ 推薦", "☁️ 觀望"]
+
+class SlotBatch:
+    """一份機台數據 (game, room, total_bet, score_rate) 以欄位儲存，一次算完全部 space 與等級"""
+
+    def __init__(self, rows):
+        self.games, self.rooms = [], []
+        self.bets, self.rates = array('d'), array('d')
+        for game, room, bet, rate in rows:
+            self.games.append(game)
+            self.rooms.append(room)
+            self.bets.append(bet)
+            self.rates.append(rate)
+        rtp = FIXED_RTP / 100.0
+        # 與 calculate_slot_logic 同一條公式 (expected_return - actual_gain)，整欄一次計算
+        self.space = array('d', [b * rtp - b * (r / 100.0) for b, r in zip(self.bets, self.rates)])
+        self.level = array('b', [
+            (0 if r > 110 else 1) if r >= FIXED_RTP else (2 if sp >= 500000 else 3 if sp > 0 else 4)
+            for r, sp in zip(self.rates, self.space)])
+        self.by_game = {}
+        for i, game in enumerate(self.games):
+            self.by_game.setdefault(game, []).append(i)
+        self.ingested_at = time.time()
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def top(self, game, k):
+        idx = heapq.nlargest(k, self.by_game.get(game, ()), key=self.space.__getitem__)
+        return [{"game": game, "room": self.rooms[i], "total_bet": self.bets[i], "score_rate": self.rates[i],
+                 "space": self.space[i], "level": SLOT_LEVEL_NAMES[self.level[i]]} for i in idx]
+
+slot_batch = None        # 最新一份 SlotBatch
+slot_rank_cache = {}     # (game, k) -> (到期時間, 排名)；上傳新數據時清空
+
+def parse_slot_feed(body, content_type=""):
+    """CSV (game,room,total_bet,score_rate) 或 JSON 陣列；回傳 (rows, rejected)"""
+    rows, rejected = [], 0
+    text = body.decode('utf-8-sig') if isinstance(body, bytes) else body
+    if "json" in content_type or text.lstrip()[:1] in ("[", "{"):
+        data = json_loads(text)
+        if isinstance(data, dict):
+            data = data.get("rows", [])
+        if not isinstance(data, list):
+            data = [data]
+        # 不是物件的項目 (例如 [1, 2]) 算進 rejected，不讓整批失敗
+        records = ((d.get("game"), d.get("room"), d.get("total_bet"), d.get("score_rate")) if isinstance(d, dict) else None
+                   for d in data)
+    else:
+        import csv
+        reader = csv.reader(io.StringIO(text))
+        records = (r for r in reader if r and r[0].strip().lower() != "game")
+    for rec in records:
+        try:
+            game, room, bet, rate = rec[:4]
+            rows.append((str(game).strip(), str(room).strip(), float(bet), float(rate)))
+        except (TypeError, ValueError, AttributeError, IndexError):
+            rejected += 1
+    return rows, rejected
+
+def load_slot_feed(rows):
+    global slot_batch
+    batch = SlotBatch(rows)
+    slot_batch = batch
+    slot_rank_cache.clear()
+    return batch
+
+def slot_top_rooms(game, k=SLOT_TOP_K):
+    """回傳該遊戲 space 最大的 k 間；數據過期回傳 None"""
+    batch = slot_batch
+    if batch is None or time.time() - batch.ingested_at > SLOT_FEED_TTL_SEC:
+        return None
+    now = time.time()
+    hit = slot_rank_cache.get((game, k))
+    if hit and hit[0] > now:
+        metrics_inc("slot_rank_cache_hits")
+        return hit[1]
+    ranked = batch.top(game, k)
+    slot_rank_cache[(game, k)] = (now + SLOT_RANK_TTL_SEC, ranked)
+    return ranked
+
 # ==================== 核心邏輯：百家預測 (強化版) ====================
 # --- 8副牌基礎常量 ---
 DECKS = 8
@@ -543,9 +975,147 @@ def baccarat_ai_logic(history_list, big_eye=None, small_r=None, cockroach=None,
         reasons.append("⏳ 暫無明顯好路，依機率模型推薦")
 
     reason_text = "📊 AI分析報告：\n" + "\n".join(f"• {r}" for r in reasons)
-    return {"下注": final_prediction, "勝率": conf, "建議注碼": bet, "模式": mode,
+    return {"下注": final_prediction, "勝率": conf, "建議注碼": bet, "注碼單位": bet_units, "模式": mode,
             "理由": reason_text, "精準度": accuracy}
 
+# ==================== 牌路儲存 (連續段編碼) ====================
+class ShoeHistory:
+    """一個房間的整靴牌路，以連續段 (run) 保存：每段 1 byte，高 2 bits 為結果、低 6 bits 為連續局數，
+    超過 63 局的長龍拆成相鄰的同色段。一靴約 40 段，比 90 個元素的 list 小一個數量級；
+    附加 O(1)，大路每欄直接由連續段合併得到，渲染只展開需要的最後幾局"""
+    SIDES = ("莊", "閒", "和")
+    CODES = {"莊": 0, "閒": 1, "和": 2}
+    LETTERS = "BPT"            # 與 HIST_ENCODE 相同的精簡字母
+    MAX_RUN = 63
+    __slots__ = ("runs", "n")
+
+    def __init__(self, hands=()):
+        self.runs = bytearray()
+        self.n = 0
+        self.extend(hands)
+
+    @classmethod
+    def decode(cls, hist):
+        """精簡牌路字串 ("BPT…") → ShoeHistory；整段整段建，不逐局 append"""
+        shoe = cls()
+        runs = shoe.runs
+        for letter, group in itertools.groupby(hist):
+            code, m = cls.LETTERS.index(letter) << 6, len(list(group))
+            while m > 0:
+                runs.append(code | min(m, cls.MAX_RUN))
+                m -= cls.MAX_RUN
+        shoe.n = len(hist)
+        return shoe
+
+    @classmethod
+    def from_runs(cls, runs):
+        shoe = cls.__new__(cls)
+        shoe.runs = bytearray(runs)
+        shoe.n = sum(b & 63 for b in shoe.runs)
+        return shoe
+
+    def encode(self):
+        return "".join(self.LETTERS[b >> 6] * (b & 63) for b in self.runs)
+
+    def append(self, h):
+        code = self.CODES[h]
+        runs = self.runs
+        if runs and runs[-1] >> 6 == code and runs[-1] & 63 < self.MAX_RUN:
+            runs[-1] += 1
+        else:
+            runs.append(code << 6 | 1)
+        self.n += 1
+
+    def extend(self, hands):
+        for h in hands:
+            self.append(h)
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for b in self.runs:
+            side = self.SIDES[b >> 6]
+            for _ in range(b & 63):
+                yield side
+
+    def __reversed__(self):
+        for b in reversed(self.runs):
+            side = self.SIDES[b >> 6]
+            for _ in range(b & 63):
+                yield side
+
+    def __eq__(self, other):
+        return isinstance(other, ShoeHistory) and self.runs == other.runs
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"ShoeHistory({self.encode()!r})"
+
+    def iter_runs(self):
+        """依序產生 (結果, 連續局數)；拆開保存的長龍在這裡合併回一段"""
+        code, length = None, 0
+        for b in self.runs:
+            if b >> 6 == code:
+                length += b & 63
+                continue
+            if length:
+                yield self.SIDES[code], length
+            code, length = b >> 6, b & 63
+        if length:
+            yield self.SIDES[code], length
+
+    def big_road_cols(self):
+        """大路每欄的 [莊/閒, 長度]：和局不佔格，夾在同色兩段之間的和局不換欄"""
+        cols, last = [], None
+        for b in self.runs:
+            code = b >> 6
+            if code == 2:
+                continue
+            if code == last:
+                cols[-1][1] += b & 63
+            else:
+                cols.append([self.SIDES[code], b & 63])
+                last = code
+        return cols
+
+    def tail(self, k):
+        """最後 k 局 (list)，只展開用得到的連續段"""
+        parts, need = [], k
+        for b in reversed(self.runs):
+            if need <= 0:
+                break
+            take = min(b & 63, need)
+            parts.append((self.SIDES[b >> 6], take))
+            need -= take
+        return [side for side, m in reversed(parts) for _ in range(m)]
+
+    def bead_window(self, max_cols, nrows=6):
+        """珠盤路最後 max_cols 欄的局數；起點對齊 nrows 的倍數，分欄與整靴一致"""
+        n = self.n
+        return self.tail(n - max(-(-n // nrows) - max_cols, 0) * nrows)
+
+    def trim(self, max_hands):
+        """超過上限時從最舊的連續段開始丟"""
+        drop, i, runs = self.n - max_hands, 0, self.runs
+        while drop > 0:
+            m = runs[i] & 63
+            if m <= drop:
+                drop -= m
+                i += 1
+            else:
+                runs[i] -= drop
+                drop = 0
+        del runs[:i]
+        self.n = min(self.n, max_hands)
+
+# AI 的機率模型 (牌靴深度校正等) 以一靴的長度調校：牌路用整靴，AI 仍只看最後這麼多局
+AI_WINDOW_HANDS = 90
+
+def as_shoe(history):
+    return history if isinstance(history, ShoeHistory) else ShoeHistory(history)
+
 # ==================== 五路算法 ====================
 def compute_big_road(history, max_rows=6):
     pure = [h for h in history if h in ("莊", "閒")]
@@ -581,6 +1151,8 @@ def compute_big_road(history, max_rows=6):
     return grid, max_col + 1
 
 def compute_big_road_cols(history):
+    if isinstance(history, ShoeHistory):
+        return [[side] * n for side, n in history.big_road_cols()]
     cols = []
     pure = [h for h in history if h in ("莊", "閒")]
     if not pure:
@@ -734,6 +1306,8 @@ def build_bead_road(history, max_cols=15):
     # 超過max_cols列後，以列為單位丟掉最舊的列
     nrows = 6
     sz = "18px"
+    if isinstance(history, ShoeHistory):
+        history = history.bead_window(max_cols, nrows)
     # 每6筆一列（由上至下）
     cols = [history[i:i + nrows] for i in range(0, len(history), nrows)]
     # 取最後max_cols列（以列為單位縮減，保持對齊）
@@ -803,15 +1377,275 @@ def build_derived_road_ui(title, flat, style="hollow", max_display=40, use_dot=F
     truncated = [c[:max_rows] for c in display_cols]
     return _section(title, _grid(truncated, max_rows, cell_fn, sz))
 
+# ==================== 牌路圖片 ====================
+# 版面 (1x 像素)：左 珠盤路 15 欄 x 6 列 (32px)｜右上 大路 30 欄 (16px)｜
+# 右中 大眼仔路 60 欄 (8px)｜右下 小路、曱甴路 各 30 欄 (8px)。以 2 倍大小繪製再縮小，圓形邊緣較平滑
+ROAD_IMAGE_VERSION = 1     # 版面或配色改變時遞增，舊網址自然失效
+ROAD_IMAGE_SIZE = (960, 192)
+ROAD_IMAGE_SCALE = 2
+ROAD_GRID_COLOR = "#E5E8E8"
+ROAD_RULE_COLOR = "#BDC3C7"
+# (左上 x, 左上 y, 格寬, 欄數) 與畫法
+ROAD_DERIVED_LAYOUT = [(480, 96, 8, 60, "hollow"), (480, 144, 8, 30, "dot"), (720, 144, 8, 30, "slash")]
+
+road_image_cache = OrderedDict()   # 檔名 -> PNG bytes (記憶體 LRU)
+road_image_lock = threading.Lock()
+_road_disk_bytes = None            # 本行程估計的磁碟快取大小；啟動時掃描一次，之後超過上限時才再掃描目錄
+_road_disk_added = 0               # 本行程累計寫入的 bytes (只增不減)，掃描期間的新增量靠它補回
+_road_scan_lock = threading.Lock() # 同時只有一個執行緒掃描 / 驅逐
+_road_image_ok = None              # Pillow 是否可用 (第一次繪製時才檢查)
+
+def road_fingerprint(hist_str):
+    """以頻道 secret 做 HMAC：外人無法由牌路算出檔名，也就無法從網址反推牌路"""
+    return hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), f"roads/{ROAD_IMAGE_VERSION}:{hist_str}".encode('ascii'),
+                    hashlib.sha256).hexdigest()[:20]
+
+def _valid_road_name(name):
+    return len(name) == 24 and name.endswith(".png") and all(c in "0123456789abcdef" for c in name[:20])
+
+def render_road_png(hist_str, grid_data=None, derived=None):
+    """把五路畫成 PNG；grid_data / derived 可由呼叫端傳入已算好的結果。沒有 Pillow 時回傳 None"""
+    global _road_image_ok
+    if _road_image_ok is False:
+        return None
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        _road_image_ok = False
+        print("[ROADS] Pillow not installed, falling back to Flex grids")
+        return None
+    _road_image_ok = True
+    history = ShoeHistory.decode(hist_str)
+    if grid_data is None:
+        grid_data = compute_big_road(history)
+    if derived is None:
+        derived = compute_derived_roads(compute_big_road_cols(history))
+    s = ROAD_IMAGE_SCALE
+    width, height = ROAD_IMAGE_SIZE
+    im = Image.new("RGB", (width * s, height * s), "#FFFFFF")
+    draw = ImageDraw.Draw(im)
+
+    def cell(x0, y0, size, c, r, pad):
+        return [(x0 + c * size + pad) * s, (y0 + r * size + pad) * s,
+                (x0 + (c + 1) * size - pad) * s - 1, (y0 + (r + 1) * size - pad) * s - 1]
+
+    def grid_lines(x0, y0, size, cols, rows):
+        for c in range(1, cols):
+            draw.line([((x0 + c * size) * s, y0 * s), ((x0 + c * size) * s, (y0 + rows * size) * s)], fill=ROAD_GRID_COLOR, width=s)
+        for r in range(1, rows):
+            draw.line([(x0 * s, (y0 + r * size) * s), ((x0 + cols * size) * s, (y0 + r * size) * s)], fill=ROAD_GRID_COLOR, width=s)
+
+    grid_lines(0, 0, 32, 15, 6)
+    grid_lines(480, 0, 16, 30, 6)
+    for x0, y0, size, cols, _ in ROAD_DERIVED_LAYOUT:
+        grid_lines(x0, y0, size, cols, 6)
+    for line in ([(480, 0), (480, 192)], [(480, 96), (960, 96)], [(480, 144), (960, 144)], [(720, 144), (720, 192)]):
+        draw.line([(x * s, y * s) for x, y in line], fill=ROAD_RULE_COLOR, width=s)
+
+    # 珠盤路：每 6 筆一欄，只留最後 15 欄
+    bead = history.bead_window(15)
+    bead_cols = [bead[i:i + 6] for i in range(0, len(bead), 6)]
+    for c, col in enumerate(bead_cols):
+        for r, x in enumerate(col):
+            draw.ellipse(cell(0, 0, 32, c, r, 3), fill=CM.get(x, "#27AE60"))
+    # 大路：空心圈，只留最後 30 欄
+    grid, num_cols = grid_data
+    start = max(num_cols - 30, 0)
+    for (r, c), x in grid.items():
+        if c >= start:
+            draw.ellipse(cell(480, 0, 16, c - start, r, 2), outline=CM.get(x, "#999999"), width=2 * s)
+    # 衍生路：大眼仔 空心圈、小路 實心點、曱甴路 斜線；超過 6 列的長龍截斷
+    for (x0, y0, size, cols, style), flat in zip(ROAD_DERIVED_LAYOUT, derived):
+        for c, col in enumerate(_derived_to_cols(flat)[-cols:]):
+            for r, x in enumerate(col[:6]):
+                box = cell(x0, y0, size, c, r, 1)
+                color = DM.get(x, "#999999")
+                if style == "hollow":
+                    draw.ellipse(box, outline=color, width=s)
+                elif style == "dot":
+                    draw.ellipse(box, fill=color)
+                else:
+                    draw.line([(box[0], box[3]), (box[2], box[1])], fill=color, width=s)
+    # reduce (box filter) 與 FASTOCTREE 調色盤比 LANCZOS + 預設量化快約 10 倍，檔案也較小
+    im = im.reduce(s).quantize(colors=32, method=Image.Quantize.FASTOCTREE)
+    buf = io.BytesIO()
+    im.save(buf, "PNG")
+    return buf.getvalue()
+
+def get_road_image(name):
+    """記憶體 → 磁碟；都沒有回傳 None。磁碟命中時更新 mtime，驅逐時依 mtime 判斷新舊"""
+    with road_image_lock:
+        png = road_image_cache.get(name)
+        if png is not None:
+            road_image_cache.move_to_end(name)
+            return png
+    path = os.path.join(ROAD_IMAGE_DIR, name)
+    try:
+        with open(path, 'rb') as f:
+            png = f.read()
+        os.utime(path)
+    except OSError:
+        return None
+    metrics_inc("road_image_disk_hits")
+    _remember_road_image(name, png)
+    return png
+
+def _remember_road_image(name, png):
+    with road_image_lock:
+        road_image_cache[name] = png
+        road_image_cache.move_to_end(name)
+        while len(road_image_cache) > ROAD_IMAGE_MEM_ITEMS:
+            road_image_cache.popitem(last=False)
+
+def store_road_image(name, png):
+    global _road_disk_bytes
+    _remember_road_image(name, png)
+    path = os.path.join(ROAD_IMAGE_DIR, name)
+    try:
+        os.makedirs(ROAD_IMAGE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(png)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[ROADS] write failed: {e}")
+        return
+    global _road_disk_added
+    with road_image_lock:
+        if _road_disk_bytes is None:
+            _road_disk_bytes = 0
+        _road_disk_bytes += len(png)
+        _road_disk_added += len(png)
+        over = _road_disk_bytes > ROAD_IMAGE_DISK_MB * 1024 * 1024
+    if over:
+        _evict_road_disk()
+
+def _scan_road_disk():
+    """(mtime, 大小, 路徑)；掃描途中被刪掉 (其他行程驅逐) 或讀不到的項目直接略過"""
+    entries = []
+    try:
+        with os.scandir(ROAD_IMAGE_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith(".png"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+    except OSError:
+        pass
+    return entries
+
+def _evict_road_disk():
+    """實際掃描目錄 (行程池的子行程也會寫入)，刪掉最久沒用到的圖直到低於上限的 90%；
+    啟動時也呼叫一次，以實際大小作為估計的起點。掃描與刪檔不持有 road_image_lock，
+    只在最後更新估計值時拿鎖，掃描期間其他執行緒新寫入的量照樣加回去"""
+    global _road_disk_bytes
+    if not _road_scan_lock.acquire(blocking=False):
+        return
+    try:
+        with road_image_lock:
+            added_before = _road_disk_added
+        entries = _scan_road_disk()
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        limit = ROAD_IMAGE_DISK_MB * 1024 * 1024 * 0.9
+        removed = 0
+        for _, size, path in entries:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                total -= size
+                continue
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with road_image_lock:
+            _road_disk_bytes = total + (_road_disk_added - added_before)
+    finally:
+        _road_scan_lock.release()
+    metrics_inc("road_image_evicted", removed)
+
+def road_image_url(entry, render=True):
+    """分析快取項目對應的牌路圖片網址 (依牌路內容命名，同一牌路只畫一次)；
+    無法產生圖片、或 render=False 且尚未畫過時回傳 None"""
+    url = entry.get("image")
+    if url is not None:
+        return url
+    name = road_fingerprint(entry["hist"]) + ".png"
+    if get_road_image(name) is None:
+        if not render:
+            return None
+        t0 = time.perf_counter()
+        try:
+            png = render_road_png(entry["hist"], entry["grid"], entry["derived"])
+        except Exception as e:
+            print(f"[ROADS] render failed: {e}")
+            png = None
+        if png is None:
+            return None
+        metrics_inc("road_image_renders")
+        metrics_inc("road_image_render_us", int((time.perf_counter() - t0) * 1e6))
+        store_road_image(name, png)
+    # 快取項目由請求執行緒與預先渲染執行緒共用：寫回時拿 analysis_cache_lock，先寫入的為準
+    with analysis_cache_lock:
+        return entry.setdefault("image", f"{BASE_URL}/roads/{name}")
+
 # ==================== Flex 構建 ====================
-def build_analysis_flex(room, history, total_counts=None, profit_info=None, _out_res=None):
-    big_road_grid = compute_big_road(history)
-    big_road_cols = compute_big_road_cols(history)
-    big_eye, small_r, cockroach = compute_derived_roads(big_road_cols)
-    res = baccarat_ai_logic(history, big_eye, small_r, cockroach, total_counts=total_counts)
+# 各降級層級的牌路尺寸嘗試順序 (珠盤路欄數, 大路欄數)，由大到小直到卡片小於 29KB
+RENDER_TIER_ATTEMPTS = [
+    [(15, 80), (15, 50), (15, 30), (10, 30), (8, 25), (6, 20)],   # 0：完整
+    [(10, 30), (8, 25), (6, 20)],                                 # 1：縮小牌路
+    [(6, 20)],                                                    # 2：最小牌路、不附分析文字
+]
+
+# --- 分析快取 ---
+# 牌路、AI 預測與牌路元件只由牌路 (與總數) 決定，同一張桌的用戶不論頻道都共用；
+# 卡片其餘部分 (損益、按鈕) 因人而異，每次照常組裝。快取內容視為唯讀
+analysis_cache = OrderedDict()   # (牌路字串, 總數) -> {"hist", "grid", "derived", "res", "image", "ui": {(珠盤欄, 大路欄): (珠盤路, 大路)}}
+analysis_cache_lock = threading.Lock()
+
+def analysis_core(history, total_counts=None):
+    history = as_shoe(history)
+    key = (history.encode(),
+           tuple(total_counts.get(k, 0) for k in ("莊", "閒", "和")) if total_counts else None)
+    with analysis_cache_lock:
+        entry = analysis_cache.get(key)
+        if entry is not None:
+            analysis_cache.move_to_end(key)
+    if entry is not None:
+        metrics_inc("analysis_cache_hits")
+        return entry
+    metrics_inc("analysis_cache_misses")
+    derived = compute_derived_roads(compute_big_road_cols(history))
+    entry = {"hist": key[0], "grid": compute_big_road(history), "derived": derived, "ui": {},
+             "res": baccarat_ai_logic(history.tail(AI_WINDOW_HANDS), *derived, total_counts=total_counts)}
+    with analysis_cache_lock:
+        analysis_cache[key] = entry
+        while len(analysis_cache) > ANALYSIS_CACHE_SIZE:
+            analysis_cache.popitem(last=False)
+    return entry
+
+def road_widgets(entry, history, bead_cols, br_cols):
+    widgets = entry["ui"].get((bead_cols, br_cols))
+    if widgets is None:
+        # 在鎖外組好再寫回 (見 road_image_url)；兩條執行緒同時組同一份時沿用先寫入的
+        widgets = (build_bead_road(history, bead_cols), build_big_road_ui(entry["grid"], br_cols))
+        with analysis_cache_lock:
+            widgets = entry["ui"].setdefault((bead_cols, br_cols), widgets)
+    return widgets
+
+def build_analysis_flex(room, history, total_counts=None, profit_info=None, _out_res=None, tier=0):
+    history = as_shoe(history)
+    core = analysis_core(history, total_counts)
+    res = core["res"]
     if _out_res is not None:
         _out_res.update(res)
-    reason_text = res.get("理由", "")
+    reason_text = res.get("理由", "") if tier < 2 else ""
     if total_counts:
         tb = total_counts.get('莊', 0)
         tp = total_counts.get('閒', 0)
@@ -855,26 +1689,35 @@ def build_analysis_flex(room, history, total_counts=None, profit_info=None, _out
     }
     pred_box = {"type": "box", "layout": "vertical", "margin": "xs", "backgroundColor": "#FDF2E9", "paddingAll": "sm", "cornerRadius": "md", "contents": pred}
     info_line = {"type": "text", "text": f"房號：{room} | 模式：{res['模式']}", "size": "xxs", "color": "#888888"}
+    # 負載升級後 (tier >= 1) 不再畫新圖，已畫好的照用，其餘改回 Flex 方格
+    image_url = road_image_url(core, render=tier == 0) if ROAD_IMAGE else None
+    if image_url:
+        # 五路整張圖：卡片大小固定，不必逐步縮小牌路
+        roads = [
+            {"type": "image", "url": image_url, "size": "full", "aspectMode": "fit", "aspectRatio": "5:1", "margin": "xs"},
+            {"type": "text", "text": "珠盤路｜大路　大眼仔／小路／曱甴路", "size": "xxs", "color": "#AAAAAA", "align": "center"},
+        ]
+        bubble1 = {
+            "type": "bubble", "size": "giga",
+            "header": hdr,
+            "body": {"type": "box", "layout": "vertical", "spacing": "none", "paddingAll": "xs",
+                     "contents": [info_line, *roads, pred_box]},
+            "footer": footer
+        }
+        return {"type": "flex", "altText": "AI分析報告", "contents": bubble1}
     # Progressive size reduction: reduce bead + big road columns until under 29KB
-    attempts = [
-        (15, 80),  # full
-        (15, 50),
-        (15, 30),
-        (10, 30),
-        (8, 25),
-        (6, 20),
-    ]
-    for bead_cols, br_cols in attempts:
+    for bead_cols, br_cols in RENDER_TIER_ATTEMPTS[min(tier, 2)]:
         bubble1 = {
             "type": "bubble", "size": "giga",
             "header": hdr,
             "body": {
                 "type": "box", "layout": "vertical", "spacing": "none", "paddingAll": "xs",
-                "contents": [info_line, build_bead_road(history, bead_cols), build_big_road_ui(big_road_grid, br_cols), pred_box]
+                "contents": [info_line, *road_widgets(core, history, bead_cols, br_cols), pred_box]
             },
             "footer": footer
         }
-        b1_size = len(json.dumps(bubble1, ensure_ascii=False))
+        # 以實際送出的 bytes 計算大小
+        b1_size = len(json_dumps_bytes(bubble1))
         print(f"[DEBUG] bubble1={b1_size} (bead={bead_cols}, big_road={br_cols})")
         if b1_size < 29000:
             break
@@ -901,30 +1744,222 @@ def build_slot_flex(room, res):
         }
     }
 
+def build_slot_rank_flex(game, ranked):
+    rows = []
+    for n, r in enumerate(ranked, 1):
+        res = calculate_slot_logic(r["total_bet"], r["score_rate"])
+        rows.append({"type": "box", "layout": "horizontal", "margin": "sm", "contents": [
+            {"type": "text", "text": f"{n}.", "size": "xs", "flex": 1, "color": "#888888"},
+            {"type": "text", "text": f"房號 {r['room']}", "size": "xs", "flex": 3, "weight": "bold"},
+            {"type": "text", "text": res["level"], "size": "xs", "flex": 4, "color": res["color"]},
+            {"type": "text", "text": f"{r['space']:,.0f}", "size": "xxs", "flex": 3, "align": "end", "color": "#666666"}
+        ]})
+    return {
+        "type": "flex", "altText": f"{game} 推薦房間",
+        "contents": {
+            "type": "bubble",
+            "header": {"type": "box", "layout": "vertical", "backgroundColor": "#2C3E50", "contents": [
+                {"type": "text", "text": f"🔥 {game} 推薦房間 TOP {len(ranked)}", "color": "#ffffff", "weight": "bold", "size": "md", "align": "center"}
+            ]},
+            "body": {"type": "box", "layout": "vertical", "contents": [
+                {"type": "text", "text": f"依補償空間排序 | RTP: {FIXED_RTP}%", "size": "xxs", "color": "#888888"}
+            ] + rows}
+        },
+        "quickReply": {"items": [
+            {"type": "action", "action": {"type": "message", "label": f"房號{r['room']}"[:20], "text": r["room"]}} for r in ranked[:12]
+        ] + [{"type": "action", "action": {"type": "message", "label": "↩ 返回主選單", "text": "返回主選單"}}]}
+    }
+
+# ==================== 多頻道 ====================
+class LineChannel:
+    """一個 LINE 官方帳號：憑證與自己的連線池。預設頻道沿用原始 uid，
+    其他頻道的 uid 在進來時就加上「頻道id:」前綴，所有以 uid 為 key 的狀態因此自然分開"""
+
+    def __init__(self, cid, access_token, secret, destination=None, admins=()):
+        self.id = cid
+        self.prefix = "" if cid == DEFAULT_CHANNEL_ID else f"{cid}:"
+        self.secret_key = secret.encode('utf-8')
+        self.destination = destination
+        self.admins = [self.prefix + a for a in admins]
+        self.headers = {"Content-Type": "application/json", "Authorization": f"Bearer {access_token}"}
+        self.http = requests.Session()
+
+default_channel = LineChannel(DEFAULT_CHANNEL_ID, LINE_ACCESS_TOKEN, LINE_CHANNEL_SECRET)
+line_channels = {DEFAULT_CHANNEL_ID: default_channel}   # 頻道 id -> LineChannel
+channels_by_destination = {}                             # bot user id -> LineChannel
+
+def load_line_channels():
+    raw = os.environ.get("LINE_CHANNELS")
+    configs = json_loads(raw) if raw else load_data(LINE_CHANNELS_FILE, [])
+    for cfg in configs:
+        cid = cfg.get("id", "")
+        if not cid or ":" in cid or "/" in cid or cid in line_channels:
+            print(f"[CHANNEL] invalid or duplicate channel id {cid!r}, skipped")
+            continue
+        channel = LineChannel(cid, cfg["access_token"], cfg["secret"], cfg.get("destination"), cfg.get("admins", ()))
+        line_channels[cid] = channel
+        if channel.destination:
+            channels_by_destination[channel.destination] = channel
+    if len(line_channels) > 1:
+        print(f"[CHANNEL] serving {len(line_channels)} channels: {', '.join(line_channels)}")
+
+def resolve_channel(channel_id=None, destination=None):
+    """路徑指定的頻道優先 (不存在回傳 None)，其次本文的 destination，都沒有就是預設頻道"""
+    if channel_id is not None:
+        return line_channels.get(channel_id)
+    return channels_by_destination.get(destination, default_channel)
+
+def channel_for_uid(uid):
+    """命名空間 uid -> (頻道, LINE 原始 uid)"""
+    if uid and ":" in uid:
+        cid, raw = uid.split(":", 1)
+        channel = line_channels.get(cid)
+        if channel is not None:
+            return channel, raw
+    return default_channel, uid
+
+def is_admin(uid):
+    """ADMIN_UIDS 是整個服務的管理員；其他頻道設定的 admins 只管自己的頻道 (uid 已帶該頻道前綴)"""
+    if uid in ADMIN_UIDS:
+        return True
+    channel, _ = channel_for_uid(uid)
+    return channel is not default_channel and uid in channel.admins
+
+load_line_channels()
+
 # ==================== LINE 回覆 ====================
-def line_reply(reply_token, payload):
-    MENU_QUICK_REPLY = {"items": [
-        {"type": "action", "action": {"type": "message", "label": "計算獲利", "text": "計算獲利"}},
-        {"type": "action", "action": {"type": "message", "label": "百家預測", "text": "百家預測"}},
-        {"type": "action", "action": {"type": "message", "label": "電子預測", "text": "電子預測"}},
-        {"type": "action", "action": {"type": "message", "label": "儲值", "text": "儲值"}}
-    ]}
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {LINE_ACCESS_TOKEN}"}
+MENU_QUICK_ITEMS = [
+    {"type": "action", "action": {"type": "message", "label": "計算獲利", "text": "計算獲利"}},
+    {"type": "action", "action": {"type": "message", "label": "百家預測", "text": "百家預測"}},
+    {"type": "action", "action": {"type": "message", "label": "電子預測", "text": "電子預測"}},
+    {"type": "action", "action": {"type": "message", "label": "儲值", "text": "儲值"}}
+]
+MENU_QUICK_REPLY = {"items": MENU_QUICK_ITEMS}
+
+LINE_API_BASE = "https://api.line.me/v2/bot/message"
+
+# 共用連線 (keep-alive)，避免每次回覆都重新 TLS 握手；每個頻道各有一個 Session，這是預設頻道的
+line_http = default_channel.http
+
+# 非同步模式 (sv94_asgi) 會換成「排進事件迴圈後立即返回」的實作
+# 介面：line_transport(path, body, headers, on_result, channel)，on_result(status, text)
+line_transport = None
+
+def _post_line_sync(path, body, headers, on_result, channel=None):
+    try:
+        resp = (channel or default_channel).http.post(f"{LINE_API_BASE}/{path}", headers=headers, data=body, timeout=30)
+        status, text = resp.status_code, resp.text
+    except Exception as e:
+        status, text = None, str(e)
+    on_result(status, text)
+
+def send_line_request(path, body, on_result, channel=None):
+    """body 可以是 dict 或已序列化的 bytes；傳輸層一律收到 bytes。channel 省略時為預設頻道"""
+    if not isinstance(body, bytes):
+        body = json_dumps_bytes(body)
+    metrics_inc("line_bytes_out", len(body))
+    channel = channel or default_channel
+    if session_lock.defer((path, body, on_result, channel)):
+        return
+    _send_line_now(path, body, on_result, channel)
+
+def _send_line_now(path, body, on_result, channel):
+    (line_transport or _post_line_sync)(path, body, channel.headers, on_result, channel)
+
+# --- Reply token 期限 ---
+reply_tokens = {}            # reply token -> (uid, 事件發生時間, 頻道 id)
+_reply_token_ring = deque()  # (reply token, 登記時間)，過期清除用
+_reply_token_lock = threading.Lock()
+
+def register_reply_token(event):
+    tk = event.get("replyToken")
+    if not tk:
+        return
+    # 沒有 uid 的事件也要登記：回覆時靠這裡找出 token 屬於哪個頻道
+    uid = (event.get("source") or {}).get("userId")
+    now = time.time()
+    received = event.get("_received_at", now)
+    # 以 LINE 的事件時間為準 (含傳遞延遲)；時鐘誤差造成時間在未來時改用收到時間
+    ts = event.get("timestamp")
+    issued = min(ts / 1000.0, received) if ts else received
+    with _reply_token_lock:
+        reply_tokens[tk] = (uid, issued, event.get("_channel", DEFAULT_CHANNEL_ID))
+        _reply_token_ring.append((tk, now))
+        while _reply_token_ring and now - _reply_token_ring[0][1] > REPLY_TOKEN_TTL_SEC * 2:
+            reply_tokens.pop(_reply_token_ring.popleft()[0], None)
+
+def take_reply_token(tk):
+    """回覆時取出 token 的 (uid, 剩餘秒數, 頻道)；未登記的 token 回傳 None"""
+    with _reply_token_lock:
+        ctx = reply_tokens.pop(tk, None)
+    if ctx is None:
+        return None
+    uid, issued, cid = ctx
+    age = time.time() - issued
+    metrics_inc("reply_token_age_ms_total", int(age * 1000))
+    metrics_inc("reply_token_uses")
+    with metrics_lock:
+        metrics["reply_token_age_ms_max"] = max(metrics["reply_token_age_ms_max"], int(age * 1000))
+    return uid, REPLY_TOKEN_TTL_SEC - age, line_channels.get(cid, default_channel)
+
+def _push_fallback(uid, body):
+    """body 為 messages 陣列的 JSON bytes；與原本要回覆的內容相同"""
+    metrics_inc("line_push_fallbacks")
+    channel, raw_uid = channel_for_uid(uid)
+    send_line_request("push", b'{"to":' + json_dumps_bytes(raw_uid) + b',"messages":' + body + b"}", _on_push_result, channel)
+
+def _on_push_result(status, text):
+    if status != 200:
+        print(f"[LINE PUSH ERROR] {status}: {text[:300]}")
+        metrics_inc("line_push_fallback_errors")
+
+def _dispatch_reply(reply_token, messages_body, n_msgs):
+    """有足夠時間就走 reply；時間不夠直接 push，reply 回報 token 無效時再補 push"""
+    ctx = take_reply_token(reply_token)
+    channel = ctx[2] if ctx is not None else default_channel
+    uid = ctx[0] if ctx is not None and REPLY_PUSH_FALLBACK else None
+    # 逾時的 token 不論是否改用 push 都要計數；只有 push 受 REPLY_PUSH_FALLBACK 控制
+    if ctx is not None and ctx[1] < REPLY_MIN_BUDGET_SEC:
+        metrics_inc("line_reply_late")
+        if uid is not None:
+            print(f"[LINE] reply token too old ({REPLY_TOKEN_TTL_SEC - ctx[1]:.1f}s), pushing to {uid[-6:]}")
+            _push_fallback(uid, messages_body)
+            return
+        print(f"[LINE] reply token too old ({REPLY_TOKEN_TTL_SEC - ctx[1]:.1f}s), replying anyway")
+    fallback = (lambda: _push_fallback(uid, messages_body)) if uid is not None else None
+    body = b'{"replyToken":' + json_dumps_bytes(reply_token) + b',"messages":' + messages_body + b"}"
+    send_line_request("reply", body, _on_reply_result(n_msgs, fallback), channel)
+
+def _on_reply_result(n_msgs, fallback=None):
+    def done(status, text):
+        if status != 200:
+            print(f"[LINE API ERROR] {status}: {text[:300]}")
+            metrics_inc("line_reply_errors")
+            if status == 400 and "reply token" in (text or "").lower():
+                metrics_inc("line_reply_token_invalid")
+                if fallback is not None:
+                    fallback()
+        else:
+            print(f"[LINE API OK] sent {n_msgs} msg(s)")
+            metrics_inc("line_replies_ok")
+            record_first_reply()
+    return done
+
+def line_reply(reply_token, payload, quick_reply=True):
     if isinstance(payload, list):
-        msgs = payload
+        msgs = list(payload)
     elif isinstance(payload, dict):
         msgs = [payload]
     else:
         msgs = [{"type": "text", "text": str(payload)}]
-    if msgs:
-        last = msgs[-1]
-        if "quickReply" not in last:
-            last["quickReply"] = MENU_QUICK_REPLY
-    resp = requests.post("https://api.line.me/v2/bot/message/reply", headers=headers, json={"replyToken": reply_token, "messages": msgs})
-    if resp.status_code != 200:
-        print(f"[LINE API ERROR] {resp.status_code}: {resp.text[:300]}")
-    else:
-        print(f"[LINE API OK] sent {len(msgs)} msg(s)")
+    # 不修改傳入的訊息，預先建好的共用模板才能重複使用
+    if msgs and quick_reply and "quickReply" not in msgs[-1]:
+        msgs[-1] = dict(msgs[-1], quickReply=MENU_QUICK_REPLY)
+    _dispatch_reply(reply_token, json_dumps_bytes(msgs), len(msgs))
+
+def line_reply_raw(reply_token, msg_bytes_list):
+    """送出已序列化的訊息 (行程池渲染的結果)，只拼接外層不重新編碼"""
+    _dispatch_reply(reply_token, b"[" + b",".join(msg_bytes_list) + b"]", len(msg_bytes_list))
 
 def sys_bubble(text, quick_reply_items=None):
     bubble = {
@@ -947,39 +1982,359 @@ def sys_bubble(text, quick_reply_items=None):
 def text_with_back(text):
     return sys_bubble(text, [{"type": "action", "action": {"type": "message", "label": "↩ 返回主選單", "text": "返回主選單"}}])
 
+# ==================== 批次推播 (multicast) ====================
+broadcast_jobs = {}   # job_id -> 工作狀態 (持久化於 BROADCAST_JOBS_FILE)
+broadcast_lock = threading.RLock()
+_broadcast_log_lines = 0
+broadcast_executor = None   # 第一次推播時才建立 (冷啟動不載入)
+_send_bucket = None
+_send_bucket_lock = threading.Lock()
+
+def _acquire_send_slot():
+    """所有推播 worker 共用的阻塞式令牌桶"""
+    global _send_bucket
+    while True:
+        with _send_bucket_lock:
+            if _send_bucket is None:
+                _send_bucket = TokenBucket(BROADCAST_RATE_PER_SEC, BROADCAST_RATE_PER_SEC)
+            if _send_bucket.take():
+                return
+        time.sleep(1.0 / BROADCAST_RATE_PER_SEC)
+
+# 紀錄檔每行一筆：{"op": "job", "id", "job"} 建立工作 (名單只寫這一次)、
+# {"op": "chunk", "id", "idx", "status", "attempts", "sent", "failed", ["job_status", "finished_at"]} 一批送完
+def _append_broadcast_log(record):
+    global _broadcast_log_lines
+    try:
+        with open(BROADCAST_JOBS_FILE, 'ab') as f:
+            f.write(json_dumps_bytes(record) + b"\n")
+        _broadcast_log_lines += 1
+    except OSError as e:
+        print(f"[MULTICAST] log write failed: {e}")
+
+def _apply_chunk_result(job, idx, rec):
+    chunk = job["chunks"][idx]
+    chunk["status"] = rec["status"]
+    chunk["attempts"] = rec["attempts"]
+    # 送完的批次不必再留名單，只記人數
+    if "to" in chunk:
+        chunk["n"] = len(chunk.pop("to"))
+    job["sent"], job["failed"] = rec["sent"], rec["failed"]
+    if "job_status" in rec:
+        job["status"], job["finished_at"] = rec["job_status"], rec["finished_at"]
+        job.pop("messages", None)
+
+def _prune_broadcast_jobs(now=None):
+    """丟掉完成超過 BROADCAST_JOB_RETAIN_DAYS 的工作 (呼叫端持有 broadcast_lock)"""
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=BROADCAST_JOB_RETAIN_DAYS)
+    for job_id, job in list(broadcast_jobs.items()):
+        finished = job.get("finished_at")
+        if job.get("status") != "running" and datetime.fromisoformat(finished or job["created_at"]) < cutoff:
+            del broadcast_jobs[job_id]
+
+def _compact_broadcast_log():
+    """改寫紀錄檔：每個保留中的工作一行 (呼叫端持有 broadcast_lock)"""
+    global _broadcast_log_lines
+    _prune_broadcast_jobs()
+    tmp = f"{BROADCAST_JOBS_FILE}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            for job_id, job in broadcast_jobs.items():
+                f.write(json_dumps_bytes({"op": "job", "id": job_id, "job": job}) + b"\n")
+        os.replace(tmp, BROADCAST_JOBS_FILE)
+        _broadcast_log_lines = len(broadcast_jobs)
+    except OSError as e:
+        print(f"[MULTICAST] log compaction failed: {e}")
+
+def _load_broadcast_log():
+    """重播紀錄檔；最後一行若因當機而不完整就略過"""
+    jobs = load_data(BROADCAST_JOBS_LEGACY_FILE) if os.path.exists(BROADCAST_JOBS_LEGACY_FILE) else {}
+    try:
+        with open(BROADCAST_JOBS_FILE, 'rb') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        lines = []
+    for line in lines:
+        try:
+            rec = json_loads(line)
+            if rec["op"] == "job":
+                jobs[rec["id"]] = rec["job"]
+            elif rec["id"] in jobs:
+                _apply_chunk_result(jobs[rec["id"]], rec["idx"], rec)
+        except (ValueError, KeyError, IndexError, TypeError):
+            print(f"[MULTICAST] skip bad log line: {line[:80]!r}")
+    return jobs
+
+def _send_multicast_chunk(job_id, idx):
+    with broadcast_lock:
+        job = broadcast_jobs[job_id]
+        chunk = job["chunks"][idx]
+        messages = job["messages"]
+    channel = line_channels.get(chunk.get("channel"), default_channel)
+    # 同一個 retry key 重送時 LINE 不會重複發送，中斷後續傳也安全
+    headers = {**channel.headers, "X-Line-Retry-Key": chunk["retry_key"]}
+    status = "failed"
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        _acquire_send_slot()
+        try:
+            resp = channel.http.post(f"{LINE_API_BASE}/multicast", headers=headers,
+                                 json={"to": chunk["to"], "messages": messages}, timeout=30)
+            code = resp.status_code
+        except Exception as e:
+            print(f"[MULTICAST] {job_id}#{idx} error: {e}")
+            code = None
+        if code == 200 or code == 409:   # 409 = 此 retry key 已被接受過
+            status = "sent"
+            break
+        if code is not None and 400 <= code < 500 and code != 429:
+            print(f"[MULTICAST] {job_id}#{idx} rejected {code}: {resp.text[:200]}")
+            break
+        time.sleep(min(2 ** attempt, 30))
+    n = len(chunk["to"])
+    with broadcast_lock:
+        job["sent" if status == "sent" else "failed"] += n
+        rec = {"op": "chunk", "id": job_id, "idx": idx, "status": status,
+               "attempts": chunk.get("attempts", 0) + attempt + 1, "sent": job["sent"], "failed": job["failed"]}
+        if all(c["status"] != "pending" for i, c in enumerate(job["chunks"]) if i != idx):
+            rec["job_status"] = "done" if job["failed"] == 0 else "partial"
+            rec["finished_at"] = datetime.now(timezone.utc).isoformat()
+            print(f"[MULTICAST] job {job_id} {rec['job_status']}: sent={job['sent']} failed={job['failed']}")
+        _apply_chunk_result(job, idx, rec)
+        _append_broadcast_log(rec)
+        if "job_status" in rec and _broadcast_log_lines > BROADCAST_LOG_COMPACT_LINES:
+            _compact_broadcast_log()
+    metrics_inc("multicast_chunks_" + status)
+    metrics_inc("multicast_recipients_" + status, n)
+
+def _run_broadcast_job(job_id):
+    with broadcast_lock:
+        pending = [i for i, c in enumerate(broadcast_jobs[job_id]["chunks"]) if c["status"] == "pending"]
+    global broadcast_executor
+    if pending and broadcast_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        broadcast_executor = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix="multicast")
+    for idx in pending:
+        broadcast_executor.submit(_send_multicast_chunk, job_id, idx)
+
+def start_broadcast(recipients, messages, kind="announce"):
+    """建立一個推播工作：名單依頻道分開後切成 500 人一組，交給 worker pool 併發送出"""
+    recipients = list(dict.fromkeys(recipients))
+    job_id = uuid.uuid4().hex[:8]
+    by_channel = {}
+    for uid in recipients:
+        channel, raw_uid = channel_for_uid(uid)
+        by_channel.setdefault(channel.id, []).append(raw_uid)
+    chunks = [{"channel": cid, "to": raw[i:i + MULTICAST_CHUNK_SIZE], "retry_key": str(uuid.uuid4()), "status": "pending"}
+              for cid, raw in by_channel.items() for i in range(0, len(raw), MULTICAST_CHUNK_SIZE)]
+    with broadcast_lock:
+        broadcast_jobs[job_id] = {
+            "kind": kind, "created_at": datetime.now(timezone.utc).isoformat(), "status": "running" if chunks else "done",
+            "total": len(recipients), "sent": 0, "failed": 0, "messages": messages, "chunks": chunks
+        }
+        _append_broadcast_log({"op": "job", "id": job_id, "job": broadcast_jobs[job_id]})
+    metrics_inc("multicast_jobs_started")
+    _run_broadcast_job(job_id)
+    return job_id
+
+def resume_broadcast_jobs():
+    """啟動時接續上次中斷的推播工作；順便清掉過期工作並改寫紀錄檔"""
+    with broadcast_lock:
+        broadcast_jobs.update(_load_broadcast_log())
+        _compact_broadcast_log()
+        if os.path.exists(BROADCAST_JOBS_LEGACY_FILE):
+            os.replace(BROADCAST_JOBS_LEGACY_FILE, BROADCAST_JOBS_LEGACY_FILE + ".migrated")
+    for job_id, job in list(broadcast_jobs.items()):
+        if job.get("status") == "running":
+            print(f"[MULTICAST] resume job {job_id}")
+            _run_broadcast_job(job_id)
+
+def active_user_ids(channel=None):
+    """目前有效的付費用戶 (由到期索引直接切出)；指定頻道時只取該頻道的用戶"""
+    now = int(time.time())
+    with user_data_lock:
+        lo = bisect.bisect_right(expiry_index, (now, "\uffff"))
+        uids = [uid for _, uid in expiry_index[lo:]]
+    if channel is None:
+        return uids
+    return [uid for uid in uids if channel_for_uid(uid)[0] is channel]
+
+def broadcast_status_text(job_id=None):
+    with broadcast_lock:
+        if not broadcast_jobs:
+            return "📭 尚無推播紀錄"
+        if job_id is None:
+            ids = sorted(broadcast_jobs, key=lambda j: broadcast_jobs[j]["created_at"])[-5:]
+        elif job_id in broadcast_jobs:
+            ids = [job_id]
+        else:
+            return f"⚠️ 找不到推播工作 {job_id}"
+        lines = ["📣 推播狀態"]
+        for j in ids:
+            job = broadcast_jobs[j]
+            done = sum(1 for c in job["chunks"] if c["status"] != "pending")
+            lines.append(f"{j} [{job['kind']}] {job['status']}\n  進度 {done}/{len(job['chunks'])} 批｜成功 {job['sent']}｜失敗 {job['failed']}｜共 {job['total']} 人")
+        return "\n".join(lines)
+
+# ==================== 靜態資源：平台 Logo 尺寸版本 ====================
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+# thumb 給 header 的 xxs 小圖，full 給平台選單的大卡片 (皆為 3x 螢幕所需像素)
+ASSET_VARIANTS = {"thumb": 120, "full": 480}
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_RENDER_VERSION = 1   # 縮圖參數改變時加一，網址跟著變
+asset_store = {}   # "MT.thumb" -> {"src", "px", "etag", "body" (第一次被請求時才產生)}
+asset_lock = threading.Lock()
+
+def _render_variant(src, px):
+    """縮圖並重新壓縮；沒有 Pillow 或結果反而更大時沿用原圖"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return src
+    try:
+        im = Image.open(io.BytesIO(src)).convert("RGB")
+        im.thumbnail((px, px), Image.LANCZOS)
+        out = io.BytesIO()
+        im.save(out, "JPEG", quality=82, optimize=True, progressive=True)
+    except Exception as e:
+        # 原圖損毀或格式不支援：照原樣送出，不影響啟動與其他資源
+        print(f"[ASSETS] resize to {px}px failed, serving original: {e}")
+        return src
+    data = out.getvalue()
+    return data if len(data) < len(src) else src
+
+def build_assets():
+    """啟動時只讀原圖並算 ETag (原圖雜湊 + 尺寸)，不在匯入時跑 Pillow；縮圖在第一次請求時才產生"""
+    for logo in ("MT", "DG"):
+        try:
+            with open(os.path.join(STATIC_DIR, f"{logo}.jpg"), 'rb') as f:
+                src = f.read()
+        except OSError as e:
+            print(f"[ASSETS] {logo}.jpg unavailable: {e}")
+            continue
+        digest = hashlib.sha256(src)
+        for variant, px in ASSET_VARIANTS.items():
+            d = digest.copy()
+            d.update(f":{px}:{ASSET_RENDER_VERSION}".encode('ascii'))
+            asset_store[f"{logo}.{variant}"] = {"src": src, "px": px, "etag": d.hexdigest()[:16], "body": None}
+
+def asset_body(asset):
+    body = asset["body"]
+    if body is None:
+        with asset_lock:
+            body = asset["body"]
+            if body is None:
+                body = asset["body"] = _render_variant(asset["src"], asset["px"])
+    return body
+
+def asset_url(logo, variant):
+    """內容定址的網址：圖片一變網址就變，因此可以永久快取"""
+    asset = asset_store.get(f"{logo}.{variant}")
+    if not asset:
+        return f"{BASE_URL}/static/{logo}.jpg"
+    return f"{BASE_URL}/assets/{logo}.{variant}.{asset['etag']}.jpg"
+
+build_assets()
+
+# ==================== 靜態 Flex 模板 (載入時預先建好) ====================
+MAIN_MENU_MSG = sys_bubble("--- 新紀元 AI 系統 ---", MENU_QUICK_ITEMS)
+
+PROVIDER_BODY = {"type": "box", "layout": "horizontal", "spacing": "lg", "paddingAll": "lg", "contents": [
+    {"type": "box", "layout": "vertical", "flex": 1, "cornerRadius": "lg", "backgroundColor": "#F8F9FA", "paddingAll": "md", "contents": [
+        {"type": "image", "url": asset_url("MT", "full"), "size": "full", "aspectRatio": "1:1", "aspectMode": "cover"},
+        {"type": "text", "text": "MT真人", "weight": "bold", "size": "md", "align": "center", "margin": "sm", "color": "#2C3E50"},
+    ], "action": {"type": "message", "label": "MT真人", "text": "平台:MT"}},
+    {"type": "box", "layout": "vertical", "flex": 1, "cornerRadius": "lg", "backgroundColor": "#F8F9FA", "paddingAll": "md", "contents": [
+        {"type": "image", "url": asset_url("DG", "full"), "size": "full", "aspectRatio": "1:1", "aspectMode": "cover"},
+        {"type": "text", "text": "DG真人", "weight": "bold", "size": "md", "align": "center", "margin": "sm", "color": "#2C3E50"},
+    ], "action": {"type": "message", "label": "DG真人", "text": "平台:DG"}}
+]}
+PROVIDER_FOOTER = {"type": "box", "layout": "vertical", "contents": [
+    {"type": "button", "action": {"type": "message", "label": "↩ 返回主選單", "text": "返回主選單"}, "style": "primary", "color": "#1A5276", "height": "sm"}
+]}
+
+def build_provider_flex(left):
+    """平台選單：只有授權剩餘時間會變，其餘沿用預建的 body/footer"""
+    return {
+        "type": "flex", "altText": "請選擇平台",
+        "contents": {
+            "type": "bubble", "size": "mega",
+            "header": {"type": "box", "layout": "vertical", "backgroundColor": "#1A5276", "paddingAll": "md", "contents": [
+                {"type": "text", "text": "🎲 請選擇遊戲平台", "color": "#ffffff", "weight": "bold", "size": "lg", "align": "center"},
+                {"type": "text", "text": f"🔑 授權剩餘：{left}", "color": "#AED6F1", "size": "xs", "align": "center", "margin": "xs"}
+            ]},
+            "body": PROVIDER_BODY,
+            "footer": PROVIDER_FOOTER
+        }
+    }
+
+MT_CATEGORY_FLEX = {
+    "type": "flex", "altText": "MT真人 - 選擇遊戲廳",
+    "contents": {
+        "type": "bubble", "size": "mega",
+        "header": {"type": "box", "layout": "vertical", "backgroundColor": "#1A5276", "paddingAll": "md", "contents": [
+            {"type": "box", "layout": "horizontal", "contents": [
+                {"type": "image", "url": asset_url("MT", "thumb"), "size": "xxs", "aspectRatio": "1:1", "aspectMode": "cover", "flex": 0},
+                {"type": "box", "layout": "vertical", "flex": 4, "paddingStart": "md", "contents": [
+                    {"type": "text", "text": "MT真人", "color": "#ffffff", "weight": "bold", "size": "lg"},
+                    {"type": "text", "text": "請選擇遊戲廳", "color": "#AED6F1", "size": "xs"}
+                ]}
+            ]}
+        ]},
+        "body": {"type": "box", "layout": "vertical", "spacing": "sm", "paddingAll": "lg", "contents": [
+            {"type": "button", "action": {"type": "message", "label": "🎲 百家樂 - 亞洲廳", "text": "MT廳:亞洲廳"}, "style": "primary", "color": "#2E86C1", "height": "sm"},
+            {"type": "button", "action": {"type": "message", "label": "🎲 百家樂 - 國際廳（敬請期待）", "text": "MT廳:國際廳"}, "style": "secondary", "height": "sm"},
+            {"type": "button", "action": {"type": "message", "label": "↩ 返回主選單", "text": "返回主選單"}, "style": "secondary", "height": "sm"}
+        ]}
+    }
+}
+
+DG_CATEGORY_FLEX = {
+    "type": "flex", "altText": "DG真人 - 選擇遊戲廳",
+    "contents": {
+        "type": "bubble", "size": "mega",
+        "header": {"type": "box", "layout": "vertical", "backgroundColor": "#1A5276", "paddingAll": "md", "contents": [
+            {"type": "box", "layout": "horizontal", "contents": [
+                {"type": "image", "url": asset_url("DG", "thumb"), "size": "xxs", "aspectRatio": "1:1", "aspectMode": "cover", "flex": 0},
+                {"type": "box", "layout": "vertical", "flex": 4, "paddingStart": "md", "contents": [
+                    {"type": "text", "text": "DG真人", "color": "#ffffff", "weight": "bold", "size": "lg"},
+                    {"type": "text", "text": "請選擇遊戲廳", "color": "#AED6F1", "size": "xs"}
+                ]}
+            ]}
+        ]},
+        "body": {"type": "box", "layout": "vertical", "spacing": "sm", "paddingAll": "lg", "contents": [
+            {"type": "button", "action": {"type": "message", "label": "🎲 百家樂", "text": "DG廳:百家樂"}, "style": "primary", "color": "#2E86C1", "height": "sm"},
+            {"type": "button", "action": {"type": "message", "label": "💃 性感百家樂", "text": "DG廳:性感百家樂"}, "style": "primary", "color": "#8E44AD", "height": "sm"},
+            {"type": "button", "action": {"type": "message", "label": "↩ 返回主選單", "text": "返回主選單"}, "style": "secondary", "height": "sm"}
+        ]}
+    }
+}
+
 # ==================== 輔助功能 ====================
 def send_main_menu(tk):
-    line_reply(tk, sys_bubble("--- 新紀元 AI 系統 ---", [
-        {"type": "action", "action": {"type": "message", "label": "計算獲利", "text": "計算獲利"}},
-        {"type": "action", "action": {"type": "message", "label": "百家預測", "text": "百家預測"}},
-        {"type": "action", "action": {"type": "message", "label": "電子預測", "text": "電子預測"}},
-        {"type": "action", "action": {"type": "message", "label": "儲值", "text": "儲值"}}
-    ]))
+    line_reply(tk, MAIN_MENU_MSG)
 
 def get_access_status(uid):
-    if uid in ADMIN_UIDS:
+    if is_admin(uid):
         return "active", "永久"
-    user = user_access_data.get(uid)
-    if not user:
+    expiry = user_expiry_ts.get(uid)
+    if expiry is None:
         return "none", ""
-    expiry = datetime.fromisoformat(user["expiry_date"].replace('Z', '+00:00'))
-    now = datetime.now(timezone.utc)
-    if now < expiry:
-        diff = expiry - now
-        return "active", f"{diff.days}天 {diff.seconds // 3600}時"
+    diff = expiry - int(time.time())
+    if diff > 0:
+        return "active", f"{diff // 86400}天 {diff % 86400 // 3600}時"
     return "expired", ""
 
 def use_time_card(uid, code):
     with time_cards_data_lock:
         active = time_cards_data.get("active_cards", {})
-        if code not in active:
+        # 序號只能在產生它的頻道使用
+        if code not in active or active[code].get("channel", DEFAULT_CHANNEL_ID) != channel_for_uid(uid)[0].id:
             return False, "❌ 序號無效"
         dur_str = active[code]["duration"]
         val = int(''.join(filter(str.isdigit, dur_str)))
         now = datetime.now(timezone.utc)
-        current_expiry = datetime.fromisoformat(
-            user_access_data.get(uid, {"expiry_date": now.isoformat()})["expiry_date"].replace('Z', '+00:00')
-        )
+        current_ts = user_expiry_ts.get(uid)
+        current_expiry = datetime.fromtimestamp(current_ts, timezone.utc) if current_ts is not None else now
         base_time = max(now, current_expiry)
         if 'M' in dur_str:
             delta = timedelta(minutes=val)
@@ -987,435 +2342,1923 @@ def use_time_card(uid, code):
             delta = timedelta(hours=val)
         else:
             delta = timedelta(days=val)
-        new_expiry = (base_time + delta).isoformat().replace("+00:00", "Z")
-        user_access_data[uid] = {"expiry_date": new_expiry}
-        time_cards_data.setdefault("used_cards", {})[code] = active.pop(code)
-        save_data(USER_DATA_FILE, user_access_data)
-        save_data(TIME_CARDS_FILE, time_cards_data)
+        new_dt = base_time + delta
+        new_expiry = new_dt.isoformat().replace("+00:00", "Z")
+        with user_data_lock:   # 與到期掃描的標記互斥
+            user_access_data[uid] = {"expiry_date": new_expiry, "expiry_ts": int(new_dt.timestamp())}
+            set_user_expiry(uid, int(new_dt.timestamp()))
+            expiry_notified.pop(uid, None)
+        card = active.pop(code)
+        card["used_by"] = uid
+        card["used_at"] = now.isoformat()
+        used = time_cards_data.setdefault("used_cards", {})
+        used[code] = card
+        with user_data_lock:
+            save_data(USER_DATA_FILE, user_access_data)
+        if len(used) >= CARD_HOT_USED_MAX:
+            compact_used_cards()
+        else:
+            save_data(TIME_CARDS_FILE, time_cards_data)
         return True, f"✅ 儲值成功！有效期至：\n{new_expiry[:16]}"
 
-# ==================== Webhook 入口 ====================
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    signature = request.headers.get('X-Line-Signature', '')
-    body = request.get_data(as_text=True)
-    if not verify_signature(body, signature):
-        abort(400)
+# ==================== 獲利帳本 ====================
+LEDGER_SIDES = ["莊", "閒", "和"]
+LEDGER_SIDE_CODE = {s: i for i, s in enumerate(LEDGER_SIDES)}
+LEDGER_EXPORT_CHUNK = 1000
 
-    data = request.json
-    for event in data.get("events", []):
-        # 處理 follow 事件 (新用戶加入)
-        if event["type"] == "follow":
-            uid = event["source"]["userId"]
-            tk = event["replyToken"]
-            print(f"[FOLLOW] new user: {uid[-6:]}")
-            send_main_menu(tk)
-            continue
-        if event["type"] != "message" or "text" not in event["message"]:
-            continue
-        uid = event["source"]["userId"]
-        tk = event["replyToken"]
-        msg = event["message"]["text"].strip()
-        print(f"[RECV] uid={uid[-6:]}, msg={msg}, mode={chat_modes.get(uid)}")
+class ProfitLedger:
+    """每局一筆 (局數, 房間, 下注方, 單位, 開牌, 損益)，以 array 欄位儲存；
+    統計 (最大回撤、最長連輸、各房間小計) 在寫入時以 O(1) 更新"""
 
-        # 1. 基礎指令
-        if msg.upper() in ["UID", "查詢ID", "我的ID"]:
-            line_reply(tk, sys_bubble(f"📋 您的 UID：\n{uid}"))
-            continue
+    def __init__(self, unit):
+        self.unit = unit
+        self.rooms = []          # 房間名稱 (room 欄位存索引)
+        self._room_index = {}
+        self.room = array('H')
+        self.side = array('b')   # LEDGER_SIDES 索引，-1 = 非莊閒 (例如 "等待數據")
+        self.units = array('d')
+        self.result = array('b')
+        self.pnl = array('d')
+        self.total = 0.0
+        self.wins = self.losses = self.ties = 0
+        self.peak = 0.0
+        self.max_drawdown = 0.0
+        self.losing_run = 0
+        self.longest_losing_run = 0
+        self.by_room = {}        # room -> [局數, 損益, 贏, 輸]
 
-        if uid in ADMIN_UIDS and msg.startswith("產生序號"):
-            try:
-                _, duration, count = msg.split()
-                dur_key = duration.upper()
-                if dur_key not in VALID_DURATIONS:
-                    valid_list = "\n".join([f"  {k} = {v}" for k, v in VALID_DURATIONS.items()])
-                    line_reply(tk, sys_bubble(f"⚠️ 無效期限【{duration}】\n\n可用期限：\n{valid_list}\n\n格式：產生序號 [期限] [數量]"))
-                    continue
-                codes = []
-                with time_cards_data_lock:
-                    for _ in range(int(count)):
-                        code = "".join(random.choices("ABCDEFGHJKLMNPQRSTUVWXYZ23456789", k=10))
-                        time_cards_data["active_cards"][code] = {"duration": dur_key, "created_at": datetime.now(timezone.utc).isoformat()}
-                        codes.append(code)
-                    save_data(TIME_CARDS_FILE, time_cards_data)
-                line_reply(tk, [
-                    sys_bubble(f"✅ 已產生 {count} 組【{VALID_DURATIONS[dur_key]}】序號："),
-                    {"type": "text", "text": "\n".join(codes)}
-                ])
-            except:
-                line_reply(tk, sys_bubble("⚠️ 格式錯誤：產生序號 [期限] [數量]\n\n可用：10M / 1H / 2D / 7D / 12D / 30D"))
-            continue
+    COLUMNS = ("room", "side", "units", "result", "pnl")
+    STATS = ("total", "wins", "losses", "ties", "peak", "max_drawdown", "losing_run", "longest_losing_run")
 
-        if msg == "返回主選單":
-            chat_modes.pop(uid, None)
-            baccarat_history_dict.pop(uid, None)
-            profit_tracker.pop(uid, None)
-            send_main_menu(tk)
-            continue
+    def __len__(self):
+        return len(self.pnl)
 
-        if "清除數據" in msg and (":" in msg or "：" in msg):
-            room = msg.replace("：", ":").split(":")[-1].strip()
-            if uid in baccarat_history_dict and room in baccarat_history_dict[uid]:
-                baccarat_history_dict[uid][room] = []
-                baccarat_history_dict[uid].pop(f"{room}_total", None)
-            clear_msg = f"✅ {room} 牌路已清除"
-            if uid in profit_tracker:
-                clear_msg += "\n\n💰 獲利計算仍持續中\n請繼續輸入開牌結果"
-            line_reply(tk, text_with_back(clear_msg))
-            continue
+    def to_state(self):
+        """部署交接用：欄位存成 base64 原始 bytes，統計直接帶過去不重算"""
+        state = {"unit": self.unit, "rooms": self.rooms, "by_room": self.by_room,
+                 "stats": [getattr(self, name) for name in self.STATS]}
+        for name in self.COLUMNS:
+            state[name] = base64.b64encode(getattr(self, name).tobytes()).decode('ascii')
+        return state
 
-        # 2. 狀態機與功能入口
-        mode = chat_modes.get(uid)
-        status, left = get_access_status(uid)
-
-        # --- 電子預測 ---
-        if msg == "電子預測":
-            if status == "active":
-                chat_modes[uid] = "slot_choose_game"
-                line_reply(tk, sys_bubble("🎰 請選擇電子遊戲：", [
-                    {"type": "action", "action": {"type": "message", "label": "賽特1", "text": "選遊戲:賽特1"}},
-                    {"type": "action", "action": {"type": "message", "label": "賽特2", "text": "選遊戲:賽特2"}}
-                ]))
-            else:
-                line_reply(tk, sys_bubble("❌ 權限不足，請先儲值。"))
-            continue
+    @classmethod
+    def from_state(cls, state, swap=False):
+        """swap：快照來自位元組順序不同的機器時，把欄位轉回本機順序"""
+        ledger = cls(state["unit"])
+        ledger.rooms = list(state["rooms"])
+        ledger._room_index = {room: i for i, room in enumerate(ledger.rooms)}
+        ledger.by_room = {room: list(stat) for room, stat in state["by_room"].items()}
+        for name, value in zip(cls.STATS, state["stats"]):
+            setattr(ledger, name, value)
+        for name in cls.COLUMNS:
+            col = getattr(ledger, name)
+            col.frombytes(base64.b64decode(state[name]))
+            if swap:
+                col.byteswap()
+        return ledger
 
-        elif mode == "slot_choose_game" and msg.startswith("選遊戲:"):
-            game_name = msg.split(":")[-1]
-            chat_modes[uid] = {"state": "slot_choose_room", "game": game_name}
-            line_reply(tk, text_with_back(f"✅ 已選 {game_name}\n請輸入房號 (1~3000)：\n例如：888"))
-            continue
+    def record(self, room, side, units, result):
+        """寫入一局並回傳該局損益；和局退注，不中斷連輸"""
+        amount = self.unit * units
+        if result == "和":
+            pnl = 0
+            self.ties += 1
+        elif result == side:
+            pnl = amount * (BANKER_PAYOUT if side == "莊" else PLAYER_PAYOUT)
+            self.wins += 1
+            self.losing_run = 0
+        else:
+            pnl = -amount
+            self.losses += 1
+            self.losing_run += 1
+            if self.losing_run > self.longest_losing_run:
+                self.longest_losing_run = self.losing_run
+        self.total += pnl
+        if self.total > self.peak:
+            self.peak = self.total
+        elif self.peak - self.total > self.max_drawdown:
+            self.max_drawdown = self.peak - self.total
+        idx = self._room_index.get(room)
+        if idx is None:
+            idx = self._room_index[room] = len(self.rooms)
+            self.rooms.append(room)
+        self.room.append(idx)
+        self.side.append(LEDGER_SIDE_CODE.get(side, -1))
+        self.units.append(units)
+        self.result.append(LEDGER_SIDE_CODE.get(result, -1))
+        self.pnl.append(pnl)
+        stat = self.by_room.get(room)
+        if stat is None:
+            stat = self.by_room[room] = [0, 0.0, 0, 0]
+        stat[0] += 1
+        stat[1] += pnl
+        if pnl > 0:
+            stat[2] += 1
+        elif pnl < 0:
+            stat[3] += 1
+        return pnl
 
-        elif isinstance(mode, dict) and mode.get("state") == "slot_choose_room":
-            chat_modes[uid] = {"state": "slot_input_bet", "game": mode["game"], "room": msg}
-            line_reply(tk, text_with_back(f"✅ 已鎖定：{mode['game']} 房號 {msg}\n\n第一步：請輸入【今日總下注額】"))
-            continue
+    def rows(self, n=None):
+        """逐局產生 (局數, 房間, 下注, 單位, 開牌, 損益, 累計)；只讀前 n 筆，匯出時寫入也不受影響"""
+        n = len(self.pnl) if n is None else n
+        cum = 0.0
+        for i in range(n):
+            cum += self.pnl[i]
+            side, result = self.side[i], self.result[i]
+            yield (i + 1, self.rooms[self.room[i]], LEDGER_SIDES[side] if side >= 0 else "",
+                   self.units[i], LEDGER_SIDES[result] if result >= 0 else "", self.pnl[i], cum)
 
-        elif isinstance(mode, dict) and mode.get("state") == "slot_input_bet":
-            try:
-                bet = float(msg)
-                chat_modes[uid] = {"state": "slot_input_rate", "game": mode["game"], "room": mode["room"], "total_bet": bet}
-                line_reply(tk, text_with_back(f"💰 總下注額已設定：{bet:,.0f}\n\n第二步：請輸入【今日得分率】\n(例如：48)"))
-            except:
-                line_reply(tk, sys_bubble("⚠️ 格式錯誤，請輸入純數字下注額。"))
-            continue
+    def iter_csv(self):
+        n = len(self.pnl)
+        yield "\ufeffhand,room,side,units,result,pnl,cumulative\n"   # BOM：Excel 直接開啟不會亂碼
+        buf = []
+        for hand, room, side, units, result, pnl, cum in self.rows(n):
+            buf.append(f"{hand},{room.replace(',', ' ')},{side},{units:g},{result},{pnl:.2f},{cum:.2f}\n")
+            if len(buf) >= LEDGER_EXPORT_CHUNK:
+                yield "".join(buf)
+                buf = []
+        if buf:
+            yield "".join(buf)
 
-        elif isinstance(mode, dict) and mode.get("state") == "slot_input_rate":
-            try:
-                rate = float(msg)
-                total_bet = mode["total_bet"]
-                room_display = f"{mode['game']} 房號:{mode['room']}"
-                res = calculate_slot_logic(total_bet, rate)
-                line_reply(tk, build_slot_flex(room_display, res))
-                chat_modes[uid] = {"state": "slot_input_bet", "game": mode["game"], "room": mode["room"]}
-            except:
-                line_reply(tk, sys_bubble("⚠️ 格式錯誤，請輸入純數字得分率。"))
-            continue
+    def iter_jsonl(self):
+        n = len(self.pnl)
+        buf = []
+        for hand, room, side, units, result, pnl, cum in self.rows(n):
+            buf.append(json_dumps_bytes({"hand": hand, "room": room, "side": side, "units": units,
+                                         "result": result, "pnl": pnl, "cumulative": cum}))
+            if len(buf) >= LEDGER_EXPORT_CHUNK:
+                yield b"\n".join(buf) + b"\n"
+                buf = []
+        if buf:
+            yield b"\n".join(buf) + b"\n"
 
-        # --- 計算獲利 ---
-        if msg == "計算獲利":
-            if status == "active":
-                chat_modes[uid] = {"state": "profit_input_unit"}
-                line_reply(tk, text_with_back("💰 計算獲利模式\n\n請輸入您的【1單位金額】：\n(例如：100)\n\n設定後請進入百家預測，系統會自動根據AI建議注碼幫您計算每局損益"))
-            else:
-                line_reply(tk, sys_bubble("❌ 權限不足，請先儲值。"))
-            continue
+    def report_text(self):
+        decided = self.wins + self.losses
+        lines = [
+            "📊 獲利結算報表",
+            "=" * 20,
+            f"🎯 單位金額：{self.unit:,.0f}",
+            "=" * 20,
+            f"📈 總損益：{self.total:+,.0f}",
+            f"📉 最大回撤：{self.max_drawdown:,.0f}",
+            f"🔻 最長連輸：{self.longest_losing_run}局",
+            "=" * 20,
+            f"🎮 總局數：{len(self)}",
+            f"✅ 贏：{self.wins}局",
+            f"❌ 輸：{self.losses}局",
+            f"➖ 和：{self.ties}局",
+            f"📊 勝率：{(self.wins / max(decided, 1) * 100):.1f}%",
+        ]
+        if len(self.by_room) > 1:
+            lines.append("=" * 20)
+            top = sorted(self.by_room.items(), key=lambda kv: -kv[1][0])[:5]
+            lines.extend(f"🏠 {room}：{st[0]}局 {st[1]:+,.0f} ({st[2]}W{st[3]}L)" for room, st in top)
+            if len(self.by_room) > 5:
+                lines.append(f"… 其餘 {len(self.by_room) - 5} 個房間請見明細")
+        return "\n".join(lines) + "\n"
 
-        elif isinstance(mode, dict) and mode.get("state") == "profit_input_unit":
-            try:
-                unit = float(msg)
-                if unit <= 0:
-                    raise ValueError
-                profit_tracker[uid] = {
-                    "unit": unit, "total_profit": 0, "rounds": 0,
-                    "wins": 0, "losses": 0, "last_prediction": None
-                }
-                chat_modes.pop(uid, None)
-                line_reply(tk, sys_bubble(
-                    f"✅ 獲利計算已啟動\n\n"
-                    f"🎯 1單位金額：{unit:,.0f}\n\n"
-                    f"請選擇遊戲館開始遊戲\n"
-                    f"每局開牌後系統會自動計算損益\n\n"
-                    f"輸入【結算】可查看完整報表\n"
-                    f"輸入【關閉獲利】停止計算",
-                    [
-                        {"type": "action", "action": {"type": "message", "label": "百家預測", "text": "百家預測"}},
-                        {"type": "action", "action": {"type": "message", "label": "電子預測", "text": "電子預測"}},
-                        {"type": "action", "action": {"type": "message", "label": "↩ 返回主選單", "text": "返回主選單"}}
-                    ]
-                ))
-            except:
-                line_reply(tk, sys_bubble("⚠️ 請輸入正確的數字金額"))
-            continue
+def ledger_export_links(uid, settled_at=None):
+    """連結綁定特定帳本：s<結算時間> 為該次結算的帳本，a 為進行中的帳本；之後重新開始追蹤或再結算都不會換成別本"""
+    kind = f"s{settled_at}" if settled_at is not None else "a"
+    return sign_export(f"{uid}.{kind}.csv", route="ledger"), sign_export(f"{uid}.{kind}.jsonl", route="ledger")
 
-        if msg == "結算" and uid in profit_tracker:
-            pt = profit_tracker[uid]
-            rpt = (
-                f"📊 獲利結算報表\n"
-                f"{'='*20}\n"
-                f"🎯 單位金額：{pt['unit']:,.0f}\n"
-                f"{'='*20}\n"
-                f"📈 總損益：{pt['total_profit']:+,.0f}\n"
-                f"{'='*20}\n"
-                f"🎮 總局數：{pt['rounds']}\n"
-                f"✅ 贏：{pt['wins']}局\n"
-                f"❌ 輸：{pt['losses']}局\n"
-                f"➖ 和：{pt['rounds'] - pt['wins'] - pt['losses']}局\n"
-                f"📊 勝率：{(pt['wins']/max(pt['wins']+pt['losses'],1)*100):.1f}%\n"
-            )
-            profit_tracker.pop(uid, None)
-            line_reply(tk, sys_bubble(rpt))
-            continue
+def remember_settled_ledger(uid, ledger, now=None):
+    now = int(time.time()) if now is None else now
+    settled_ledgers.pop(uid, None)
+    settled_ledgers[uid] = (now, ledger)
+    while settled_ledgers:
+        oldest_uid, (at, _) = next(iter(settled_ledgers.items()))
+        if at > now - EXPORT_LINK_TTL_SEC and len(settled_ledgers) <= SETTLED_LEDGERS_MAX:
+            break
+        del settled_ledgers[oldest_uid]
+    return now
 
-        if msg == "關閉獲利" and uid in profit_tracker:
-            profit_tracker.pop(uid, None)
-            line_reply(tk, sys_bubble("✅ 獲利計算已關閉"))
-            continue
+def find_export_ledger(uid, kind):
+    if kind == "a":
+        pt = profit_tracker.get(uid)
+        return pt["ledger"] if pt else None
+    settled = settled_ledgers.get(uid)
+    if settled is not None and kind == f"s{settled[0]}":
+        return settled[1]
+    return None
 
-        # --- 百家預測 ---
-        if msg == "百家預測":
-            if status == "active":
-                chat_modes[uid] = "choose_provider"
-                BASE_URL = "https://bc-line-kmh9.onrender.com"
-                provider_flex = {
-                    "type": "flex", "altText": "請選擇平台",
-                    "contents": {
-                        "type": "bubble", "size": "mega",
-                        "header": {"type": "box", "layout": "vertical", "backgroundColor": "#1A5276", "paddingAll": "md", "contents": [
-                            {"type": "text", "text": "🎲 請選擇遊戲平台", "color": "#ffffff", "weight": "bold", "size": "lg", "align": "center"},
-                            {"type": "text", "text": f"🔑 授權剩餘：{left}", "color": "#AED6F1", "size": "xs", "align": "center", "margin": "xs"}
-                        ]},
-                        "body": {"type": "box", "layout": "horizontal", "spacing": "lg", "paddingAll": "lg", "contents": [
-                            {"type": "box", "layout": "vertical", "flex": 1, "cornerRadius": "lg", "backgroundColor": "#F8F9FA", "paddingAll": "md", "contents": [
-                                {"type": "image", "url": f"{BASE_URL}/static/MT.jpg", "size": "full", "aspectRatio": "1:1", "aspectMode": "cover"},
-                                {"type": "text", "text": "MT真人", "weight": "bold", "size": "md", "align": "center", "margin": "sm", "color": "#2C3E50"},
-                            ], "action": {"type": "message", "label": "MT真人", "text": "平台:MT"}},
-                            {"type": "box", "layout": "vertical", "flex": 1, "cornerRadius": "lg", "backgroundColor": "#F8F9FA", "paddingAll": "md", "contents": [
-                                {"type": "image", "url": f"{BASE_URL}/static/DG.jpg", "size": "full", "aspectRatio": "1:1", "aspectMode": "cover"},
-                                {"type": "text", "text": "DG真人", "weight": "bold", "size": "md", "align": "center", "margin": "sm", "color": "#2C3E50"},
-                            ], "action": {"type": "message", "label": "DG真人", "text": "平台:DG"}}
-                        ]},
-                        "footer": {"type": "box", "layout": "vertical", "contents": [
-                            {"type": "button", "action": {"type": "message", "label": "↩ 返回主選單", "text": "返回主選單"}, "style": "primary", "color": "#1A5276", "height": "sm"}
-                        ]}
-                    }
-                }
-                line_reply(tk, provider_flex)
-            else:
-                line_reply(tk, sys_bubble("❌ 權限已過期或未開通。"))
-            continue
+# ==================== 房間統計 (管理員總覽) ====================
+class RoomStats:
+    """單一房間跨所有用戶的累計統計；每筆開牌結果 O(1) 更新，總覽不必掃描 baccarat_history_dict"""
 
-        elif mode == "choose_provider" and msg.startswith("平台:"):
-            p_name = "MT真人" if "MT" in msg else "DG真人"
-            if "MT" in msg:
-                chat_modes[uid] = {"state": "mt_choose_category", "p": p_name}
-                BASE_URL = "https://bc-line-kmh9.onrender.com"
-                cat_flex = {
-                    "type": "flex", "altText": "MT真人 - 選擇遊戲廳",
-                    "contents": {
-                        "type": "bubble", "size": "mega",
-                        "header": {"type": "box", "layout": "vertical", "backgroundColor": "#1A5276", "paddingAll": "md", "contents": [
-                            {"type": "box", "layout": "horizontal", "contents": [
-                                {"type": "image", "url": f"{BASE_URL}/static/MT.jpg", "size": "xxs", "aspectRatio": "1:1", "aspectMode": "cover", "flex": 0},
-                                {"type": "box", "layout": "vertical", "flex": 4, "paddingStart": "md", "contents": [
-                                    {"type": "text", "text": "MT真人", "color": "#ffffff", "weight": "bold", "size": "lg"},
-                                    {"type": "text", "text": "請選擇遊戲廳", "color": "#AED6F1", "size": "xs"}
-                                ]}
-                            ]}
-                        ]},
-                        "body": {"type": "box", "layout": "vertical", "spacing": "sm", "paddingAll": "lg", "contents": [
-                            {"type": "button", "action": {"type": "message", "label": "🎲 百家樂 - 亞洲廳", "text": "MT廳:亞洲廳"}, "style": "primary", "color": "#2E86C1", "height": "sm"},
-                            {"type": "button", "action": {"type": "message", "label": "🎲 百家樂 - 國際廳（敬請期待）", "text": "MT廳:國際廳"}, "style": "secondary", "height": "sm"},
-                            {"type": "button", "action": {"type": "message", "label": "↩ 返回主選單", "text": "返回主選單"}, "style": "secondary", "height": "sm"}
-                        ]}
-                    }
-                }
-                line_reply(tk, cat_flex)
-            else:
-                chat_modes[uid] = {"state": "dg_choose_category", "p": p_name}
-                BASE_URL = "https://bc-line-kmh9.onrender.com"
-                dg_flex = {
-                    "type": "flex", "altText": "DG真人 - 選擇遊戲廳",
-                    "contents": {
-                        "type": "bubble", "size": "mega",
-                        "header": {"type": "box", "layout": "vertical", "backgroundColor": "#1A5276", "paddingAll": "md", "contents": [
-                            {"type": "box", "layout": "horizontal", "contents": [
-                                {"type": "image", "url": f"{BASE_URL}/static/DG.jpg", "size": "xxs", "aspectRatio": "1:1", "aspectMode": "cover", "flex": 0},
-                                {"type": "box", "layout": "vertical", "flex": 4, "paddingStart": "md", "contents": [
-                                    {"type": "text", "text": "DG真人", "color": "#ffffff", "weight": "bold", "size": "lg"},
-                                    {"type": "text", "text": "請選擇遊戲廳", "color": "#AED6F1", "size": "xs"}
-                                ]}
-                            ]}
-                        ]},
-                        "body": {"type": "box", "layout": "vertical", "spacing": "sm", "paddingAll": "lg", "contents": [
-                            {"type": "button", "action": {"type": "message", "label": "🎲 百家樂", "text": "DG廳:百家樂"}, "style": "primary", "color": "#2E86C1", "height": "sm"},
-                            {"type": "button", "action": {"type": "message", "label": "💃 性感百家樂", "text": "DG廳:性感百家樂"}, "style": "primary", "color": "#8E44AD", "height": "sm"},
-                            {"type": "button", "action": {"type": "message", "label": "↩ 返回主選單", "text": "返回主選單"}, "style": "secondary", "height": "sm"}
-                        ]}
-                    }
-                }
-                line_reply(tk, dg_flex)
-            continue
+    def __init__(self):
+        self.hands = 0
+        self.counts = {"莊": 0, "閒": 0, "和": 0}
+        self.reporters = OrderedDict()   # uid -> 最後回報時間，依時間排序；超過 ROOM_REPORTER_WINDOW_SEC 的從前面丟掉
+        self.streak_side = ""
+        self.streak_len = 0
+        self.prediction = None     # 最近一次 AI 預測 {"side", "confidence", "units", "ts"}
+        self.hits = deque(maxlen=ROOM_HIT_WINDOW)
+        self.hit_count = 0
+        self.updated_at = 0
 
-        elif isinstance(mode, dict) and mode.get("state") == "dg_choose_category" and msg.startswith("DG廳:"):
-            category = msg.replace("DG廳:", "")
-            chat_modes[uid] = {"state": "choose_room", "p": "DG真人", "cat": category}
+    def record_results(self, uid, history, new_data, pred_side):
+        """history 已包含 new_data；pred_side 為該用戶上一張卡的預測 (只評第一筆非和局結果)"""
+        for actual in new_data:
+            self.counts[actual] = self.counts.get(actual, 0) + 1
+            if pred_side in ("莊", "閒") and actual != "和":
+                if len(self.hits) == self.hits.maxlen:
+                    self.hit_count -= self.hits[0]
+                hit = 1 if actual == pred_side else 0
+                self.hits.append(hit)
+                self.hit_count += hit
+                pred_side = None
+        self.hands += len(new_data)
+        now = time.time()
+        reporters = self.reporters
+        reporters[uid] = now
+        reporters.move_to_end(uid)
+        while next(iter(reporters.values())) < now - ROOM_REPORTER_WINDOW_SEC:
+            reporters.popitem(last=False)
+        # 連莊/連閒以最近回報的牌路為準 (和局不中斷)，最多回看一條牌路的長度
+        side, n = "", 0
+        for h in reversed(history):
+            if h == "和":
+                continue
+            if side and h != side:
+                break
+            side, n = h, n + 1
+        self.streak_side, self.streak_len = side, n
+        self.updated_at = int(now)
 
-            if category == "百家樂":
-                line_reply(tk, text_with_back("🎲 DG真人 - 百家樂\n\n請輸入房號：RB01~RB07"))
-            elif category == "性感百家樂":
-                line_reply(tk, text_with_back("💃 DG真人 - 性感百家樂\n\n請輸入房號：S01~S07"))
-            else:
-                line_reply(tk, text_with_back("⚠️ 未知遊戲廳"))
-            continue
+    def recent_reporters(self, now=None):
+        """最近 ROOM_REPORTER_WINDOW_SEC 內回報過的人數 (只讀取，不修改；總覽可能不在 session_lock 內呼叫)"""
+        cutoff = (time.time() if now is None else now) - ROOM_REPORTER_WINDOW_SEC
+        return sum(1 for ts in list(self.reporters.values()) if ts >= cutoff)
 
-        elif isinstance(mode, dict) and mode.get("state") == "mt_choose_category" and msg.startswith("MT廳:"):
-            category = msg.replace("MT廳:", "")
-            chat_modes[uid] = {"state": "choose_room", "p": "MT真人"}
+    def snapshot(self, room):
+        pred = self.prediction or {}
+        return {
+            "room": room, "hands": self.hands, "banker": self.counts["莊"], "player": self.counts["閒"],
+            "tie": self.counts["和"], "reporters": self.recent_reporters(),
+            "streak": {"side": self.streak_side, "length": self.streak_len},
+            "prediction": pred.get("side"), "confidence": pred.get("confidence"),
+            "hit_rate": round(self.hit_count / len(self.hits) * 100, 1) if self.hits else None,
+            "hit_samples": len(self.hits), "updated_at": self.updated_at,
+        }
 
-            # ── 房間選擇 ──
-            if category == "亞洲廳":
-                line_reply(tk, text_with_back(f"🎲 MT真人 - 亞洲廳\n\n請輸入房號：\n百家樂1~百家樂13、百家樂3A"))
-            elif category == "國際廳":
-                line_reply(tk, text_with_back("🚧 國際廳即將開放，敬請期待！"))
-            else:
-                line_reply(tk, text_with_back("⚠️ 未知遊戲廳"))
+room_stats = {}         # room -> RoomStats
+room_predictions = {}   # uid -> (room, 預測方)，下一筆結果進來時評分
+
+def record_room_results(uid, room, history, new_data):
+    stats = room_stats.get(room)
+    if stats is None:
+        stats = room_stats[room] = RoomStats()
+    pred_room, pred_side = room_predictions.pop(uid, (None, None))
+    stats.record_results(uid, history, new_data, pred_side if pred_room == room else None)
+
+def remember_prediction(uid, room, pt, res):
+    """分析卡送出後記錄 AI 預測：損益計算與房間命中率共用"""
+    if not res:
+        return
+    if pt is not None:
+        pt["last_prediction"] = res
+    side = res.get("下注")
+    if side in ("莊", "閒"):
+        room_predictions[uid] = (room, side)
+        stats = room_stats.get(room)
+        if stats is not None:
+            stats.prediction = {"side": side, "confidence": res.get("勝率"), "units": res.get("注碼單位"), "ts": int(time.time())}
+
+def room_dashboard():
+    """固定房間 (MT / DG) 在前，其餘有資料的房間在後"""
+    rooms = MT_ROOMS + DG_ROOMS
+    rooms += sorted(r for r in list(room_stats) if r not in rooms)
+    empty = RoomStats()
+    return [room_stats.get(r, empty).snapshot(r) for r in rooms]
+
+def build_room_dashboard_flex(rows):
+    def cell(text, flex, color="#2C3E50", align="center", weight="regular"):
+        return {"type": "text", "text": str(text), "size": "xxs", "flex": flex, "color": color, "align": align, "weight": weight}
+    header = {"type": "box", "layout": "horizontal", "contents": [
+        cell("房間", 4, "#888888", "start"), cell("局數", 2, "#888888"), cell("莊/閒/和", 4, "#888888"),
+        cell("連", 2, "#888888"), cell("預測", 2, "#888888"), cell("命中", 2, "#888888")]}
+    lines = [header, {"type": "separator", "margin": "xs"}]
+    total = 0
+    for r in rows:
+        total += r["hands"]
+        if not r["hands"]:
             continue
+        streak = f"{r['streak']['side']}{r['streak']['length']}" if r["streak"]["length"] else "-"
+        pred_color = "#C0392B" if r["prediction"] == "莊" else "#2471A3" if r["prediction"] == "閒" else "#888888"
+        hit = f"{r['hit_rate']:.0f}%" if r["hit_rate"] is not None else "-"
+        lines.append({"type": "box", "layout": "horizontal", "margin": "xs", "contents": [
+            cell(r["room"], 4, align="start", weight="bold"), cell(r["hands"], 2),
+            cell(f"{r['banker']}/{r['player']}/{r['tie']}", 4), cell(streak, 2),
+            cell(r["prediction"] or "-", 2, pred_color), cell(hit, 2)]})
+    if len(lines) == 2:
+        lines.append(cell("尚無開牌資料", 1, "#888888"))
+    return {
+        "type": "flex", "altText": "📊 房間總覽",
+        "contents": {
+            "type": "bubble", "size": "giga",
+            "header": {"type": "box", "layout": "vertical", "backgroundColor": "#1A5276", "paddingAll": "sm", "contents": [
+                {"type": "text", "text": f"📊 房間總覽 (共 {total:,} 局)", "color": "#ffffff", "weight": "bold", "size": "sm", "align": "center"}]},
+            "body": {"type": "box", "layout": "vertical", "paddingAll": "md", "contents": lines}
+        }
+    }
 
-        elif isinstance(mode, dict) and mode.get("state") == "choose_room":
-            room_name = msg.replace("房號:", "").strip()
-            if mode.get("p") == "MT真人":
-                # Normalize: add space after 百家樂 if missing
-                rn = room_name
-                if rn.startswith("百家樂") and len(rn) > 3 and rn[3] != " ":
-                    rn = "百家樂 " + rn[3:]
-                room_name = rn
-                mt_valid = [f"百家樂 {i}" for i in range(1, 14)] + ["百家樂 3A"]
-                if room_name not in mt_valid:
-                    line_reply(tk, text_with_back("⚠️ MT真人房號格式錯誤\n\n百家樂：百家樂1~百家樂13、百家樂3A"))
-                    continue
+# ==================== 開牌結果：限流與合併 ====================
+RESULT_CODE_MAP = {"1": "閒", "2": "莊", "3": "和"}
+
+def parse_results(msg):
+    return [RESULT_CODE_MAP[c] for c in msg if c in RESULT_CODE_MAP]
+
+def is_result_only(msg):
+    """訊息是否只含開牌結果 (可直接併入等待中的批次)"""
+    return bool(parse_results(msg)) and all(c in RESULT_CODE_MAP or c in " ,，" for c in msg)
+
+class TokenBucket:
+    """單一用戶的令牌桶：有令牌才立即渲染，沒有就進合併視窗"""
+
+    def __init__(self, capacity=RESULT_BUCKET_CAPACITY, rate=RESULT_BUCKET_RATE):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+result_buckets = {}   # uid -> TokenBucket
+pending_results = {}  # uid -> {"room", "tk", "data", "batches", "timer"}；batches 為各則訊息的結果 (依序)
+deferred_results = {}  # uid -> [(tk, room, data, batches)]：上一張卡還在行程池渲染時收到的結果，等它回覆後依序處理
+class SessionLock:
+    """可重入的狀態鎖。持有期間送往 LINE 的請求先排在本執行緒的佇列，最外層釋放鎖之後才依序送出：
+    同步模式 (_post_line_sync) 的 HTTPS 往返不在鎖內進行，其他用戶的事件不必排在網路後面"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+        return True
+
+    def release(self):
+        self._local.depth -= 1
+        outbox = None
+        if self._local.depth == 0:
+            outbox, self._local.outbox = getattr(self._local, "outbox", None), None
+        self._lock.release()
+        for args in outbox or ():
+            try:
+                _send_line_now(*args)
+            except Exception as e:
+                print(f"[LINE] deferred send failed: {e}")
+
+    def defer(self, args):
+        """本執行緒持有鎖時把請求排進佇列並回傳 True；未持有時回傳 False (呼叫端直接送出)"""
+        if getattr(self._local, "depth", 0) == 0:
+            return False
+        outbox = getattr(self._local, "outbox", None)
+        if outbox is None:
+            outbox = self._local.outbox = []
+        outbox.append(args)
+        metrics_inc("line_sends_deferred")
+        return True
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+# 事件處理與合併視窗計時器共用，避免同一用戶的狀態被兩條執行緒同時修改
+session_lock = SessionLock()
+
+def submit_results(uid, tk, room, new_data):
+    """開牌結果入口：令牌足夠就立即處理，否則在合併視窗內累積"""
+    ack_tk = None
+    with session_lock:
+        pending = pending_results.get(uid)
+        if pending and pending["room"] != room:
+            flush_pending_results(uid)
+            pending = None
+        if pending:
+            # 併入批次：較早的 reply token 只回輕量確認，卡片用最後一個 token
+            ack_tk = pending["tk"]
+            pending["tk"] = tk
+            pending["data"].extend(new_data)
+            pending["batches"].append(list(new_data))
+            metrics_inc("results_coalesced")
+        else:
+            bucket = result_buckets.get(uid)
+            if bucket is None:
+                bucket = result_buckets[uid] = TokenBucket()
+            if COALESCE_WINDOW_SEC <= 0 or bucket.take():
+                process_results(uid, tk, room, new_data)
+                return
+            timer = threading.Timer(COALESCE_WINDOW_SEC, flush_pending_results, args=(uid,))
+            timer.daemon = True
+            pending_results[uid] = {"room": room, "tk": tk, "data": list(new_data), "batches": [list(new_data)],
+                                    "timer": timer}
+            metrics_inc("results_rate_limited")
+            timer.start()
+    if ack_tk:
+        line_reply(ack_tk, {"type": "text", "text": "✅ 已收到，與後續結果合併分析"}, quick_reply=False)
+
+def flush_pending_results(uid):
+    """合併視窗到期 (或用戶送出其他指令) 時，一次寫入並渲染整批結果"""
+    with session_lock:
+        pending = pending_results.pop(uid, None)
+        if not pending:
+            return
+        pending["timer"].cancel()
+        metrics_inc("results_batches_flushed")
+        process_results(uid, pending["tk"], pending["room"], pending["data"], pending["batches"])
+
+def _record_results(uid, room, history, room_totals, pt, new_data):
+    """寫入一則訊息的開牌結果：先以上一輪 AI 預測計算損益，再寫入牌路、房間統計與總數"""
+    # --- 獲利計算：用上一輪AI預測 vs 本輪實際結果 ---
+    if pt:
+        ledger = pt["ledger"]
+        for actual in new_data:
+            last_pred = pt.get("last_prediction")
+            if last_pred:
+                bet_side = last_pred["下注"]
+                # 注碼單位由 AI 直接給數字；沒有 (例如數據不足) 時以 1 單位計
+                units = last_pred.get("注碼單位", 1)
+                bet_amount = pt["unit"] * units
+                profit = ledger.record(room, bet_side, units, actual)
+                rounds = len(ledger)
+                if actual == "和":
+                    round_text = f"第{rounds}局：AI下{bet_side} {bet_amount:,.0f} → 開{actual} ➖ 和局(退注)"
+                elif profit > 0:
+                    round_text = f"第{rounds}局：AI下{bet_side} {bet_amount:,.0f} → 開{actual} ✅ +{profit:,.0f}"
+                else:
+                    round_text = f"第{rounds}局：AI下{bet_side} {bet_amount:,.0f} → 開{actual} ❌ {profit:,.0f}"
+                pt["round_text"] = round_text
+                pt["round_profit"] = profit
+
+    history.extend(new_data)
+    record_room_results(uid, room, history, new_data)
+    for d in new_data:
+        if d in room_totals:
+            room_totals[d] += 1
+    if len(history) > SHOE_MAX_HANDS:
+        history.trim(SHOE_MAX_HANDS)
+
+def process_results(uid, tk, room, new_data, batches=None):
+    """把一批開牌結果寫入牌路、計算損益並回覆分析卡
+
+    batches 為合併視窗內各則訊息的結果 (依序，合計即 new_data)。沒有合併時每則訊息都會回一張卡、
+    帶出新的 AI 預測，因此每則之間以當時的牌路重算 AI 預測，損益與房間命中率都與沒有合併時相同
+    """
+    # 上一張卡還在行程池渲染時先排著，等它回覆 (_finish_analysis) 後再處理，損益才會用到最新的 AI 預測；
+    # 呼叫端持有 session_lock，不能在這裡等行程池
+    if analysis_in_flight(uid):
+        deferred_results.setdefault(uid, []).append((tk, room, list(new_data), batches))
+        metrics_inc("results_deferred")
+        return
+    rooms = baccarat_history_dict.setdefault(uid, {})
+    history = rooms.get(room)
+    if history is None:
+        history = rooms[room] = ShoeHistory()
+    spec_sec = score_speculation(uid, room, history, new_data)
+    profit_info = None
+    pt = profit_tracker.get(uid)
+    room_totals = rooms.setdefault(f"{room}_total", {"莊": 0, "閒": 0, "和": 0})
+    for i, batch in enumerate(batches or [new_data]):
+        if i:
+            remember_prediction(uid, room, pt, analysis_core(history, room_totals)["res"])
+            metrics_inc("results_coalesced_predictions")
+        _record_results(uid, room, history, room_totals, pt, batch)
+
+    # Build profit_info for display
+    if pt:
+        ledger = pt["ledger"]
+        profit_info = {
+            "total_profit": ledger.total,
+            "rounds": len(ledger),
+            "wins": ledger.wins,
+            "losses": ledger.losses,
+            "round_profit": pt.get("round_profit", 0)
+        }
+        if "round_text" in pt:
+            profit_info["round_text"] = pt["round_text"]
+
+    tier = load_governor.tier
+    metrics_inc(f"render_tier_{min(tier, 3)}")
+    if tier >= 3:
+        # 過載：只算 AI 預測，回純文字卡
+        card, res = build_fallback_card(room, history, room_totals)
+        line_reply(tk, card)
+        remember_prediction(uid, room, pt, res)
+        return
+    # 預先渲染命中時分析已在快取，直接在這裡組卡比送進行程池快
+    if analysis_pool is not None and spec_sec is None:
+        submit_analysis(uid, tk, room, history, room_totals, profit_info, pt, tier)
+        if tier == 0:
+            schedule_speculation(uid, room, history, room_totals)
+        return
+    try:
+        ai_out = {}
+        t0 = time.perf_counter()
+        flex_msg = build_analysis_flex(room, history, room_totals, profit_info, _out_res=ai_out, tier=tier)
+        if spec_sec is not None:
+            served = time.perf_counter() - t0
+            metrics_inc("speculation_served_us_total", int(served * 1e6))
+            metrics_inc("speculation_saved_us_total", int(max(spec_sec - served, 0) * 1e6))
+        print("[DEBUG] flex built OK")
+        line_reply(tk, flex_msg)
+        # Store current AI prediction for next round's profit calculation
+        remember_prediction(uid, room, pt, ai_out)
+        if tier == 0:
+            schedule_speculation(uid, room, history, room_totals, ai_out.get("下注"))
+    except Exception as e:
+        print(f"[DEBUG] build_analysis_flex ERROR: {e}")
+        traceback.print_exc()
+        line_reply(tk, sys_bubble(f"⚠️ 分析錯誤：{str(e)[:100]}"))
+
+# ==================== 分析卡行程池 ====================
+HIST_ENCODE = {"閒": "P", "莊": "B", "和": "T"}
+HIST_DECODE = {v: k for k, v in HIST_ENCODE.items()}
+
+analysis_pool = None          # ProcessPoolExecutor，ANALYSIS_PROCESSES > 0 時建立
+analysis_reply_pool = None    # 完成後送出回覆用的執行緒 (不佔用行程池的管理執行緒)
+analysis_jobs = {}            # uid -> 最近一個渲染工作
+_analysis_inflight = 0
+_analysis_lock = threading.Lock()
+
+def render_analysis_job(room, hist, totals, profit_info, submitted_at, tier=0):
+    """在子行程執行：精簡牌路字串 → 完整分析卡 JSON bytes (含 quickReply)"""
+    started = time.time()
+    res = {}
+    flex = build_analysis_flex(room, ShoeHistory.decode(hist), totals, profit_info, _out_res=res, tier=tier)
+    flex = dict(flex, quickReply=MENU_QUICK_REPLY)
+    data = json_dumps_bytes(flex)
+    return data, res, started - submitted_at, time.time() - started
+
+def build_fallback_card(room, history, total_counts):
+    """逾時或排隊已滿時的精簡卡：只算 AI 預測，不畫牌路"""
+    res = baccarat_ai_logic(as_shoe(history).tail(AI_WINDOW_HANDS), total_counts=total_counts)
+    text = (f"⚡ {room} 快速預測\n\n🎯 預測：{res['下注']}\n信心：{res['勝率']}%｜注碼：{res['建議注碼']}\n\n"
+            f"(完整牌路分析忙碌中，稍後會自動恢復)")
+    return sys_bubble(text, MENU_QUICK_ITEMS), res
+
+def start_analysis_pool():
+    """必須在其他背景執行緒啟動前呼叫：fork 出的子行程才不會繼承被鎖住的鎖"""
+    global analysis_pool, analysis_reply_pool
+    if ANALYSIS_PROCESSES <= 0 or analysis_pool is not None:
+        return
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    ctx = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    analysis_pool = ProcessPoolExecutor(max_workers=ANALYSIS_PROCESSES, mp_context=ctx)
+    # 用內建函式暖機：此時 sv94 可能還在匯入中，pickle 本模組的函式會卡在匯入鎖
+    analysis_pool.submit(os.getpid).result()
+    analysis_reply_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="analysis-reply")
+    print(f"[ANALYSIS] process pool ready: {ANALYSIS_PROCESSES} worker(s)", flush=True)
+
+def _finish_analysis(job, payload=None, res=None, fallback_reason=None):
+    """同一個工作只會回覆一次：結果與逾時誰先到就用誰"""
+    global _analysis_inflight
+    with job["lock"]:
+        if job["done"]:
+            return
+        job["done"] = True
+    with _analysis_lock:
+        _analysis_inflight -= 1
+    try:
+        if payload is not None:
+            line_reply_raw(job["tk"], [payload])
+        else:
+            metrics_inc("analysis_fallback_" + fallback_reason)
+            card, res = build_fallback_card(job["room"], job["history"], job["totals"])
+            line_reply(job["tk"], card)
+        remember_prediction(job["uid"], job["room"], job["pt"], res)
+    finally:
+        job["event"].set()
+        resume_deferred_results(job["uid"])
+
+def _on_analysis_done(job, fut):
+    try:
+        payload, res, queue_wait, compute = fut.result()
+    except Exception as e:
+        print(f"[ANALYSIS] render failed: {e}")
+        _finish_analysis(job, fallback_reason="error")
+        return
+    metrics_inc("analysis_rendered")
+    metrics_inc("analysis_queue_wait_ms_total", int(queue_wait * 1000))
+    metrics_inc("analysis_compute_ms_total", int(compute * 1000))
+    with metrics_lock:
+        metrics["analysis_queue_wait_ms_max"] = max(metrics["analysis_queue_wait_ms_max"], int(queue_wait * 1000))
+        metrics["analysis_compute_ms_max"] = max(metrics["analysis_compute_ms_max"], int(compute * 1000))
+    _finish_analysis(job, payload, res)
+
+def submit_analysis(uid, tk, room, history, totals, profit_info, pt, tier=0):
+    """把渲染交給行程池，完成或逾時後由回呼送出回覆 (呼叫端不等待)"""
+    global _analysis_inflight
+    job = {"uid": uid, "tk": tk, "room": room, "history": list(history), "totals": dict(totals), "pt": pt,
+           "done": False, "lock": threading.Lock(), "event": threading.Event()}
+    analysis_jobs[uid] = job
+    with _analysis_lock:
+        full = _analysis_inflight >= ANALYSIS_QUEUE_MAX
+        if not full:
+            _analysis_inflight += 1
+    if full:
+        job["done"] = True
+        metrics_inc("analysis_fallback_queue_full")
+        card, res = build_fallback_card(room, history, totals)
+        line_reply(tk, card)
+        remember_prediction(uid, room, pt, res)
+        job["event"].set()
+        return
+    hist = as_shoe(history).encode()
+    fut = analysis_pool.submit(render_analysis_job, room, hist, dict(totals), profit_info, time.time(), tier)
+    timer = threading.Timer(ANALYSIS_TIMEOUT_SEC, _finish_analysis, args=(job,), kwargs={"fallback_reason": "timeout"})
+    timer.daemon = True
+    timer.start()
+    fut.add_done_callback(lambda f: (timer.cancel(), analysis_reply_pool.submit(_on_analysis_done, job, f)))
+
+def analysis_in_flight(uid):
+    job = analysis_jobs.get(uid)
+    return job is not None and not job["event"].is_set()
+
+def resume_deferred_results(uid):
+    """上一張卡回覆後處理排著的結果；其中一批又送進行程池時，其餘的會再排回去"""
+    with session_lock:
+        for tk, room, data, batches in deferred_results.pop(uid, ()):
+            process_results(uid, tk, room, data, batches)
+
+def wait_analysis(uid, timeout=ANALYSIS_TIMEOUT_SEC + 1):
+    """只能在未持有 session_lock 時呼叫"""
+    job = analysis_jobs.get(uid)
+    if job is not None and not job["event"].is_set():
+        job["event"].wait(timeout)
+
+# ==================== 預先渲染 (下一局) ====================
+speculation_queue = OrderedDict()   # uid -> 待算的工作；同一用戶只留最新一筆 (舊的視為取消)
+speculation_done = OrderedDict()    # uid -> 已算好的 {"room", "shoe", "n", "sides": {結果: 秒}}，下一筆結果進來時評分
+speculation_cond = threading.Condition()
+SPECULATE_SIDES = ("莊", "閒", "和")
+SPECULATE_IDLE_POLL_SEC = 0.02
+
+def schedule_speculation(uid, room, history, totals, pred_side=None):
+    """分析卡送出後呼叫 (持有 session_lock)：排入下一局三種結果的預先渲染；AI 預測的那一方最可能，先算"""
+    if not SPECULATE:
+        return
+    job = {"uid": uid, "room": room, "shoe": history, "n": len(history), "runs": bytes(history.runs),
+           "totals": dict(totals), "order": sorted(SPECULATE_SIDES, key=lambda side: side != pred_side)}
+    with speculation_cond:
+        if speculation_queue.pop(uid, None) is not None:
+            metrics_inc("speculation_cancelled")
+        speculation_queue[uid] = job
+        while len(speculation_queue) > SPECULATE_QUEUE_MAX:
+            speculation_queue.popitem(last=False)
+            metrics_inc("speculation_dropped")
+        speculation_cond.notify()
+
+def _speculation_stale(job):
+    """用戶已經送出新結果 (或清除了這個房間的牌路)，這份預先渲染用不到了"""
+    return len(job["shoe"]) != job["n"] or baccarat_history_dict.get(job["uid"], {}).get(job["room"]) is not job["shoe"]
+
+def _system_idle():
+    return load_governor.pending == 0 and load_governor.tier == 0
+
+def speculate(job):
+    """依序算出三種結果的分析卡 (寫進分析快取 / 牌路圖片快取)；系統忙時等待，超過預算或已過時就停"""
+    sides, spent = {}, 0.0
+    for side in job["order"]:
+        while not _system_idle() and not _speculation_stale(job):
+            time.sleep(SPECULATE_IDLE_POLL_SEC)
+        if _speculation_stale(job):
+            metrics_inc("speculation_cancelled")
+            break
+        if spent * 1000 >= SPECULATE_BUDGET_MS:
+            metrics_inc("speculation_over_budget")
+            break
+        shoe = ShoeHistory.from_runs(job["runs"])
+        shoe.append(side)
+        # 與 _record_results 相同：超過上限先丟最舊的，快取的鍵才會與真正寫入後的牌路一致
+        if len(shoe) > SHOE_MAX_HANDS:
+            shoe.trim(SHOE_MAX_HANDS)
+        totals = dict(job["totals"])
+        totals[side] = totals.get(side, 0) + 1
+        t0 = time.perf_counter()
+        build_analysis_flex(job["room"], shoe, totals)
+        sides[side] = time.perf_counter() - t0
+        spent += sides[side]
+        metrics_inc("speculation_rendered")
+    if not sides:
+        return
+    with speculation_cond:
+        speculation_done.pop(job["uid"], None)
+        speculation_done[job["uid"]] = {"room": job["room"], "shoe": job["shoe"], "n": job["n"], "sides": sides}
+        # 三張卡都在分析快取裡才有意義：追蹤的用戶數不超過快取能容納的
+        while len(speculation_done) > max(ANALYSIS_CACHE_SIZE // len(SPECULATE_SIDES), 1):
+            speculation_done.popitem(last=False)
+
+def score_speculation(uid, room, history, new_data):
+    """寫入新結果前呼叫：命中時回傳該結果預先渲染花的秒數，否則回傳 None；沒用到的部分計入浪費"""
+    if not SPECULATE:
+        return None
+    with speculation_cond:
+        if speculation_queue.pop(uid, None) is not None:
+            metrics_inc("speculation_cancelled")
+        spec = speculation_done.pop(uid, None)
+    side = new_data[0] if len(new_data) == 1 else None
+    hit = (spec is not None and spec["room"] == room and spec["shoe"] is history
+           and spec["n"] == len(history) and side in spec["sides"])
+    if spec is not None:
+        wasted = sum(sec for s, sec in spec["sides"].items() if not hit or s != side)
+        metrics_inc("speculation_wasted_us_total", int(wasted * 1e6))
+    metrics_inc("speculation_hits" if hit else "speculation_misses")
+    return spec["sides"][side] if hit else None
+
+def speculation_report(snap):
+    """/metrics 的 speculation 欄位：命中率與每次命中省下 / 實際花的組卡時間"""
+    hits, misses = snap.get("speculation_hits", 0), snap.get("speculation_misses", 0)
+    return {
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+        "saved_ms_per_hit": round(snap.get("speculation_saved_us_total", 0) / hits / 1000, 2) if hits else None,
+        "served_ms_per_hit": round(snap.get("speculation_served_us_total", 0) / hits / 1000, 2) if hits else None,
+        "wasted_ms": round(snap.get("speculation_wasted_us_total", 0) / 1000, 1),
+        "queued": len(speculation_queue),
+    }
+
+def _speculation_loop():
+    while True:
+        with speculation_cond:
+            while not speculation_queue:
+                speculation_cond.wait()
+            _, job = speculation_queue.popitem(last=False)
+        try:
+            speculate(job)
+        except Exception as e:
+            print(f"[SPECULATE] error: {e}")
+
+def start_speculator():
+    if SPECULATE:
+        threading.Thread(target=_speculation_loop, name="speculator", daemon=True).start()
+        print(f"[SPECULATE] enabled: budget={SPECULATE_BUDGET_MS:.0f}ms queue={SPECULATE_QUEUE_MAX}", flush=True)
+
+# ==================== 到期掃描 ====================
+# uid -> 已通知的種類 ("soon" / "expired")；同時記在 user_access_data[uid]["expiry_notified"]，重啟後不會重複推播
+expiry_notified = {uid: u["expiry_notified"] for uid, u in user_access_data.items()
+                   if isinstance(u, dict) and u.get("expiry_notified")}
+
+def on_expiry_events(soon, expired):
+    """掃描結果轉成批次推播 (即將到期 / 已到期各一個工作)"""
+    if soon or expired:
+        print(f"[EXPIRY] soon={len(soon)} expired={len(expired)}")
+    if not EXPIRY_NOTIFY:
+        return
+    if soon:
+        start_broadcast(soon, [{"type": "text", "text": "⏰ 您的授權即將到期，請記得儲值以免中斷服務。"}], kind="expiry_soon")
+    if expired:
+        start_broadcast(expired, [{"type": "text", "text": "⌛ 您的授權已到期，輸入【儲值】即可續用。"}], kind="expired")
 
-                # ── MT真人：手動輸入模式 ──
-                chat_modes[uid] = {"state": "predicting", "room": room_name}
-                line_reply(tk, text_with_back(f"✅ 已選擇 {room_name}\n\n請輸入開牌結果：\n1(閒) 2(莊) 3(和)"))
+def sweep_expiries(now=None):
+    """只查索引中落在通知區間的用戶，不掃描全部用戶"""
+    now = int(time.time()) if now is None else now
+    soon, expired = [], []
+    # 與儲值、管理員修改共用 user_data_lock：讀取、標記與存檔在同一段鎖內完成
+    with user_data_lock:
+        for ts, uid in users_expiring_between(now - max(EXPIRY_SWEEP_SEC, 60) * 2, now + EXPIRY_NOTICE_AHEAD_SEC):
+            kind = "expired" if ts <= now else "soon"
+            if expiry_notified.get(uid) == kind:
                 continue
-            # DG → 驗證房號（根據類別限制）
-            rn = room_name.upper()
-            dg_cat = mode.get("cat", "")
-            if dg_cat == "百家樂":
-                dg_valid = [f"RB0{i}" for i in range(1, 8)]
-                if rn not in dg_valid:
-                    line_reply(tk, text_with_back("⚠️ 房號格式錯誤\n\n百家樂房號：RB01~RB07"))
-                    continue
-            elif dg_cat == "性感百家樂":
-                dg_valid = [f"S0{i}" for i in range(1, 8)]
-                if rn not in dg_valid:
-                    line_reply(tk, text_with_back("⚠️ 房號格式錯誤\n\n性感百家樂房號：S01~S07"))
-                    continue
-            else:
-                if rn not in DG_ROOMS:
-                    line_reply(tk, text_with_back("⚠️ DG真人房號格式錯誤\n\n百家樂：RB01~RB07\n性感百家樂：S01~S07"))
-                    continue
-            room_name = rn
-            chat_modes[uid] = {"state": "predicting", "room": room_name}
-            line_reply(tk, text_with_back(f"✅ 已選擇 {room_name}\n\n請輸入開牌結果：\n1(閒) 2(莊) 3(和)"))
-            continue
+            expiry_notified[uid] = kind
+            if uid in user_access_data:
+                user_access_data[uid]["expiry_notified"] = kind
+            (expired if kind == "expired" else soon).append(uid)
+        if soon or expired:
+            save_data(USER_DATA_FILE, user_access_data)
+    metrics_inc("expiry_sweeps")
+    metrics_inc("expiry_soon_found", len(soon))
+    metrics_inc("expiry_expired_found", len(expired))
+    on_expiry_events(soon, expired)
+    return soon, expired
 
-        elif isinstance(mode, dict) and mode.get("state") == "predicting":
-            room = mode["room"]
-            history = baccarat_history_dict.setdefault(uid, {}).setdefault(room, [])
-            code_map = {"1": "閒", "2": "莊", "3": "和"}
-            new_data = [code_map[c] for c in msg if c in code_map]
-            print(f"[DEBUG] predicting: msg={msg}, new_data={new_data}, history_len={len(history)}")
-            if new_data:
-                # --- 獲利計算：用上一輪AI預測 vs 本輪實際結果 ---
-                profit_info = None
-                pt = profit_tracker.get(uid)
-                if pt:
-                    for actual in new_data:
-                        last_pred = pt.get("last_prediction")
-                        if last_pred:
-                            bet_side = last_pred["下注"]
-                            bet_text = last_pred.get("建議注碼", "1單位")
-                            # 動態解析注碼數字 (支援 1~10單位)
-                            try:
-                                multiplier = float(''.join(c for c in bet_text.split("單位")[0] if c.isdigit() or c == '.'))
-                            except:
-                                multiplier = 1.0
-                            bet_amount = pt["unit"] * multiplier
-                            pt["rounds"] += 1
-                            if actual == "和":
-                                profit = 0
-                                round_text = f"第{pt['rounds']}局：AI下{bet_side} {bet_amount:,.0f} → 開{actual} ➖ 和局(退注)"
-                            elif actual == bet_side:
-                                if bet_side == "莊":
-                                    profit = bet_amount * BANKER_PAYOUT
-                                else:
-                                    profit = bet_amount * PLAYER_PAYOUT
-                                pt["wins"] += 1
-                                round_text = f"第{pt['rounds']}局：AI下{bet_side} {bet_amount:,.0f} → 開{actual} ✅ +{profit:,.0f}"
-                            else:
-                                profit = -bet_amount
-                                pt["losses"] += 1
-                                round_text = f"第{pt['rounds']}局：AI下{bet_side} {bet_amount:,.0f} → 開{actual} ❌ {profit:,.0f}"
-                            pt["total_profit"] += profit
-                            pt["round_text"] = round_text
-                            pt["round_profit"] = profit
-
-                history.extend(new_data)
-                # Track total count before trimming
-                total_key = f"{room}_total"
-                room_totals = baccarat_history_dict[uid].setdefault(total_key, {"莊": 0, "閒": 0, "和": 0})
-                for d in new_data:
-                    if d in room_totals:
-                        room_totals[d] += 1
-                if len(history) > 90:
-                    history = history[-90:]
-                baccarat_history_dict[uid][room] = history
-
-                # Build profit_info for display
-                if pt:
-                    profit_info = {
-                        "total_profit": pt["total_profit"],
-                        "rounds": pt["rounds"],
-                        "wins": pt["wins"],
-                        "losses": pt["losses"],
-                        "round_profit": pt.get("round_profit", 0)
-                    }
-                    if "round_text" in pt:
-                        profit_info["round_text"] = pt["round_text"]
+def _expiry_sweeper_loop():
+    while True:
+        time.sleep(EXPIRY_SWEEP_SEC)
+        try:
+            sweep_expiries()
+        except Exception as e:
+            print(f"[EXPIRY] sweep error: {e}")
 
-                try:
-                    ai_out = {} if pt else None
-                    flex_msg = build_analysis_flex(room, history, room_totals, profit_info, _out_res=ai_out)
-                    print(f"[DEBUG] flex built OK, size={len(json.dumps(flex_msg, ensure_ascii=False))}")
-                    line_reply(tk, flex_msg)
-                    # Store current AI prediction for next round's profit calculation
-                    if pt and ai_out:
-                        pt["last_prediction"] = ai_out
-                except Exception as e:
-                    print(f"[DEBUG] build_analysis_flex ERROR: {e}")
-                    traceback.print_exc()
-                    line_reply(tk, sys_bubble(f"⚠️ 分析錯誤：{str(e)[:100]}"))
-            else:
-                line_reply(tk, sys_bubble("⚠️ 請輸入 1, 2 或 3"))
-            continue
+def start_expiry_sweeper():
+    if EXPIRY_SWEEP_SEC > 0:
+        threading.Thread(target=_expiry_sweeper_loop, name="expiry-sweeper", daemon=True).start()
 
-        # 儲值入口
-        if msg == "儲值":
-            chat_modes[uid] = "input_card"
-            line_reply(tk, sys_bubble("請輸入 10 位儲值序號："))
-            continue
+# ==================== 序號批次產生與匯出 ====================
+CARD_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # 32 字，剛好對應 5 bits
+CARD_CODE_LEN = 10
+# 每個亂數 byte 取低 5 bits 對應字母，無模數偏差；整批用 bytes.translate 一次轉換
+_CARD_TABLE = bytes(CARD_ALPHABET.encode('ascii')[b & 31] for b in range(256))
+
+def mint_card_codes(count, is_taken):
+    """用 os.urandom 批次產生 count 組不重複序號 (與既有序號、同批序號皆不碰撞)"""
+    codes, seen = [], set()
+    while len(codes) < count:
+        need = count - len(codes)
+        raw = os.urandom(need * CARD_CODE_LEN).translate(_CARD_TABLE).decode('ascii')
+        for i in range(0, len(raw), CARD_CODE_LEN):
+            code = raw[i:i + CARD_CODE_LEN]
+            if code in seen or is_taken(code):
+                metrics_inc("card_mint_collisions")
+                continue
+            seen.add(code)
+            codes.append(code)
+    return codes
+
+def mint_cards(dur_key, count, channel_id=DEFAULT_CHANNEL_ID):
+    """產生一批序號並一次寫入 time_cards.json，回傳 (batch_id, codes, created_at)；非預設頻道的序號標上頻道"""
+    batch_id = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:6]
+    created_at = datetime.now(timezone.utc).isoformat()
+    with time_cards_data_lock:
+        active = time_cards_data.setdefault("active_cards", {})
+        used = time_cards_data.setdefault("used_cards", {})
+        # 已歸檔的已使用序號也不能重新發出 (compact_used_cards 同樣先取 time_cards_data_lock，索引不會在這期間變動)
+        with card_archive_lock:
+            archived = _load_card_archive_index()
+        codes = mint_card_codes(count, lambda c: c in active or c in used or c in archived)
+        for code in codes:
+            active[code] = {"duration": dur_key, "created_at": created_at, "batch": batch_id}
+            if channel_id != DEFAULT_CHANNEL_ID:
+                active[code]["channel"] = channel_id
+        save_data(TIME_CARDS_FILE, time_cards_data)
+    metrics_inc("cards_minted", len(codes))
+    return batch_id, codes, created_at
+
+def export_card_batch(batch_id, dur_key, codes, created_at):
+    """把一批序號寫成 CSV 與 JSONL，回傳兩個檔名"""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    csv_name, jsonl_name = f"cards_{batch_id}.csv", f"cards_{batch_id}.jsonl"
+    with open(os.path.join(EXPORT_DIR, csv_name), 'w', encoding='utf-8', newline='') as f:
+        f.write("code,duration,created_at,batch\n")
+        f.writelines(f"{c},{dur_key},{created_at},{batch_id}\n" for c in codes)
+    with open(os.path.join(EXPORT_DIR, jsonl_name), 'wb') as f:
+        f.writelines(json_dumps_bytes({"code": c, "duration": dur_key, "created_at": created_at, "batch": batch_id}) + b"\n" for c in codes)
+    return csv_name, jsonl_name
+
+def sign_export(name, ttl=EXPORT_LINK_TTL_SEC, route="exports"):
+    """產生有時效的下載連結 (HMAC 簽章，可直接在 LINE 點開)；簽章包含路由，連結不能跨路由使用"""
+    exp = int(time.time()) + ttl
+    sig = hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), f"{route}/{name}:{exp}".encode('utf-8'), hashlib.sha256).hexdigest()
+    return f"{BASE_URL}/{route}/{name}?exp={exp}&sig={sig}"
+
+def export_link_valid(name, exp, sig, route="exports"):
+    try:
+        if int(exp) < time.time():
+            return False
+    except (TypeError, ValueError):
+        return False
+    expected = hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), f"{route}/{name}:{exp}".encode('utf-8'), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, sig or "")
+
+# ==================== 已使用序號歸檔 ====================
+card_archive_index = None   # code -> 所在 gzip member 的檔案位移 (首次查詢時載入)
+card_archive_lock = threading.Lock()
+
+def _load_card_archive_index():
+    global card_archive_index
+    if card_archive_index is None:
+        idx = {}
+        if os.path.exists(CARD_ARCHIVE_INDEX_FILE):
+            with open(CARD_ARCHIVE_INDEX_FILE, 'r', encoding='utf-8') as f:
+                for line in f:
+                    code, _, offset = line.rstrip("\n").partition("\t")
+                    if offset:
+                        idx[code] = int(offset)
+        card_archive_index = idx
+    return card_archive_index
+
+def compact_used_cards():
+    """把熱檔中的已使用序號追加成一個新的 gzip member，再從 time_cards.json 移除"""
+    with time_cards_data_lock, card_archive_lock:
+        used = time_cards_data.get("used_cards", {})
+        if not used:
+            return 0
+        batch = dict(used)
+        import gzip
+        payload = b"".join(json_dumps_bytes({"code": c, **info}) + b"\n" for c, info in batch.items())
+        # 先寫冷檔與索引並落盤，再改熱檔；中途當機最多造成重複歸檔，不會遺失
+        with open(CARD_ARCHIVE_FILE, 'ab') as f:
+            offset = f.tell()
+            f.write(gzip.compress(payload))
+            f.flush()
+            os.fsync(f.fileno())
+        with open(CARD_ARCHIVE_INDEX_FILE, 'a', encoding='utf-8') as f:
+            f.writelines(f"{c}\t{offset}\n" for c in batch)
+            f.flush()
+            os.fsync(f.fileno())
+        if card_archive_index is not None:
+            card_archive_index.update((c, offset) for c in batch)
+        for c in batch:
+            used.pop(c, None)
+        save_data(TIME_CARDS_FILE, time_cards_data)
+    metrics_inc("cards_archived", len(batch))
+    print(f"[CARDS] archived {len(batch)} used card(s) at offset {offset}")
+    return len(batch)
+
+def lookup_archived_card(code):
+    """由索引定位 gzip member，只解壓那一段找出序號紀錄"""
+    import zlib
+    with card_archive_lock:
+        offset = _load_card_archive_index().get(code)
+        if offset is None:
+            return None
+        with open(CARD_ARCHIVE_FILE, 'rb') as f:
+            f.seek(offset)
+            d = zlib.decompressobj(wbits=31)
+            chunks = []
+            while not d.eof:
+                buf = f.read(65536)
+                if not buf:
+                    break
+                chunks.append(d.decompress(buf))
+    for line in b"".join(chunks).decode('utf-8').splitlines():
+        rec = json_loads(line)
+        if rec.get("code") == code:
+            return rec
+    return None
+
+def find_card(code):
+    """稽核查詢：依序查 active、熱檔 used、冷檔歸檔"""
+    with time_cards_data_lock:
+        if code in time_cards_data.get("active_cards", {}):
+            return "active", time_cards_data["active_cards"][code]
+        if code in time_cards_data.get("used_cards", {}):
+            return "used", time_cards_data["used_cards"][code]
+    rec = lookup_archived_card(code)
+    return ("archived", rec) if rec else (None, None)
+
+def _card_compactor_loop():
+    while True:
+        time.sleep(CARD_COMPACT_SEC)
+        try:
+            compact_used_cards()
+        except Exception as e:
+            print(f"[CARDS] compaction error: {e}")
+
+def start_card_compactor():
+    if CARD_COMPACT_SEC > 0:
+        threading.Thread(target=_card_compactor_loop, name="card-compactor", daemon=True).start()
+
+# ==================== 記憶體統計 ====================
+memory_last = None          # 最近一次 memory_report() 的摘要 (/metrics 直接讀，不重新計算)
+memory_alerted = {}         # 警示項目 -> 上次推播時間
+_memory_trace_snapshot = None
 
-        elif mode == "input_card":
-            success, result_msg = use_time_card(uid, msg.upper())
-            chat_modes.pop(uid, None)
-            line_reply(tk, sys_bubble(result_msg))
+def _memory_structures():
+    return {
+        "baccarat_history_dict": baccarat_history_dict,
+        "chat_modes": chat_modes,
+        "profit_tracker": profit_tracker,
+        "settled_ledgers": settled_ledgers,
+        "user_access_data": user_access_data,
+        "time_cards_data": time_cards_data,
+        "room_stats": room_stats,
+        "processed_events": processed_events,
+        "analysis_cache": analysis_cache,
+        "road_image_cache": road_image_cache,
+    }
+
+def deep_sizeof(obj, seen=None):
+    """估算物件含內容的大小 (bytes)；只展開容器與本模組的狀態類別，同一物件只算一次
+
+    不拿鎖走訪其他執行緒正在修改的結構：每一層先用 list() 取快照 (在 GIL 下一次完成)，
+    再走訪快照，避免 "changed size during iteration"；估算值允許與當下略有出入
+    """
+    seen = set() if seen is None else seen
+    walk_types = (ProfitLedger, RoomStats, IdempotencyCache)
+    size, stack = 0, [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
             continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            for k, v in list(o.items()):
+                stack.append(k)
+                stack.append(v)
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            stack.extend(list(o))
+        elif isinstance(o, walk_types):
+            stack.append(vars(o))
+        elif isinstance(o, ShoeHistory):
+            stack.append(o.runs)
+    return size
+
+def approx_sizeof(obj):
+    """大型 dict 抽樣 MEMORY_SAMPLE_SIZE 筆再按比例推估；只有少數 key 的外層 dict 逐項展開"""
+    if not isinstance(obj, dict):
+        return deep_sizeof(obj)
+    n = len(obj)
+    if n <= 8:
+        return sys.getsizeof(obj) + sum(sys.getsizeof(k) + approx_sizeof(v) for k, v in list(obj.items()))
+    if n <= MEMORY_SAMPLE_SIZE:
+        return deep_sizeof(obj)
+    keys = list(obj)
+    picked = keys[::max(1, len(keys) // MEMORY_SAMPLE_SIZE)][:MEMORY_SAMPLE_SIZE]
+    seen = set()
+    part = sum(deep_sizeof(k, seen) + deep_sizeof(obj.get(k), seen) for k in picked)
+    return int(sys.getsizeof(obj) + part * len(keys) / len(picked))
+
+def process_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024   # 取不到目前值時以峰值代替
+
+def memory_counts():
+    rooms = hands = 0
+    for h in list(baccarat_history_dict.values()):
+        for k, v in list(h.items()):
+            if isinstance(v, ShoeHistory):
+                rooms += 1
+                hands += len(v)
+    return {
+        "users": len(baccarat_history_dict), "rooms": rooms, "hands": hands,
+        "chat_modes": len(chat_modes), "profit_trackers": len(profit_tracker),
+        "ledger_hands": sum(len(pt["ledger"]) for pt in list(profit_tracker.values())),
+        "access_users": len(user_access_data),
+        "active_cards": len(time_cards_data.get("active_cards", {})),
+        "used_cards": len(time_cards_data.get("used_cards", {})),
+    }
+
+def heaviest_users(n=10):
+    """先用局數粗排取候選，再對候選逐一估算，不必對所有用戶做深度計算"""
+    def rough(uid):
+        h = baccarat_history_dict.get(uid) or {}
+        pt = profit_tracker.get(uid)
+        return sum(len(v) for v in list(h.values()) if isinstance(v, ShoeHistory)) + (len(pt["ledger"]) * 4 if pt else 0)
+    uids = set(baccarat_history_dict) | set(profit_tracker)
+    out = []
+    for uid in heapq.nlargest(n * 3, uids, key=rough):
+        seen = set()
+        size = deep_sizeof(baccarat_history_dict.get(uid), seen) + deep_sizeof(profit_tracker.get(uid), seen) \
+            + deep_sizeof(chat_modes.get(uid), seen)
+        out.append({"uid": uid, "bytes": size})
+    out.sort(key=lambda r: -r["bytes"])
+    return out[:n]
+
+def memory_report(top=0):
+    global memory_last
+    t0 = time.perf_counter()
+    structures = {name: approx_sizeof(obj) for name, obj in _memory_structures().items()}
+    report = {"rss_mb": round(process_rss_mb(), 1), "structures_bytes": structures,
+              "counts": memory_counts(), "generated_at": int(time.time())}
+    if top:
+        report["heaviest_users"] = heaviest_users(top)
+    report["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    memory_last = {k: v for k, v in report.items() if k != "heaviest_users"}
+    metrics_set("memory_rss_mb", report["rss_mb"])
+    for name, size in structures.items():
+        metrics_set(f"memory_{name}_kb", size // 1024)
+    return report
+
+def memory_alerts(report):
+    alerts = []
+    if MEMORY_ALERT_RSS_MB > 0 and report["rss_mb"] >= MEMORY_ALERT_RSS_MB:
+        alerts.append(("rss", f"RSS {report['rss_mb']:.0f}MB ≥ {MEMORY_ALERT_RSS_MB:.0f}MB"))
+    for name, size in report["structures_bytes"].items():
+        if MEMORY_ALERT_STRUCT_MB > 0 and size >= MEMORY_ALERT_STRUCT_MB * 1024 * 1024:
+            alerts.append((name, f"{name} ≈ {size / 1048576:.1f}MB ≥ {MEMORY_ALERT_STRUCT_MB:.0f}MB"))
+    return alerts
+
+def check_memory():
+    report = memory_report()
+    now = time.time()
+    fresh = []
+    for key, text in memory_alerts(report):
+        if now - memory_alerted.get(key, 0) >= MEMORY_ALERT_COOLDOWN_SEC:
+            memory_alerted[key] = now
+            fresh.append(text)
+    if fresh:
+        print(f"[MEMORY] alert: {'; '.join(fresh)}")
+        metrics_inc("memory_alerts", len(fresh))
+        start_broadcast(ADMIN_UIDS, [{"type": "text", "text": "⚠️ 記憶體警示\n" + "\n".join(fresh) + "\n\n輸入【記憶體】查看明細"}],
+                        kind="memory_alert")
+    return fresh
+
+def _memory_checker_loop():
+    while True:
+        time.sleep(MEMORY_CHECK_SEC)
+        try:
+            check_memory()
+        except Exception as e:
+            print(f"[MEMORY] check error: {e}")
+
+def start_memory_checker():
+    if MEMORY_CHECK_SEC > 0:
+        threading.Thread(target=_memory_checker_loop, name="memory-checker", daemon=True).start()
+
+def memory_trace(action):
+    """tracemalloc：start 開始追蹤並取基準快照，diff 與上次快照比較 (之後以新快照為基準)，stop 結束"""
+    global _memory_trace_snapshot
+    import tracemalloc
+    if action == "start":
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _memory_trace_snapshot = tracemalloc.take_snapshot()
+        return ["tracemalloc started"]
+    if action == "stop":
+        tracemalloc.stop()
+        _memory_trace_snapshot = None
+        return ["tracemalloc stopped"]
+    if not tracemalloc.is_tracing() or _memory_trace_snapshot is None:
+        return ["tracemalloc not running"]
+    snap = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    stats = snap.compare_to(_memory_trace_snapshot, "lineno")
+    _memory_trace_snapshot = snap
+    return [str(st) for st in stats[:10]]
+
+def memory_report_text(report):
+    lines = [f"🧠 記憶體 RSS：{report['rss_mb']:.1f}MB", "=" * 20]
+    for name, size in sorted(report["structures_bytes"].items(), key=lambda kv: -kv[1]):
+        lines.append(f"{name}：{size / 1024:,.0f}KB")
+    c = report["counts"]
+    lines += ["=" * 20,
+              f"用戶 {c['users']:,}｜房間 {c['rooms']:,}｜牌路 {c['hands']:,} 局",
+              f"對話狀態 {c['chat_modes']:,}｜獲利追蹤 {c['profit_trackers']:,} ({c['ledger_hands']:,} 局)",
+              f"授權用戶 {c['access_users']:,}｜序號 {c['active_cards']:,} 未用 / {c['used_cards']:,} 已用"]
+    if report.get("heaviest_users"):
+        lines += ["=" * 20] + [f"{r['uid'][-6:]}：{r['bytes'] / 1024:,.1f}KB" for r in report["heaviest_users"]]
+    lines.append(f"(估算耗時 {report['elapsed_ms']}ms)")
+    return "\n".join(lines)
+
+# ==================== 效能分析 (取樣 / cProfile) ====================
+profile_session = None   # 進行中的分析；None 時 profiled_handle_event 直接呼叫 handle_event
+profile_last = None      # 最近一次完成的結果 (檔名與摘要)
+_profile_threads = {}    # thread ident -> 正在處理的分支
+_profile_lock = threading.Lock()
+
+PROFILE_ADMIN_PREFIXES = ("產生序號", "公告", "查詢序號", "房間總覽", "推播狀態", "效能分析", "記憶體")
+
+def event_branch(event):
+    """把事件歸到狀態機的分支，取樣結果依此分組"""
+    if event.get("type") == "follow":
+        return "menus"
+    message = event.get("message") or {}
+    if event.get("type") != "message" or "text" not in message:
+        return "other"
+    uid = event["source"].get("userId")
+    msg = message["text"].strip()
+    mode = chat_modes.get(uid)
+    state = mode.get("state", "") if isinstance(mode, dict) else (mode or "")
+    if is_admin(uid) and msg.startswith(PROFILE_ADMIN_PREFIXES):
+        return "admin"
+    if state == "predicting":
+        return "predicting"
+    if state.startswith("slot") or msg == "電子預測":
+        return "slot"
+    if state.startswith("profit") or msg in ("計算獲利", "結算", "關閉獲利"):
+        return "profit"
+    if state == "input_card" or msg == "儲值":
+        return "card"
+    return "menus"
+
+def start_profile(mode="sample", seconds=None, requests_limit=None, notify_uid=None):
+    """開始一次分析 (時間或筆數先到者結束)；已有分析進行中回傳 None"""
+    global profile_session
+    if seconds is None and requests_limit is None:
+        seconds = 60
+    seconds = min(seconds or PROFILE_MAX_SEC, PROFILE_MAX_SEC)
+    with _profile_lock:
+        if profile_session is not None:
+            return None
+        session = {"id": time.strftime("%Y%m%d%H%M%S") + "_" + uuid.uuid4().hex[:4], "mode": mode, "started": time.time(), "seconds": seconds,
+                   "remaining": requests_limit, "seen": 0, "samples": 0, "stacks": Counter(),
+                   "requests": Counter(), "stats": {}, "notify": notify_uid}
+        profile_session = session
+    timer = threading.Timer(seconds, stop_profile, args=(session,))
+    timer.daemon = True
+    timer.start()
+    session["timer"] = timer
+    if mode == "sample":
+        threading.Thread(target=_profile_sampler, args=(session,), daemon=True, name="profiler").start()
+    print(f"[PROFILE] start {session['id']} mode={mode} seconds={seconds} requests={requests_limit}")
+    return session
+
+def _profile_sampler(session):
+    """定時讀取處理中執行緒的堆疊，累計成 collapsed stack (branch;外層;...;內層 → 次數)"""
+    interval = PROFILE_SAMPLE_MS / 1000.0
+    root = handle_event.__code__
+    stacks = session["stacks"]
+    while profile_session is session:
+        frames = sys._current_frames()
+        for ident, branch in list(_profile_threads.items()):
+            f = frames.get(ident)
+            stack = []
+            while f is not None:
+                code = f.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                if code is root:
+                    break
+                f = f.f_back
+            if stack:
+                stacks[branch + ";" + ";".join(reversed(stack))] += 1
+                session["samples"] += 1
+        del frames
+        time.sleep(interval)
+
+def profiled_handle_event(event):
+    session = profile_session
+    if session is None:
+        return handle_event(event)
+    branch = event_branch(event)
+    session["requests"][branch] += 1
+    session["seen"] += 1
+    ident = threading.get_ident()
+    _profile_threads[ident] = branch
+    prof = None
+    if session["mode"] == "cprofile" and session["seen"] % max(1, round(1 / PROFILE_CPROFILE_RATE)) == 0:
+        import cProfile
+        prof = cProfile.Profile()
+    try:
+        if prof is None:
+            handle_event(event)
+        else:
+            prof.enable()
+            try:
+                handle_event(event)
+            finally:
+                prof.disable()
+                _merge_profile(session, branch, prof)
+    finally:
+        _profile_threads.pop(ident, None)
+        if session["remaining"] is not None:
+            session["remaining"] -= 1
+            if session["remaining"] <= 0:
+                stop_profile(session)
+
+def _merge_profile(session, branch, prof):
+    import pstats
+    stats = session["stats"].get(branch)
+    if stats is None:
+        session["stats"][branch] = pstats.Stats(prof)
+    else:
+        stats.add(prof)
+
+def stop_profile(session=None):
+    """結束分析並寫出檔案 (EXPORT_DIR)：取樣為 .folded，cProfile 為各分支的 .prof 與文字摘要"""
+    global profile_session, profile_last
+    with _profile_lock:
+        session = session or profile_session
+        if session is None or profile_session is not session:
+            return None
+        profile_session = None
+    session["timer"].cancel()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    files = []
+    if session["mode"] == "sample":
+        name = f"profile_{session['id']}.folded"
+        with open(os.path.join(EXPORT_DIR, name), 'w', encoding='utf-8') as f:
+            f.writelines(f"{stack} {n}\n" for stack, n in session["stacks"].most_common())
+        files.append(name)
+    else:
+        summary = io.StringIO()
+        for branch, stats in sorted(session["stats"].items()):
+            name = f"profile_{session['id']}_{branch}.prof"
+            stats.dump_stats(os.path.join(EXPORT_DIR, name))
+            files.append(name)
+            summary.write(f"===== {branch} =====\n")
+            stats.stream = summary
+            stats.sort_stats("cumulative").print_stats(25)
+        name = f"profile_{session['id']}.txt"
+        with open(os.path.join(EXPORT_DIR, name), 'w', encoding='utf-8') as f:
+            f.write(summary.getvalue())
+        files.append(name)
+    profile_last = {"id": session["id"], "mode": session["mode"], "files": files,
+                    "elapsed": round(time.time() - session["started"], 1), "samples": session["samples"],
+                    "requests": dict(session["requests"])}
+    print(f"[PROFILE] done {session['id']}: {profile_last['requests']} samples={session['samples']}")
+    if session["notify"]:
+        # 只通知一位管理員：直接推播，不建立廣播工作 (不寫入廣播記錄、不占用廣播執行緒)
+        channel, raw_uid = channel_for_uid(session["notify"])
+        send_line_request("push", {"to": raw_uid, "messages": [{"type": "text", "text": profile_status_text()}]},
+                          _on_profile_notify_result, channel)
+    return profile_last
 
-        # 持久選單出口
+def _on_profile_notify_result(status, text):
+    if status != 200:
+        print(f"[PROFILE] notify failed {status}: {text[:300]}")
+
+def profile_status_text():
+    session = profile_session
+    if session is not None:
+        left = session["started"] + session["seconds"] - time.time()
+        return (f"⏱ 效能分析進行中 ({session['mode']})\n已處理 {session['seen']} 筆，剩餘 {left:.0f} 秒"
+                + (f" / {session['remaining']} 筆" if session["remaining"] is not None else ""))
+    if profile_last is None:
+        return "尚未執行過效能分析\n\n格式：效能分析 [60秒|200筆] [cprofile]"
+    counts = "、".join(f"{b} {n}" for b, n in sorted(profile_last["requests"].items(), key=lambda kv: -kv[1])) or "無"
+    links = "\n\n".join(f"{name}：\n{sign_export(name)}" for name in profile_last["files"])
+    return (f"✅ 效能分析 {profile_last['id']} 已完成 ({profile_last['mode']}, {profile_last['elapsed']}秒)\n"
+            f"請求：{counts}\n取樣：{profile_last['samples']}\n\n{links}")
+
+def parse_profile_args(text):
+    """「60秒」「30s」→ 秒數；「200筆」或純數字 → 筆數；「cprofile」切換模式"""
+    mode, seconds, limit = "sample", None, None
+    for tok in text.replace("：", " ").split():
+        low = tok.lower()
+        if low in ("cprofile", "sample"):
+            mode = low
+        elif low.endswith(("秒", "s")) and low.rstrip("秒s").isdigit():
+            seconds = int(low.rstrip("秒s"))
+        elif low.rstrip("筆次").isdigit():
+            limit = int(low.rstrip("筆次"))
+        else:
+            raise ValueError(tok)
+    return mode, seconds, limit
+
+# ==================== 負載控制 ====================
+class LoadGovernor:
+    """依待處理事件數與近期延遲決定渲染層級；升級 (變便宜) 立即生效，
+    降回需低於門檻一半並維持 LOAD_RECOVER_SEC，每次只回一級，避免來回震盪
+
+    沒有待處理事件時，延遲估計每 LOAD_RECOVER_SEC 減半；讀取 tier 時也會重新評估，
+    尖峰過後即使沒有新事件 (或只有零星事件)，層級也會依時間逐級降回
+    """
+
+    MAX_TIER = 4
+
+    def __init__(self, queue_steps=LOAD_QUEUE_STEPS, latency_steps=LOAD_LATENCY_STEPS, recover_sec=LOAD_RECOVER_SEC):
+        self.queue_steps = queue_steps
+        self.latency_steps = latency_steps
+        self.recover_sec = recover_sec
+        self.pending = 0
+        self.latency = 0.0        # 收到事件到處理完成的 EWMA (秒)
+        self._tier = 0
+        self._last_busy = 0.0     # 最後一次負載仍達目前層級 (半門檻) 的時間
+        self._latency_at = 0.0    # 延遲估計最後一次更新 / 衰減的時間
+        self._evaluated_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def tier(self):
+        now = time.monotonic()
+        if self._tier and now - self._evaluated_at >= 1.0:
+            with self._lock:
+                self._evaluate(now)
+        return self._tier
+
+    def admit(self, n=1):
+        with self._lock:
+            self.pending += n
+            self._evaluate()
+
+    def done(self, latency):
+        with self._lock:
+            self.pending = max(0, self.pending - 1)
+            self.latency = latency if self.latency == 0 else self.latency * 0.8 + latency * 0.2
+            self._latency_at = time.monotonic()
+            self._evaluate(self._latency_at)
+
+    def _target(self, scale=1.0):
+        tier = 0
+        for i, (q, lat) in enumerate(zip(self.queue_steps, self.latency_steps), 1):
+            if self.pending >= q * scale or self.latency >= lat * scale:
+                tier = i
+        return min(tier, self.MAX_TIER)
+
+    def _evaluate(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._evaluated_at = now
+        if self.pending == 0 and self.latency:
+            self.latency *= 0.5 ** ((now - self._latency_at) / self.recover_sec)
+            self._latency_at = now
+        target = self._target()
+        if target > self._tier:
+            self._set(target)
+            self._last_busy = now
+        elif self._target(0.5) >= self._tier:
+            self._last_busy = now
+        elif now - self._last_busy >= self.recover_sec:
+            self._set(self._tier - 1)
+            self._last_busy = now
+        metrics_set("load_pending", self.pending)
+        metrics_set("load_latency_ms", int(self.latency * 1000))
+
+    def _set(self, tier):
+        print(f"[LOAD] tier {self._tier} -> {tier} (pending={self.pending}, latency={self.latency:.2f}s)")
+        metrics_inc("load_tier_up" if tier > self._tier else "load_tier_down")
+        metrics_inc(f"load_tier_enter_{tier}")
+        metrics_set("load_tier", tier)
+        self._tier = tier
+
+load_governor = LoadGovernor()
+
+BUSY_MSG = {"type": "text", "text": "⏳ 目前使用人數眾多，請稍後再試；開牌結果仍會即時分析。"}
+
+def should_shed(event):
+    """最高負載時只略過 SHED_COMMANDS 列出的查詢；選單導覽、開牌結果、儲值與其他管理指令照常處理"""
+    if load_governor.tier < LoadGovernor.MAX_TIER:
+        return False
+    message = event.get("message") or {}
+    if event.get("type") != "message" or "text" not in message:
+        return False
+    return message["text"].strip().upper() in SHED_COMMANDS
+
+# ==================== 指令路由 ====================
+# 依序比對：UID 查詢 → 管理指令 → 返回主選單 → 清除數據 → 功能指令 / 狀態處理。
+# 功能指令與狀態處理共用優先序 (數字越小越先)，重現原本 if/elif 的先後：
+# 例如 predicting 狀態下輸入「儲值」仍當作開牌結果處理，而「百家預測」則會重新進入選單。
+class PrefixTrie:
+    """前綴樹：由左往右逐字比對，回傳第一個 (最短) 命中的已登記前綴"""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix):
+        node = self.root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node[None] = prefix      # None 為結尾標記，不會與字元衝突
+
+    def match(self, text):
+        node = self.root
+        for ch in text:
+            node = node.get(ch)
+            if node is None:
+                return None
+            if None in node:
+                return node[None]
+        return None
+
+UID_COMMANDS = {"UID", "查詢ID", "我的ID"}
+# 最高負載時可略過的指令 (完整比對)：唯讀、稍後再查也無妨的查詢與總覽
+SHED_COMMANDS = frozenset(UID_COMMANDS | {"房間總覽"})
+route_prefixes = PrefixTrie()
+admin_routes = {}       # 前綴或完整指令 → handler (管理員，見 is_admin)
+global_admin_routes = set()   # 只有 ADMIN_UIDS 能用的管理指令 (看得到所有頻道的資料或整個行程的狀態)
+command_routes = {}     # 完整指令 → (優先序, handler, 條件)
+state_routes = {}       # 狀態 → [(優先序, handler, 前綴, 完整指令)]，依優先序排列
+
+def admin_command(prefix=None, exact=None, global_only=False):
+    """登記管理指令；前綴指令同時加進前綴樹。global_only 的指令其他頻道的管理員不能使用"""
+    def deco(fn):
+        if prefix:
+            route_prefixes.add(prefix)
+        admin_routes[prefix or exact] = fn
+        if global_only:
+            global_admin_routes.add(prefix or exact)
+        return fn
+    return deco
+
+def command(text, priority, guard=None):
+    """登記完整比對的功能指令；guard(uid) 為假時視同未命中"""
+    def deco(fn):
+        command_routes[text] = (priority, fn, guard)
+        return fn
+    return deco
+
+def state_route(state, priority, prefix=None, exact=None):
+    """登記狀態處理；prefix / exact 都不給時，該狀態下任何訊息都交給它"""
+    def deco(fn):
+        if prefix:
+            route_prefixes.add(prefix)
+        routes = state_routes.setdefault(state, [])
+        routes.append((priority, fn, prefix, exact))
+        routes.sort(key=lambda r: r[0])
+        return fn
+    return deco
+
+def mode_state(mode):
+    """chat_modes 的值可能是字串或 {"state": ...}，統一取出狀態名稱"""
+    return mode.get("state") if isinstance(mode, dict) else mode
+
+def resolve_route(uid, msg, mode):
+    """回傳處理這則訊息的 handler(uid, tk, msg, mode)"""
+    if msg.upper() in UID_COMMANDS:
+        return reply_uid
+    prefix = route_prefixes.match(msg)
+    if is_admin(uid):
+        key = prefix if prefix in admin_routes else msg
+        handler = admin_routes.get(key)
+        if handler is not None and (key not in global_admin_routes or uid in ADMIN_UIDS):
+            return handler
+    if msg == "返回主選單":
+        return back_to_main_menu
+    if "清除數據" in msg and (":" in msg or "：" in msg):
+        return clear_room_history
+
+    best = None
+    cmd = command_routes.get(msg)
+    if cmd is not None and (cmd[2] is None or cmd[2](uid)):
+        best = cmd
+    for priority, fn, r_prefix, r_exact in state_routes.get(mode_state(mode), ()):
+        if best is not None and priority > best[0]:
+            break
+        if (r_prefix is None or r_prefix == prefix) and (r_exact is None or r_exact == msg):
+            return fn
+    return best[1] if best is not None else send_main_menu_route
+
+# --- 基礎指令 ---
+def reply_uid(uid, tk, msg, mode):
+    line_reply(tk, sys_bubble(f"📋 您的 UID：\n{uid}"))
+
+def back_to_main_menu(uid, tk, msg, mode):
+    chat_modes.pop(uid, None)
+    baccarat_history_dict.pop(uid, None)
+    profit_tracker.pop(uid, None)
+    send_main_menu(tk)
+
+def clear_room_history(uid, tk, msg, mode):
+    room = msg.replace("：", ":").split(":")[-1].strip()
+    if uid in baccarat_history_dict and room in baccarat_history_dict[uid]:
+        baccarat_history_dict[uid][room] = ShoeHistory()
+        baccarat_history_dict[uid].pop(f"{room}_total", None)
+    clear_msg = f"✅ {room} 牌路已清除"
+    if uid in profit_tracker:
+        clear_msg += "\n\n💰 獲利計算仍持續中\n請繼續輸入開牌結果"
+    line_reply(tk, text_with_back(clear_msg))
+
+def send_main_menu_route(uid, tk, msg, mode):
+    # 持久選單出口
+    send_main_menu(tk)
+
+# --- 管理指令 ---
+@admin_command(prefix="產生序號")
+def admin_mint_cards(uid, tk, msg, mode):
+    try:
+        _, duration, count = msg.split()
+        dur_key = duration.upper()
+        if dur_key not in VALID_DURATIONS:
+            valid_list = "\n".join([f"  {k} = {v}" for k, v in VALID_DURATIONS.items()])
+            line_reply(tk, sys_bubble(f"⚠️ 無效期限【{duration}】\n\n可用期限：\n{valid_list}\n\n格式：產生序號 [期限] [數量]"))
+            return
+        n = int(count)
+        if not 0 < n <= CARD_MINT_MAX:
+            raise ValueError
+        batch_id, codes, created_at = mint_cards(dur_key, n, channel_for_uid(uid)[0].id)
+        if n <= CARD_INLINE_MAX:
+            line_reply(tk, [
+                sys_bubble(f"✅ 已產生 {count} 組【{VALID_DURATIONS[dur_key]}】序號："),
+                {"type": "text", "text": "\n".join(codes)}
+            ])
+        else:
+            csv_name, jsonl_name = export_card_batch(batch_id, dur_key, codes, created_at)
+            line_reply(tk, [
+                sys_bubble(f"✅ 已產生 {n:,} 組【{VALID_DURATIONS[dur_key]}】序號\n批次：{batch_id}\n\n數量較多，請下載檔案 (24 小時內有效)："),
+                {"type": "text", "text": f"CSV：\n{sign_export(csv_name)}\n\nJSONL：\n{sign_export(jsonl_name)}"}
+            ])
+    except:
+        line_reply(tk, sys_bubble("⚠️ 格式錯誤：產生序號 [期限] [數量]\n\n可用：10M / 1H / 2D / 7D / 12D / 30D"))
+
+@admin_command(prefix="公告")
+def admin_announce(uid, tk, msg, mode):
+    text = msg[2:].lstrip(" :：")
+    if not text:
+        line_reply(tk, sys_bubble("⚠️ 格式：公告 [內容]"))
+        return
+    recipients = active_user_ids(channel_for_uid(uid)[0])
+    job_id = start_broadcast(recipients, [{"type": "text", "text": text}])
+    line_reply(tk, sys_bubble(f"📣 公告已排入推播\n工作編號：{job_id}\n對象：{len(recipients)} 位有效用戶\n\n輸入【推播狀態】查詢進度"))
+
+@admin_command(prefix="查詢序號", global_only=True)
+def admin_find_card(uid, tk, msg, mode):
+    code = msg[4:].strip().upper()
+    where, info = find_card(code)
+    if where is None:
+        line_reply(tk, sys_bubble(f"❌ 查無序號 {code}"))
+    else:
+        label = {"active": "未使用", "used": "已使用", "archived": "已使用 (歸檔)"}[where]
+        detail = "\n".join(f"{k}：{v}" for k, v in info.items() if k != "code")
+        line_reply(tk, sys_bubble(f"🔎 {code}\n狀態：{label}\n{detail}"))
+
+@admin_command(prefix="效能分析", global_only=True)
+def chat_admin_profile(uid, tk, msg, mode):
+    arg = msg[4:].strip()
+    if arg in ("", "狀態"):
+        line_reply(tk, sys_bubble(profile_status_text()))
+    elif arg == "停止":
+        stop_profile()
+        line_reply(tk, sys_bubble(profile_status_text()))
+    else:
+        try:
+            prof_mode, seconds, limit = parse_profile_args(arg)
+        except ValueError:
+            line_reply(tk, sys_bubble("⚠️ 格式：效能分析 [60秒|200筆] [cprofile]\n效能分析 狀態 / 停止"))
+            return
+        session = start_profile(prof_mode, seconds, limit, notify_uid=uid)
+        if session is None:
+            line_reply(tk, sys_bubble("⚠️ 已有效能分析進行中\n\n" + profile_status_text()))
+        else:
+            line_reply(tk, sys_bubble(f"⏱ 效能分析已開始 ({prof_mode})\n最長 {session['seconds']} 秒"
+                                      + (f" 或 {limit} 筆" if limit else "") + "\n完成後會推播下載連結"))
+
+@admin_command(prefix="記憶體", global_only=True)
+def chat_admin_memory(uid, tk, msg, mode):
+    arg = msg[3:].strip()
+    if arg.startswith("追蹤"):
+        action = {"開始": "start", "差異": "diff", "停止": "stop"}.get(arg[2:].strip(), "diff")
+        line_reply(tk, sys_bubble("\n".join(memory_trace(action))[:1900]))
+    else:
+        line_reply(tk, sys_bubble(memory_report_text(memory_report(top=5))))
+
+@admin_command(exact="房間總覽")
+def admin_room_dashboard(uid, tk, msg, mode):
+    line_reply(tk, build_room_dashboard_flex(room_dashboard()))
+
+@admin_command(prefix="推播狀態", global_only=True)
+def admin_broadcast_status(uid, tk, msg, mode):
+    arg = msg[4:].strip()
+    line_reply(tk, sys_bubble(broadcast_status_text(arg or None)))
+
+# --- 電子預測 ---
+@command("電子預測", 10)
+def slot_entry(uid, tk, msg, mode):
+    if get_access_status(uid)[0] == "active":
+        chat_modes[uid] = "slot_choose_game"
+        line_reply(tk, sys_bubble("🎰 請選擇電子遊戲：", [
+            {"type": "action", "action": {"type": "message", "label": "賽特1", "text": "選遊戲:賽特1"}},
+            {"type": "action", "action": {"type": "message", "label": "賽特2", "text": "選遊戲:賽特2"}}
+        ]))
+    else:
+        line_reply(tk, sys_bubble("❌ 權限不足，請先儲值。"))
+
+@state_route("slot_choose_game", 20, prefix="選遊戲:")
+def slot_choose_game(uid, tk, msg, mode):
+    game_name = msg.split(":")[-1]
+    chat_modes[uid] = {"state": "slot_choose_room", "game": game_name}
+    prompt = f"✅ 已選 {game_name}\n請輸入房號 (1~3000)：\n例如：888"
+    if slot_top_rooms(game_name):
+        line_reply(tk, sys_bubble(prompt + "\n\n或點【推薦房間】查看目前最佳機台", [
+            {"type": "action", "action": {"type": "message", "label": "🔥 推薦房間", "text": "推薦房間"}},
+            {"type": "action", "action": {"type": "message", "label": "↩ 返回主選單", "text": "返回主選單"}}
+        ]))
+    else:
+        line_reply(tk, text_with_back(prompt))
+
+@state_route("slot_choose_room", 30, exact="推薦房間")
+def slot_recommend_rooms(uid, tk, msg, mode):
+    ranked = slot_top_rooms(mode["game"])
+    if ranked:
+        line_reply(tk, build_slot_rank_flex(mode["game"], ranked))
+    else:
+        line_reply(tk, text_with_back("⚠️ 目前沒有最新的機台數據，請直接輸入房號"))
+
+@state_route("slot_choose_room", 40)
+def slot_choose_room(uid, tk, msg, mode):
+    chat_modes[uid] = {"state": "slot_input_bet", "game": mode["game"], "room": msg}
+    line_reply(tk, text_with_back(f"✅ 已鎖定：{mode['game']} 房號 {msg}\n\n第一步：請輸入【今日總下注額】"))
+
+@state_route("slot_input_bet", 50)
+def slot_input_bet(uid, tk, msg, mode):
+    try:
+        bet = float(msg)
+        chat_modes[uid] = {"state": "slot_input_rate", "game": mode["game"], "room": mode["room"], "total_bet": bet}
+        line_reply(tk, text_with_back(f"💰 總下注額已設定：{bet:,.0f}\n\n第二步：請輸入【今日得分率】\n(例如：48)"))
+    except:
+        line_reply(tk, sys_bubble("⚠️ 格式錯誤，請輸入純數字下注額。"))
+
+@state_route("slot_input_rate", 60)
+def slot_input_rate(uid, tk, msg, mode):
+    try:
+        rate = float(msg)
+        total_bet = mode["total_bet"]
+        room_display = f"{mode['game']} 房號:{mode['room']}"
+        res = calculate_slot_logic(total_bet, rate)
+        line_reply(tk, build_slot_flex(room_display, res))
+        chat_modes[uid] = {"state": "slot_input_bet", "game": mode["game"], "room": mode["room"]}
+    except:
+        line_reply(tk, sys_bubble("⚠️ 格式錯誤，請輸入純數字得分率。"))
+
+# --- 計算獲利 ---
+@command("計算獲利", 70)
+def profit_entry(uid, tk, msg, mode):
+    if get_access_status(uid)[0] == "active":
+        chat_modes[uid] = {"state": "profit_input_unit"}
+        line_reply(tk, text_with_back("💰 計算獲利模式\n\n請輸入您的【1單位金額】：\n(例如：100)\n\n設定後請進入百家預測，系統會自動根據AI建議注碼幫您計算每局損益"))
+    else:
+        line_reply(tk, sys_bubble("❌ 權限不足，請先儲值。"))
+
+@state_route("profit_input_unit", 80)
+def profit_input_unit(uid, tk, msg, mode):
+    try:
+        unit = float(msg)
+        if unit <= 0:
+            raise ValueError
+        profit_tracker[uid] = {"unit": unit, "ledger": ProfitLedger(unit), "last_prediction": None}
+        chat_modes.pop(uid, None)
+        line_reply(tk, sys_bubble(
+            f"✅ 獲利計算已啟動\n\n"
+            f"🎯 1單位金額：{unit:,.0f}\n\n"
+            f"請選擇遊戲館開始遊戲\n"
+            f"每局開牌後系統會自動計算損益\n\n"
+            f"輸入【結算】可查看完整報表\n"
+            f"輸入【關閉獲利】停止計算",
+            [
+                {"type": "action", "action": {"type": "message", "label": "百家預測", "text": "百家預測"}},
+                {"type": "action", "action": {"type": "message", "label": "電子預測", "text": "電子預測"}},
+                {"type": "action", "action": {"type": "message", "label": "↩ 返回主選單", "text": "返回主選單"}}
+            ]
+        ))
+    except:
+        line_reply(tk, sys_bubble("⚠️ 請輸入正確的數字金額"))
+
+@command("結算", 90, guard=lambda uid: uid in profit_tracker)
+def profit_settle(uid, tk, msg, mode):
+    ledger = profit_tracker.pop(uid)["ledger"]
+    rpt = ledger.report_text()
+    if len(ledger):
+        csv_url, jsonl_url = ledger_export_links(uid, remember_settled_ledger(uid, ledger))
+        rpt += f"{'='*20}\n📥 逐局明細 (24小時內有效)：\nCSV：{csv_url}\nJSONL：{jsonl_url}\n"
+    line_reply(tk, sys_bubble(rpt))
+
+@command("關閉獲利", 100, guard=lambda uid: uid in profit_tracker)
+def profit_close(uid, tk, msg, mode):
+    profit_tracker.pop(uid, None)
+    line_reply(tk, sys_bubble("✅ 獲利計算已關閉"))
+
+# --- 百家預測 ---
+@command("百家預測", 110)
+def baccarat_entry(uid, tk, msg, mode):
+    status, left = get_access_status(uid)
+    if status == "active":
+        chat_modes[uid] = "choose_provider"
+        line_reply(tk, build_provider_flex(left))
+    else:
+        line_reply(tk, sys_bubble("❌ 權限已過期或未開通。"))
+
+@state_route("choose_provider", 120, prefix="平台:")
+def choose_provider(uid, tk, msg, mode):
+    p_name = "MT真人" if "MT" in msg else "DG真人"
+    if "MT" in msg:
+        chat_modes[uid] = {"state": "mt_choose_category", "p": p_name}
+        line_reply(tk, MT_CATEGORY_FLEX)
+    else:
+        chat_modes[uid] = {"state": "dg_choose_category", "p": p_name}
+        line_reply(tk, DG_CATEGORY_FLEX)
+
+@state_route("dg_choose_category", 130, prefix="DG廳:")
+def dg_choose_category(uid, tk, msg, mode):
+    category = msg.replace("DG廳:", "")
+    chat_modes[uid] = {"state": "choose_room", "p": "DG真人", "cat": category}
+
+    if category == "百家樂":
+        line_reply(tk, text_with_back("🎲 DG真人 - 百家樂\n\n請輸入房號：RB01~RB07"))
+    elif category == "性感百家樂":
+        line_reply(tk, text_with_back("💃 DG真人 - 性感百家樂\n\n請輸入房號：S01~S07"))
+    else:
+        line_reply(tk, text_with_back("⚠️ 未知遊戲廳"))
+
+@state_route("mt_choose_category", 140, prefix="MT廳:")
+def mt_choose_category(uid, tk, msg, mode):
+    category = msg.replace("MT廳:", "")
+    chat_modes[uid] = {"state": "choose_room", "p": "MT真人"}
+
+    # ── 房間選擇 ──
+    if category == "亞洲廳":
+        line_reply(tk, text_with_back(f"🎲 MT真人 - 亞洲廳\n\n請輸入房號：\n百家樂1~百家樂13、百家樂3A"))
+    elif category == "國際廳":
+        line_reply(tk, text_with_back("🚧 國際廳即將開放，敬請期待！"))
+    else:
+        line_reply(tk, text_with_back("⚠️ 未知遊戲廳"))
+
+@state_route("choose_room", 150)
+def choose_room(uid, tk, msg, mode):
+    room_name = msg.replace("房號:", "").strip()
+    if mode.get("p") == "MT真人":
+        # Normalize: add space after 百家樂 if missing
+        rn = room_name
+        if rn.startswith("百家樂") and len(rn) > 3 and rn[3] != " ":
+            rn = "百家樂 " + rn[3:]
+        room_name = rn
+        mt_valid = [f"百家樂 {i}" for i in range(1, 14)] + ["百家樂 3A"]
+        if room_name not in mt_valid:
+            line_reply(tk, text_with_back("⚠️ MT真人房號格式錯誤\n\n百家樂：百家樂1~百家樂13、百家樂3A"))
+            return
+
+        # ── MT真人：手動輸入模式 ──
+        chat_modes[uid] = {"state": "predicting", "room": room_name}
+        line_reply(tk, text_with_back(f"✅ 已選擇 {room_name}\n\n請輸入開牌結果：\n1(閒) 2(莊) 3(和)"))
+        return
+    # DG → 驗證房號（根據類別限制）
+    rn = room_name.upper()
+    dg_cat = mode.get("cat", "")
+    if dg_cat == "百家樂":
+        dg_valid = [f"RB0{i}" for i in range(1, 8)]
+        if rn not in dg_valid:
+            line_reply(tk, text_with_back("⚠️ 房號格式錯誤\n\n百家樂房號：RB01~RB07"))
+            return
+    elif dg_cat == "性感百家樂":
+        dg_valid = [f"S0{i}" for i in range(1, 8)]
+        if rn not in dg_valid:
+            line_reply(tk, text_with_back("⚠️ 房號格式錯誤\n\n性感百家樂房號：S01~S07"))
+            return
+    else:
+        if rn not in DG_ROOMS:
+            line_reply(tk, text_with_back("⚠️ DG真人房號格式錯誤\n\n百家樂：RB01~RB07\n性感百家樂：S01~S07"))
+            return
+    room_name = rn
+    chat_modes[uid] = {"state": "predicting", "room": room_name}
+    line_reply(tk, text_with_back(f"✅ 已選擇 {room_name}\n\n請輸入開牌結果：\n1(閒) 2(莊) 3(和)"))
+
+@state_route("predicting", 160)
+def predicting(uid, tk, msg, mode):
+    room = mode["room"]
+    new_data = parse_results(msg)
+    print(f"[DEBUG] predicting: msg={msg}, new_data={new_data}")
+    if new_data:
+        submit_results(uid, tk, room, new_data)
+    else:
+        line_reply(tk, sys_bubble("⚠️ 請輸入 1, 2 或 3"))
+
+# --- 儲值 ---
+@command("儲值", 170)
+def topup_entry(uid, tk, msg, mode):
+    chat_modes[uid] = "input_card"
+    line_reply(tk, sys_bubble("請輸入 10 位儲值序號："))
+
+@state_route("input_card", 180)
+def input_card(uid, tk, msg, mode):
+    success, result_msg = use_time_card(uid, msg.upper())
+    chat_modes.pop(uid, None)
+    line_reply(tk, sys_bubble(result_msg))
+
+# ==================== Webhook 入口 ====================
+def handle_event(event):
+    # 處理 follow 事件 (新用戶加入)
+    if event["type"] == "follow":
+        uid = event["source"]["userId"]
+        tk = event["replyToken"]
+        print(f"[FOLLOW] new user: {uid[-6:]}")
         send_main_menu(tk)
+        return
+    if event["type"] != "message" or "text" not in event["message"]:
+        return
+    uid = event["source"]["userId"]
+    tk = event["replyToken"]
+    msg = event["message"]["text"].strip()
+    print(f"[RECV] uid={uid[-6:]}, msg={msg}, mode={chat_modes.get(uid)}")
+
+    # 其他指令前先把合併視窗內的開牌結果落地，維持原本的處理順序
+    if uid in pending_results and not is_result_only(msg):
+        flush_pending_results(uid)
 
+    mode = chat_modes.get(uid)
+    resolve_route(uid, msg, mode)(uid, tk, msg, mode)
+
+def process_events(events):
+    """同步 (Flask) 與非同步 (sv94_asgi) 入口共用的事件處理"""
+    for event in events:
+        try:
+            # 重送的事件在任何狀態變更前直接略過
+            if is_duplicate_event(event):
+                print(f"[DEDUP] skip {event_dedup_key(event)}")
+                continue
+            register_reply_token(event)
+            if should_shed(event):
+                metrics_inc("load_shed")
+                line_reply(event["replyToken"], BUSY_MSG, quick_reply=False)
+                continue
+            try:
+                with session_lock:
+                    profiled_handle_event(event)
+            except BaseException:
+                # 處理失敗：撤銷冪等記錄，LINE 重送 (isRedelivery) 時才會再處理一次，而不是被當成重複丟掉
+                key = event_dedup_key(event)
+                if key is not None:
+                    processed_events.discard(key)
+                    metrics_inc("dedup_released")
+                raise
+        finally:
+            # 入口 (webhook / sv94_asgi) 以 admit() 計入的事件在這裡結清
+            load_governor.done(time.time() - event.get("_received_at", time.time()))
+
+@app.route("/webhook", methods=["POST"])
+@app.route("/webhook/<channel_id>", methods=["POST"])
+def webhook(channel_id=None):
+    # 先看宣告長度，過大的請求不讀本文就拒絕
+    if request.content_length is not None and request.content_length > WEBHOOK_MAX_BYTES:
+        metrics_inc("webhook_too_large")
+        abort(413)
+    body = request.stream.read(WEBHOOK_MAX_BYTES + 1)
+    if len(body) > WEBHOOK_MAX_BYTES:
+        metrics_inc("webhook_too_large")
+        abort(413)
+    events = parse_webhook(body, request.headers.get('X-Line-Signature', ''), channel_id)
+    if events is None:
+        abort(400)
+    load_governor.admit(len(events))
+    process_events(events)
     return jsonify({"status": "ok"})
 
 @app.route("/", methods=["GET"])
@@ -1426,10 +4269,373 @@ def health():
         "service": "sv94-bot"
     })
 
-# gunicorn 啟動時也需要載入資料
-user_access_data = load_data(USER_DATA_FILE)
-time_cards_data = load_data(TIME_CARDS_FILE, {"active_cards": {}, "used_cards": {}})
+def admin_api_authorized():
+    if ADMIN_API_TOKEN:
+        supplied = request.headers.get("X-Admin-Token") or request.args.get("token", "")
+        return hmac.compare_digest(supplied.encode('utf-8'), ADMIN_API_TOKEN.encode('utf-8'))
+    return request.remote_addr in ("127.0.0.1", "::1")
+
+@app.route("/assets/<name>", methods=["GET"])
+def serve_asset(name):
+    # 名稱格式：MT.thumb.<etag>.jpg
+    parts = name.split(".")
+    asset = asset_store.get(".".join(parts[:2])) if len(parts) == 4 else None
+    if not asset:
+        abort(404)
+    resp = Response(asset_body(asset), mimetype="image/jpeg")
+    resp.set_etag(asset["etag"])
+    if parts[2] == asset["etag"]:
+        resp.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    else:
+        # 舊版本網址：回最新內容但不長期快取
+        resp.headers["Cache-Control"] = "public, max-age=3600"
+    return resp.make_conditional(request)
+
+@app.route("/roads/<name>", methods=["GET"])
+def serve_road_image(name):
+    if not _valid_road_name(name):
+        abort(404)
+    png = get_road_image(name)
+    if png is None:
+        # 已被驅逐 (或從未產生)：不依請求內容重畫，避免任何人觸發繪圖與寫檔
+        metrics_inc("road_image_misses")
+        abort(404)
+    resp = Response(png, mimetype="image/png")
+    resp.set_etag(name[:20])
+    # 網址即內容，可以永久快取
+    resp.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    return resp.make_conditional(request)
+
+@app.route("/exports/<name>", methods=["GET"])
+def download_export(name):
+    if not (admin_api_authorized() or export_link_valid(name, request.args.get("exp"), request.args.get("sig"))):
+        abort(403)
+    return send_from_directory(os.path.abspath(EXPORT_DIR), name, as_attachment=True)
+
+@app.route("/ledger/<name>", methods=["GET"])
+def download_ledger(name):
+    """逐局明細串流匯出 (CSV / JSONL)，不在記憶體中組出整份檔案"""
+    if not (admin_api_authorized() or export_link_valid(name, request.args.get("exp"), request.args.get("sig"), route="ledger")):
+        abort(403)
+    parts = name.rsplit(".", 2)
+    if len(parts) != 3 or parts[2] not in ("csv", "jsonl"):
+        abort(404)
+    uid, kind, fmt = parts
+    ledger = find_export_ledger(uid, kind)
+    if ledger is None:
+        abort(404)
+    headers = {"Content-Disposition": f"attachment; filename=ledger_{uid[-8:]}.{fmt}"}
+    if fmt == "csv":
+        return Response(ledger.iter_csv(), mimetype="text/csv", headers=headers)
+    return Response(ledger.iter_jsonl(), mimetype="application/x-ndjson", headers=headers)
+
+@app.route("/admin/slot-feed", methods=["POST"])
+def admin_slot_feed():
+    """上傳機台數據 (CSV 或 JSON)，整批計算後取代目前的排名"""
+    if not admin_api_authorized():
+        abort(403)
+    if (request.content_length or 0) > SLOT_FEED_MAX_BYTES:
+        return jsonify({"status": "too large"}), 413
+    t0 = time.perf_counter()
+    try:
+        rows, rejected = parse_slot_feed(request.get_data(), request.content_type or "")
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({"status": "bad feed", "error": str(e)[:200]}), 400
+    batch = load_slot_feed(rows)
+    elapsed_ms = round((time.perf_counter() - t0) * 1000, 1)
+    print(f"[SLOT] feed loaded: {len(batch)} rows, {rejected} rejected, {elapsed_ms}ms")
+    return jsonify({"status": "ok", "rows": len(batch), "rejected": rejected, "elapsed_ms": elapsed_ms,
+                    "games": {g: len(ix) for g, ix in batch.by_game.items()}})
+
+@app.route("/admin/slot-rank", methods=["GET"])
+def admin_slot_rank():
+    if not admin_api_authorized():
+        abort(403)
+    game = request.args.get("game", "")
+    k = min(max(request.args.get("k", SLOT_TOP_K, type=int), 1), 100)
+    ranked = slot_top_rooms(game, k)
+    if ranked is None:
+        return jsonify({"status": "no feed"}), 404
+    return jsonify({"game": game, "rooms": ranked})
+
+@app.route("/admin/profile", methods=["GET", "POST"])
+def admin_profile():
+    """GET 查看狀態；POST ?seconds=&requests=&mode=sample|cprofile 開始，POST ?stop=1 結束"""
+    if not admin_api_authorized():
+        abort(403)
+    if request.method == "POST":
+        if request.args.get("stop"):
+            stop_profile()
+        else:
+            mode = request.args.get("mode", "sample")
+            if mode not in ("sample", "cprofile"):
+                abort(400)
+            if start_profile(mode, request.args.get("seconds", type=int), request.args.get("requests", type=int)) is None:
+                return jsonify({"status": "busy"}), 409
+    session = profile_session
+    return jsonify({
+        "running": None if session is None else {"id": session["id"], "mode": session["mode"], "seen": session["seen"],
+                                                 "remaining": session["remaining"], "samples": session["samples"]},
+        "last": None if profile_last is None else dict(profile_last, links=[sign_export(n) for n in profile_last["files"]]),
+    })
+
+@app.route("/admin/memory", methods=["GET"])
+def admin_memory():
+    """各狀態結構的估算大小與數量；?top=N 附上最重的 N 位用戶，?trace=start|diff|stop 控制 tracemalloc"""
+    if not admin_api_authorized():
+        abort(403)
+    trace = request.args.get("trace")
+    if trace:
+        if trace not in ("start", "diff", "stop"):
+            abort(400)
+        return jsonify({"trace": memory_trace(trace)})
+    report = memory_report(top=min(request.args.get("top", 10, type=int), 100))
+    report["alerts"] = [text for _, text in memory_alerts(report)]
+    return jsonify(report)
+
+@app.route("/admin/rooms", methods=["GET"])
+def admin_rooms():
+    """所有房間的即時統計；?format=flex 回傳與 LINE【房間總覽】相同的 Flex"""
+    if not admin_api_authorized():
+        abort(403)
+    rows = room_dashboard()
+    if request.args.get("format") == "flex":
+        return jsonify(build_room_dashboard_flex(rows))
+    return jsonify({"generated_at": int(time.time()), "rooms": rows})
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if not admin_api_authorized():
+        abort(403)
+    snap = metrics_snapshot()
+    snap["dedup_cache_size"] = len(processed_events)
+    snap["startup"] = startup_report
+    snap["memory"] = memory_last
+    snap["handoff"] = handoff_report
+    snap["speculation"] = speculation_report(snap) if SPECULATE else None
+    return jsonify(snap)
+
+# ==================== 部署交接 (工作階段快照) ====================
+# 快照：gzip(JSON)，{"v", "saved_at", "byteorder", "partial", "sessions": {uid: 紀錄}, "dedup": [[key, 秒數]]}
+# 每位用戶的紀錄只帶有值的欄位：m 狀態、hr 各房牌路 (連續段 bytes 的 base64；舊版為 h，P/B/T 字串)、t 各房總數 [莊, 閒, 和]、
+# p 獲利追蹤、s 最近一次結算的帳本 (sa 結算時間)、r 待評分的預測 [房間, 下注方]
+# 版本 2 起牌路改存 hr；讀取時兩種欄位都認得，版本 1 的快照照樣載入
+HANDOFF_VERSION = 2
+HANDOFF_READABLE_VERSIONS = (1, 2)
+handoff_report = None   # 本行程載入快照的結果 (/metrics 的 handoff 欄位)
+_handoff_saved = False
+
+def _session_state(uid):
+    rec = {}
+    mode = chat_modes.get(uid)
+    if mode is not None:
+        rec["m"] = mode
+    rooms = baccarat_history_dict.get(uid)
+    if rooms:
+        # 牌路直接存連續段 bytes (base64)；舊版快照的 "h" 是逐局字母，讀取時兩種都接受
+        rec["hr"] = {room: base64.b64encode(v.runs).decode('ascii') for room, v in rooms.items() if isinstance(v, ShoeHistory)}
+        rec["t"] = {room.removesuffix("_total"): [v["莊"], v["閒"], v["和"]] for room, v in rooms.items() if isinstance(v, dict)}
+    pt = profit_tracker.get(uid)
+    if pt:
+        last = pt.get("last_prediction")
+        rec["p"] = {
+            "ledger": pt["ledger"].to_state(),
+            # 下一局損益只用到下注方與注碼單位
+            "last": {k: last[k] for k in ("下注", "注碼單位") if k in last} if last else None,
+            "round_text": pt.get("round_text"),
+            "round_profit": pt.get("round_profit"),
+        }
+    if uid in settled_ledgers:
+        rec["sa"], ledger = settled_ledgers[uid]
+        rec["s"] = ledger.to_state()
+    if uid in room_predictions:
+        rec["r"] = list(room_predictions[uid])
+    return rec
+
+def _restore_session(uid, rec, swap=False):
+    if "m" in rec:
+        chat_modes[uid] = rec["m"]
+    if "h" in rec or "hr" in rec or "t" in rec:
+        rooms = baccarat_history_dict[uid] = {}
+        for room, hist in rec.get("h", {}).items():
+            rooms[room] = ShoeHistory.decode(hist)
+        for room, runs in rec.get("hr", {}).items():
+            rooms[room] = ShoeHistory.from_runs(base64.b64decode(runs))
+        for room, (b, p, t) in rec.get("t", {}).items():
+            rooms[f"{room}_total"] = {"莊": b, "閒": p, "和": t}
+    if "p" in rec:
+        ledger = ProfitLedger.from_state(rec["p"]["ledger"], swap)
+        pt = profit_tracker[uid] = {"unit": ledger.unit, "ledger": ledger, "last_prediction": rec["p"]["last"]}
+        if rec["p"]["round_text"] is not None:
+            pt["round_text"] = rec["p"]["round_text"]
+            pt["round_profit"] = rec["p"]["round_profit"]
+    if "s" in rec:
+        remember_settled_ledger(uid, ProfitLedger.from_state(rec["s"], swap), rec.get("sa"))
+    if "r" in rec:
+        room_predictions[uid] = tuple(rec["r"])
+
+def save_handoff(path=HANDOFF_FILE, budget=HANDOFF_SAVE_BUDGET_SEC):
+    """關機時 (SIGTERM) 呼叫：把進行中的工作階段寫成快照；超過時間預算就只存已處理的用戶"""
+    global _handoff_saved
+    if _handoff_saved:
+        return None
+    _handoff_saved = True
+    import gzip
+    t0 = time.time()
+    deadline = t0 + budget
+    # 排著等上一張卡的結果：在取得 session_lock 之前等行程池回覆，回覆時會順便處理掉
+    for uid in list(deferred_results):
+        wait_analysis(uid, max(deadline - time.time(), 0))
+    if not session_lock.acquire(timeout=max(deadline - time.time(), 0)):
+        print("[HANDOFF] session lock busy, snapshot skipped", flush=True)
+        metrics_inc("handoff_save_failed")
+        return None
+    try:
+        # 合併視窗內的開牌結果先落地 (用原 reply token 回卡)，新行程不必處理
+        for uid in list(pending_results):
+            flush_pending_results(uid)
+        uids = set(chat_modes) | set(baccarat_history_dict) | set(profit_tracker) | set(settled_ledgers)
+        sessions, partial = {}, False
+        for i, uid in enumerate(uids):
+            if i % 1000 == 0 and time.time() > deadline:
+                partial = True
+                break
+            rec = _session_state(uid)
+            if rec:
+                sessions[uid] = rec
+    finally:
+        session_lock.release()
+    snap = {"v": HANDOFF_VERSION, "saved_at": time.time(), "byteorder": sys.byteorder, "partial": partial,
+            "sessions": sessions, "dedup": processed_events.export()}
+    try:
+        payload = gzip.compress(json_dumps_bytes(snap), compresslevel=1)
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"[HANDOFF] save failed: {e}", flush=True)
+        metrics_inc("handoff_save_failed")
+        return None
+    report = {"sessions": len(sessions), "bytes": len(payload), "sec": round(time.time() - t0, 4), "partial": partial}
+    print(f"[HANDOFF] saved {report['sessions']} sessions, {report['bytes'] / 1024:.0f} KB in {report['sec']}s"
+          + (" (partial: budget exceeded)" if partial else ""), flush=True)
+    return report
+
+def load_handoff(path=HANDOFF_FILE, budget=HANDOFF_LOAD_BUDGET_SEC):
+    """接流量前載入上一個行程的快照；已有資料的用戶不覆蓋，載入後改名為 .loaded 避免重複套用"""
+    global handoff_report
+    if not os.path.exists(path):
+        return None
+    import gzip
+    t0 = time.time()
+    deadline = t0 + budget
+    try:
+        with open(path, 'rb') as f:
+            snap = json_loads(gzip.decompress(f.read()))
+    except Exception as e:
+        snap = None
+        print(f"[HANDOFF] unreadable snapshot: {e}", flush=True)
+    try:
+        os.replace(path, path + ".loaded")
+    except OSError:
+        pass
+    if snap is None or snap.get("v") not in HANDOFF_READABLE_VERSIONS:
+        metrics_inc("handoff_load_rejected")
+        return None
+    age = t0 - snap["saved_at"]
+    if age > HANDOFF_MAX_AGE_SEC:
+        print(f"[HANDOFF] snapshot is {age:.0f}s old, ignored", flush=True)
+        metrics_inc("handoff_load_rejected")
+        return None
+    swap = snap.get("byteorder", sys.byteorder) != sys.byteorder
+    loaded, partial = 0, False
+    with session_lock:
+        for i, (uid, rec) in enumerate(snap["sessions"].items()):
+            if i % 1000 == 0 and time.time() > deadline:
+                partial = True
+                break
+            if uid in chat_modes or uid in baccarat_history_dict or uid in profit_tracker:
+                continue
+            _restore_session(uid, rec, swap)
+            loaded += 1
+    processed_events.restore(snap.get("dedup", ()))
+    handoff_report = {"sessions": loaded, "snapshot_age_sec": round(age, 1), "sec": round(time.time() - t0, 4),
+                      "partial": partial or snap.get("partial", False)}
+    metrics_set("handoff_loaded_sessions", loaded)
+    metrics_set("handoff_load_ms", int(handoff_report["sec"] * 1000))
+    print(f"[HANDOFF] loaded {loaded} sessions in {handoff_report['sec']}s "
+          f"(snapshot age {handoff_report['snapshot_age_sec']}s)" + (" (partial)" if handoff_report["partial"] else ""), flush=True)
+    return handoff_report
+
+def _handoff_on_sigterm(signum, frame):
+    save_handoff()
+    sys.exit(0)
+
+# ==================== 啟動 ====================
+def _process_start_time():
+    """由 /proc 取得行程實際啟動時間 (含 Python 與 gunicorn 自身的載入)，取不到就用模組載入時間"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            btime = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return btime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return _IMPORT_STARTED
+
+PROCESS_STARTED = _process_start_time()
+startup_report = {
+    "import_sec": round(time.time() - _IMPORT_STARTED, 4),
+    "data_load_sec": round(_DATA_LOAD_SEC, 4),
+    "process_to_ready_sec": round(time.time() - PROCESS_STARTED, 4),
+    "first_reply_sec": None,
+    # 牌路 (大路 / 衍生路) 用整靴，AI 只看最後 ai_window_hands 局
+    "shoe_analysis": {"roads": "full_shoe", "shoe_max_hands": SHOE_MAX_HANDS, "ai_window_hands": AI_WINDOW_HANDS},
+}
+_first_reply_lock = threading.Lock()
+
+def record_first_reply():
+    """行程啟動到第一次成功回覆的時間 (喚醒後最關鍵的延遲)"""
+    if startup_report["first_reply_sec"] is not None:
+        return
+    with _first_reply_lock:
+        if startup_report["first_reply_sec"] is None:
+            startup_report["first_reply_sec"] = round(time.time() - PROCESS_STARTED, 4)
+            metrics_set("startup_first_reply_sec", startup_report["first_reply_sec"])
+            print(f"[BOOT] first reply {startup_report['first_reply_sec']}s after process start", flush=True)
+
+def _warm_line_connection():
+    for channel in list(line_channels.values()):
+        try:
+            channel.http.get("https://api.line.me/v2/bot/info", headers=channel.headers, timeout=10)
+        except Exception as e:
+            print(f"[BOOT] warm-up failed ({channel.id}): {e}")
+
+def start_background_workers():
+    """背景執行緒與連線預熱；--preload 時在 worker fork 之後才呼叫 (見 gunicorn.conf.py)"""
+    start_analysis_pool()
+    start_expiry_sweeper()
+    start_card_compactor()
+    start_memory_checker()
+    start_speculator()
+    if ROAD_IMAGE:
+        threading.Thread(target=_evict_road_disk, name="road-disk-scan", daemon=True).start()
+    resume_broadcast_jobs()
+    if os.environ.get("WARM_CONNECTIONS", "1") == "1":
+        threading.Thread(target=_warm_line_connection, name="warm-up", daemon=True).start()
+
+metrics_set("startup_import_sec", startup_report["import_sec"])
+print(f"[BOOT] ready: import={startup_report['import_sec']}s data={startup_report['data_load_sec']}s "
+      f"process={startup_report['process_to_ready_sec']}s", flush=True)
+print(f"[BOOT] shoe: roads use up to {SHOE_MAX_HANDS} hands, AI sees last {AI_WINDOW_HANDS}", flush=True)
+
+if os.environ.get("SV94_DEFER_WORKERS") != "1":
+    load_handoff()
+    start_background_workers()
 
 if __name__ == "__main__":
+    # 直接執行 (開發伺服器) 時自行處理 SIGTERM；gunicorn / uvicorn 由各自的關機流程呼叫 save_handoff
+    signal.signal(signal.SIGTERM, _handoff_on_sigterm)
     print("=== SV94 Bot 啟動成功 (port 5001) ===")
     app.run(host="0.0.0.0", port=5001)
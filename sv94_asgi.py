@@ -0,0 +1,252 @@
+"""
+sv94 的 ASGI 入口 (非同步模式)
+
+    uvicorn sv94_asgi:app --host 0.0.0.0 --port 10000
+
+與 Flask 版共用同一套狀態機與渲染 (sv94.process_events / handle_event)，差別在於：
+- webhook 驗簽、解析後立即回 200，事件交給單一工作執行緒依序處理
+- 對 LINE 的呼叫改由事件迴圈上的 httpx.AsyncClient 發送 (每個頻道一個 client，連線池各自有上限)，
+  工作執行緒把請求排進事件迴圈就返回，不必等待網路往返
+- 其他路由 (/assets、/exports、/metrics…) 轉交 Flask WSGI app 處理
+"""
+import asyncio
+import io
+import os
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import sv94
+
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", "100"))
+ASYNC_MAX_INFLIGHT = int(os.environ.get("ASYNC_MAX_INFLIGHT", "5000"))
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS", "4"))
+WSGI_CHUNK_BYTES = int(os.environ.get("WSGI_CHUNK_BYTES", str(64 * 1024)))
+
+# 狀態機只用一條執行緒：同一用戶的事件維持到達順序，行為與同步版一致
+event_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="events")
+wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="wsgi")
+
+_loop = None
+_clients = {}         # 頻道 id -> httpx.AsyncClient；其他頻道第一次送出時才建立
+_make_client = None   # 建立 client 的函式；startup() 注入 client (壓測) 時為 None，所有頻道共用注入的那個
+_inflight = None      # asyncio.Semaphore：同時在途的 LINE 請求上限
+_pending = set()      # 尚未完成的對外請求 (關機與壓測時等待用)
+
+
+# ==================== 對外請求 ====================
+def _client_for(channel):
+    """只在事件迴圈上呼叫，不需要鎖"""
+    client = _clients.get(channel.id)
+    if client is None:
+        client = _clients[channel.id] = _make_client() if _make_client else _clients[sv94.DEFAULT_CHANNEL_ID]
+    return client
+
+
+async def _send(path, body, headers, on_result, channel):
+    async with _inflight:
+        try:
+            resp = await _client_for(channel).post(f"{sv94.LINE_API_BASE}/{path}", headers=headers, content=body)
+            status, text = resp.status_code, resp.text
+        except Exception as e:
+            status, text = None, str(e)
+    on_result(status, text)
+
+
+def async_transport(path, body, headers, on_result, channel=None):
+    """由工作執行緒呼叫：把請求排進事件迴圈後立即返回"""
+    channel = channel or sv94.default_channel
+    fut = asyncio.run_coroutine_threadsafe(_send(path, body, headers, on_result, channel), _loop)
+    _pending.add(fut)
+    fut.add_done_callback(_pending.discard)
+
+
+async def drain():
+    """等所有已排入的事件與對外請求完成"""
+    await _loop.run_in_executor(event_executor, lambda: None)
+    while _pending:
+        await asyncio.gather(*(asyncio.wrap_future(f) for f in list(_pending)), return_exceptions=True)
+
+
+async def startup(client=None):
+    global _loop, _make_client, _inflight
+    _loop = asyncio.get_running_loop()
+    _inflight = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+    _make_client = None
+    if client is None:
+        import httpx
+        _make_client = lambda: httpx.AsyncClient(timeout=30, limits=httpx.Limits(
+            max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=ASYNC_MAX_CONNECTIONS))
+        client = _make_client()
+    _clients.clear()
+    _clients[sv94.DEFAULT_CHANNEL_ID] = client
+    sv94.line_transport = async_transport
+    print(f"[ASGI] ready: max_connections={ASYNC_MAX_CONNECTIONS}", flush=True)
+
+
+async def shutdown():
+    await drain()
+    # 快照在事件執行緒上寫，與事件處理不會交錯；合併視窗落地時送出的回覆再等一次
+    await _loop.run_in_executor(event_executor, sv94.save_handoff)
+    await drain()
+    sv94.line_transport = None
+    for client in {id(c): c for c in _clients.values()}.values():
+        if hasattr(client, "aclose"):
+            await client.aclose()
+    _clients.clear()
+
+
+# ==================== Webhook ====================
+def _run_events(events):
+    try:
+        sv94.process_events(events)
+    except Exception:
+        traceback.print_exc()
+
+
+async def _read_body(receive, limit=None):
+    """讀取請求本文；超過 limit 時回傳 None (不再繼續累積)"""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if limit is not None and size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _respond(send, status, body, content_type=b"application/json"):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _webhook(scope, receive, send, channel_id=None):
+    signature = ""
+    for name, value in scope["headers"]:
+        if name == b"x-line-signature":
+            signature = value.decode("latin-1")
+        elif name == b"content-length":
+            try:
+                length = int(value)
+            except ValueError:
+                sv94.metrics_inc("webhook_bad_length")
+                await _respond(send, 400, b'{"status": "bad request"}')
+                return
+            if length > sv94.WEBHOOK_MAX_BYTES:
+                sv94.metrics_inc("webhook_too_large")
+                await _respond(send, 413, b'{"status": "too large"}')
+                return
+    body = await _read_body(receive, sv94.WEBHOOK_MAX_BYTES)
+    if body is None:
+        sv94.metrics_inc("webhook_too_large")
+        await _respond(send, 413, b'{"status": "too large"}')
+        return
+    events = sv94.parse_webhook(body, signature, channel_id)
+    if events is None:
+        await _respond(send, 400, b'{"status": "bad request"}')
+        return
+    # 依序排入工作執行緒；不等待處理完成，避免 LINE 因逾時而重送
+    sv94.load_governor.admit(len(events))
+    _loop.run_in_executor(event_executor, _run_events, events)
+    await _respond(send, 200, b'{"status": "ok"}')
+
+
+# ==================== 其他路由：轉交 Flask ====================
+def _wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("127.0.0.1", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0], "SERVER_PORT": str(server[1]),
+        "REMOTE_ADDR": client[0],
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0), "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body), "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True, "wsgi.multiprocess": False, "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+def _start_wsgi(environ):
+    """執行 Flask 並取出第一段內容：start_response 可能延到第一次迭代才呼叫，取到後狀態與標頭才確定"""
+    out = {}
+
+    def start_response(status, headers, exc_info=None):
+        out["status"], out["headers"] = int(status.split()[0]), headers
+
+    result = sv94.app(environ, start_response)
+    chunks = iter(result)
+    try:
+        first = _next_chunks(chunks)
+    except BaseException:
+        _close_wsgi(result)
+        raise
+    return out["status"], out["headers"], result, chunks, first
+
+
+def _next_chunks(chunks):
+    """合併小段落到 WSGI_CHUNK_BYTES 左右再送，減少執行緒往返；迭代結束回傳 None"""
+    buf, size = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= WSGI_CHUNK_BYTES:
+            break
+    return b"".join(buf) if buf else None
+
+
+def _close_wsgi(result):
+    if hasattr(result, "close"):
+        result.close()
+
+
+async def _wsgi(scope, receive, send):
+    body = await _read_body(receive)
+    status, headers, result, chunks, payload = await _loop.run_in_executor(
+        wsgi_executor, _start_wsgi, _wsgi_environ(scope, body))
+    try:
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]})
+        # 逐段轉送 WSGI 迭代器 (帳本匯出等大型回應不整份留在記憶體)
+        while payload is not None:
+            await send({"type": "http.response.body", "body": payload, "more_body": True})
+            payload = await _loop.run_in_executor(wsgi_executor, _next_chunks, chunks)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        await _loop.run_in_executor(wsgi_executor, _close_wsgi, result)
+
+
+# ==================== ASGI 進入點 ====================
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    path = scope["path"]
+    if scope["method"] == "POST" and path == "/webhook":
+        await _webhook(scope, receive, send)
+    elif scope["method"] == "POST" and path.startswith("/webhook/") and "/" not in path[9:]:
+        await _webhook(scope, receive, send, path[9:])
+    else:
+        await _wsgi(scope, receive, send)
@@ -0,0 +1,17 @@
+"""
+測試共用設定：與 bench.py 相同，關閉合併視窗與背景執行緒，在暫存目錄讀寫資料檔後才匯入 sv94
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("COALESCE_WINDOW_SEC", "0")
+os.environ.setdefault("SV94_DEFER_WORKERS", "1")
+os.environ.setdefault("WARM_CONNECTIONS", "0")
+os.chdir(tempfile.mkdtemp(prefix="sv94-test-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import sv94  # noqa: E402,F401
@@ -0,0 +1,25 @@
+import asyncio
+
+import sv94_asgi
+
+
+def _post(headers, body=b"{}"):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/webhook", "headers": headers}
+    asyncio.run(sv94_asgi.app(scope, receive, send))
+    return sent[0]["status"]
+
+
+def test_malformed_content_length_is_bad_request():
+    assert _post([(b"content-length", b"abc"), (b"x-line-signature", b"x")]) == 400
+
+
+def test_oversized_content_length_is_rejected():
+    assert _post([(b"content-length", str(sv94_asgi.sv94.WEBHOOK_MAX_BYTES + 1).encode())]) == 413
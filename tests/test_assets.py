@@ -0,0 +1,17 @@
+import sv94
+
+
+def test_assets_render_lazily_and_fall_back_on_bad_source():
+    """縮圖在第一次請求時才產生；原圖損毀時送出原始 bytes，而不是讓請求失敗"""
+    asset = sv94.asset_store["MT.thumb"]
+    assert asset["body"] is None or isinstance(asset["body"], bytes)
+    resp = sv94.app.test_client().get(sv94.asset_url("MT", "thumb").removeprefix(sv94.BASE_URL))
+    assert resp.status_code == 200 and resp.data == asset["body"]
+
+    broken = {"src": b"not a jpeg", "px": 120, "etag": "0" * 16, "body": None}
+    sv94.asset_store["BAD.thumb"] = broken
+    try:
+        resp = sv94.app.test_client().get(f"/assets/BAD.thumb.{'0' * 16}.jpg")
+        assert resp.status_code == 200 and resp.data == b"not a jpeg"
+    finally:
+        del sv94.asset_store["BAD.thumb"]
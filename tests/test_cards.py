@@ -0,0 +1,29 @@
+import sv94
+
+
+def _codes_to_bytes(code):
+    """os.urandom 的替身輸出：每個 byte 經 _CARD_TABLE 轉回 code 的對應字母"""
+    return bytes(sv94.CARD_ALPHABET.index(c) for c in code)
+
+
+def test_mint_skips_archived_used_codes(monkeypatch):
+    """序號使用後被歸檔到冷檔，再產生新序號時仍不能與它相同"""
+    sv94.time_cards_data.clear()
+    sv94.time_cards_data.update({"active_cards": {}, "used_cards": {}})
+    _, codes, _ = sv94.mint_cards("1H", 1)
+    code = codes[0]
+    ok, _ = sv94.use_time_card("Utest", code)
+    assert ok
+    assert sv94.compact_used_cards() == 1
+    assert code not in sv94.time_cards_data["used_cards"]
+    assert sv94.find_card(code)[0] == "archived"
+
+    # 第一次抽到已歸檔的序號，第二次才是新的
+    fresh = "A" * sv94.CARD_CODE_LEN
+    draws = iter([_codes_to_bytes(code), _codes_to_bytes(fresh)])
+    real_urandom = sv94.os.urandom
+    # batch_id 的 uuid4 也用 os.urandom，只替換產生序號的那幾次
+    monkeypatch.setattr(sv94.os, "urandom", lambda n: next(draws) if n == sv94.CARD_CODE_LEN else real_urandom(n))
+    _, minted, _ = sv94.mint_cards("1H", 1)
+    assert minted == [fresh]
+    assert sv94.find_card(code)[0] == "archived"
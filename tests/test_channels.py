@@ -0,0 +1,53 @@
+import base64
+import hashlib
+import hmac
+import json
+
+import pytest
+
+import sv94
+
+
+@pytest.fixture
+def tenant(monkeypatch):
+    channel = sv94.LineChannel("t1", "token", "tenant-secret", destination="Utenantbot", admins=["Utenantadmin"])
+    monkeypatch.setitem(sv94.line_channels, "t1", channel)
+    monkeypatch.setitem(sv94.channels_by_destination, "Utenantbot", channel)
+    return channel
+
+
+def _sign(body, secret):
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+
+def test_tenant_admin_is_scoped_to_own_channel(tenant):
+    admin = "t1:Utenantadmin"
+    assert sv94.is_admin(admin)
+    assert admin not in sv94.ADMIN_UIDS
+    assert not sv94.is_admin("Utenantadmin")         # 同一個 LINE uid 在預設頻道不是管理員
+    assert sv94.resolve_route(admin, "公告 hi", None) is sv94.admin_announce
+    for msg in ("查詢序號 ABC", "推播狀態", "效能分析", "記憶體"):
+        assert sv94.resolve_route(admin, msg, None) not in sv94.admin_routes.values()
+        assert sv94.resolve_route(sv94.ADMIN_UIDS[0], msg, None) in sv94.admin_routes.values()
+
+
+def test_path_channel_is_verified_before_parsing(tenant):
+    before = dict(sv94.metrics)
+    assert sv94.parse_webhook(b"not json", _sign(b"not json", "wrong"), "t1") is None
+    assert sv94.metrics["webhook_bad_signature"] == before.get("webhook_bad_signature", 0) + 1
+    assert sv94.metrics.get("webhook_bad_json", 0) == before.get("webhook_bad_json", 0)
+    assert sv94.parse_webhook(b"not json", _sign(b"not json", "tenant-secret"), "t1") is None
+    assert sv94.metrics["webhook_bad_json"] == before.get("webhook_bad_json", 0) + 1
+
+
+def test_unparsable_body_without_path_is_unauthenticated():
+    before = sv94.metrics.get("webhook_bad_signature", 0)
+    assert sv94.parse_webhook(b"[1", "sig") is None
+    assert sv94.metrics["webhook_bad_signature"] == before + 1
+
+
+def test_destination_routes_to_tenant(tenant):
+    body = json.dumps({"destination": "Utenantbot", "events": [{"type": "follow", "source": {"userId": "Ux"}}]}).encode()
+    events = sv94.parse_webhook(body, _sign(body, "tenant-secret"))
+    assert events[0]["source"]["userId"] == "t1:Ux" and events[0]["_channel"] == "t1"
+    assert sv94.parse_webhook(body, _sign(body, "tenant-secret"), sv94.DEFAULT_CHANNEL_ID) is None
@@ -0,0 +1,32 @@
+import pytest
+
+import sv94
+
+
+def _event(i):
+    return {"type": "message", "webhookEventId": f"dedup-{i}", "replyToken": f"tk-dedup-{i}",
+            "source": {"userId": "Udedup"}, "message": {"id": f"m-dedup-{i}", "type": "text", "text": "UID"}}
+
+
+def test_failed_event_is_processed_again_on_redelivery(monkeypatch):
+    calls = []
+
+    def boom(event):
+        calls.append(event["webhookEventId"])
+        raise RuntimeError("handler failed")
+
+    monkeypatch.setattr(sv94, "handle_event", boom)
+    with pytest.raises(RuntimeError):
+        sv94.process_events([_event(1)])
+    redelivered = dict(_event(1), deliveryContext={"isRedelivery": True})
+    with pytest.raises(RuntimeError):
+        sv94.process_events([redelivered])
+    assert calls == ["dedup-1", "dedup-1"]
+
+
+def test_handled_event_is_still_deduplicated(monkeypatch):
+    calls = []
+    monkeypatch.setattr(sv94, "handle_event", lambda event: calls.append(event["webhookEventId"]))
+    sv94.process_events([_event(2)])
+    sv94.process_events([_event(2)])
+    assert calls == ["dedup-2"]
@@ -0,0 +1,25 @@
+import time
+
+import sv94
+
+
+def test_sweep_marks_under_lock_and_does_not_push_by_default(monkeypatch):
+    assert sv94.EXPIRY_NOTIFY is False
+    sent, saved = [], []
+    monkeypatch.setattr(sv94, "send_line_request", lambda *a, **kw: sent.append(a))
+    monkeypatch.setattr(sv94, "start_broadcast", lambda *a, **kw: sent.append(a))
+    monkeypatch.setattr(sv94, "save_data", lambda path, data: saved.append(sv94.user_data_lock._is_owned()))
+    now = int(time.time())
+    uid = "Uexpiry"
+    sv94.user_access_data[uid] = {"expiry_date": "", "expiry_ts": now + 60}
+    sv94.set_user_expiry(uid, now + 60)
+    try:
+        soon, expired = sv94.sweep_expiries(now)
+        assert uid in soon and sv94.user_access_data[uid]["expiry_notified"] == "soon"
+        assert saved and all(saved)
+        assert sent == []
+    finally:
+        sv94.user_access_data.pop(uid, None)
+        sv94.expiry_notified.pop(uid, None)
+        sv94._index_remove(uid)
+        sv94.user_expiry_ts.pop(uid, None)
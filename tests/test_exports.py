@@ -0,0 +1,83 @@
+import asyncio
+
+import sv94
+import sv94_asgi
+
+
+def _path(url):
+    return url[len(sv94.BASE_URL):]
+
+
+def _ledger(*rounds):
+    ledger = sv94.ProfitLedger(100)
+    for side, result in rounds:
+        ledger.record("R1", side, 1, result)
+    return ledger
+
+
+def test_settled_link_serves_settled_ledger_after_restart():
+    """結算後立刻重新開始追蹤：報表裡的連結仍要下載到結算的那本，而不是新的空帳本"""
+    uid = "Uexport"
+    sv94.settled_ledgers.clear()
+    settled_at = sv94.remember_settled_ledger(uid, _ledger(("莊", "莊"), ("閒", "莊")))
+    csv_url, _ = sv94.ledger_export_links(uid, settled_at)
+    sv94.profit_tracker[uid] = {"unit": 100, "ledger": _ledger(), "last_prediction": None}
+    try:
+        client = sv94.app.test_client()
+        rows = client.get(_path(csv_url)).get_data(as_text=True).strip().splitlines()
+        assert len(rows) == 3  # 標題 + 兩局
+
+        active_csv, _ = sv94.ledger_export_links(uid)
+        assert client.get(_path(active_csv)).get_data(as_text=True).strip().count("\n") == 0
+
+        # 再結算一次後，舊連結指向的帳本已不存在
+        sv94.remember_settled_ledger(uid, _ledger(("莊", "閒")), settled_at + 1)
+        assert client.get(_path(csv_url)).status_code == 404
+    finally:
+        sv94.profit_tracker.pop(uid, None)
+        sv94.settled_ledgers.clear()
+
+
+def test_settled_ledgers_are_pruned(monkeypatch):
+    sv94.settled_ledgers.clear()
+    monkeypatch.setattr(sv94, "SETTLED_LEDGERS_MAX", 2)
+    now = 1_000_000
+    sv94.remember_settled_ledger("Uold", _ledger(), now - sv94.EXPORT_LINK_TTL_SEC)
+    sv94.remember_settled_ledger("Ua", _ledger(), now)
+    assert list(sv94.settled_ledgers) == ["Ua"]
+    sv94.remember_settled_ledger("Ub", _ledger(), now)
+    sv94.remember_settled_ledger("Uc", _ledger(), now)
+    assert list(sv94.settled_ledgers) == ["Ub", "Uc"]
+    sv94.settled_ledgers.clear()
+
+
+def test_asgi_streams_wsgi_response(monkeypatch):
+    """ASGI 模式逐段轉送 Flask 的回應，而不是整份接起來才送"""
+    monkeypatch.setattr(sv94_asgi, "WSGI_CHUNK_BYTES", 10)
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    uid = "Ustream"
+    sv94.profit_tracker[uid] = {"unit": 100, "ledger": _ledger(*[("莊", "閒")] * 20), "last_prediction": None}
+    try:
+        csv_url, _ = sv94.ledger_export_links(uid)
+        path, _, query = _path(csv_url).partition("?")
+
+        async def run():
+            sv94_asgi._loop = asyncio.get_running_loop()
+            scope = {"type": "http", "method": "GET", "path": path, "query_string": query.encode(), "headers": []}
+            await sv94_asgi.app(scope, receive, send)
+
+        asyncio.run(run())
+    finally:
+        sv94.profit_tracker.pop(uid, None)
+    assert sent[0]["status"] == 200
+    bodies = [m for m in sent[1:] if m["type"] == "http.response.body"]
+    assert len(bodies) > 2 and bodies[-1] == {"type": "http.response.body", "body": b""}
+    text = b"".join(m["body"] for m in bodies).decode()
+    assert text.strip().count("\n") == 20
@@ -0,0 +1,43 @@
+import gzip
+import json
+import time
+
+import pytest
+
+import sv94
+
+
+def _write_snapshot(path, version, sessions):
+    snap = {"v": version, "saved_at": time.time(), "byteorder": "little", "partial": False, "sessions": sessions}
+    path.write_bytes(gzip.compress(json.dumps(snap).encode()))
+
+
+@pytest.fixture
+def clean_sessions():
+    yield
+    for uid in ("Uhand1", "Uhand2"):
+        sv94.chat_modes.pop(uid, None)
+        sv94.baccarat_history_dict.pop(uid, None)
+
+
+def test_v1_snapshot_with_string_history_still_loads(tmp_path, clean_sessions):
+    path = tmp_path / "handoff.json.gz"
+    _write_snapshot(path, 1, {"Uhand1": {"m": "choose_provider", "h": {"百家樂 1": "BPT"}, "t": {"百家樂 1": [1, 1, 1]}}})
+    assert sv94.load_handoff(str(path))["sessions"] == 1
+    assert sv94.baccarat_history_dict["Uhand1"]["百家樂 1"] == sv94.ShoeHistory.decode("BPT")
+
+
+def test_current_version_round_trip_and_unknown_version(tmp_path, monkeypatch, clean_sessions):
+    path = tmp_path / "handoff.json.gz"
+    monkeypatch.setattr(sv94, "_handoff_saved", False)
+    sv94.chat_modes["Uhand2"] = {"state": "predicting", "room": "百家樂 2"}
+    sv94.baccarat_history_dict["Uhand2"] = {"百家樂 2": sv94.ShoeHistory.decode("BBPPT")}
+    sv94.save_handoff(str(path))
+    assert json.loads(gzip.decompress(path.read_bytes()))["v"] == sv94.HANDOFF_VERSION == 2
+    sv94.chat_modes.pop("Uhand2")
+    sv94.baccarat_history_dict.pop("Uhand2")
+    assert sv94.load_handoff(str(path))["sessions"] >= 1
+    assert sv94.baccarat_history_dict["Uhand2"]["百家樂 2"] == sv94.ShoeHistory.decode("BBPPT")
+
+    _write_snapshot(path, 99, {})
+    assert sv94.load_handoff(str(path)) is None
@@ -0,0 +1,32 @@
+import sv94
+
+
+def _text(msg, uid="Uload"):
+    return {"type": "message", "source": {"userId": uid}, "message": {"type": "text", "text": msg}}
+
+
+def test_tier_recovers_without_new_events(monkeypatch):
+    """尖峰過後不再有事件：層級仍依時間逐級降回"""
+    clock = [1000.0]
+    monkeypatch.setattr(sv94.time, "monotonic", lambda: clock[0])
+    gov = sv94.LoadGovernor(queue_steps=[10, 20, 30, 40], latency_steps=[1, 2, 3, 4], recover_sec=10)
+    gov.admit()
+    gov.done(8.0)
+    assert gov.tier == sv94.LoadGovernor.MAX_TIER
+    seen = []
+    for _ in range(20):
+        clock[0] += 10
+        seen.append(gov.tier)
+    assert seen[-1] == 0
+    assert seen == sorted(seen, reverse=True)
+    assert gov.latency < 0.5
+
+
+def test_shed_only_allowlisted_commands(monkeypatch):
+    monkeypatch.setattr(sv94.load_governor, "_tier", sv94.LoadGovernor.MAX_TIER)
+    monkeypatch.setattr(sv94.load_governor, "_evaluated_at", float("inf"))
+    assert sv94.should_shed(_text("uid"))
+    assert sv94.should_shed(_text("房間總覽"))
+    for msg in ("返回主選單", "百家預測", "平台:MT", "隨便打字"):
+        assert not sv94.should_shed(_text(msg))
+    assert not sv94.should_shed({"type": "follow", "source": {"userId": "Uload"}})
@@ -0,0 +1,23 @@
+"""
+固定腳本的對話回放 (bench.py replay) 與 tests/fixtures/replay.jsonl 逐則比對；
+有意改變回覆時依 bench_replay 的說明重新錄製
+"""
+import os
+
+import sv94
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "replay.jsonl")
+
+
+def test_replay_matches_recording(monkeypatch):
+    monkeypatch.chdir(os.getcwd())   # 匯入 bench 會切換到它自己的暫存目錄
+    import bench
+    monkeypatch.setattr(sv94, "ROAD_IMAGE", False)
+    monkeypatch.setattr(sv94.line_http, "post", sv94.line_http.post)
+    monkeypatch.setattr(sv94, "load_governor", sv94.load_governor)
+    with open(FIXTURE, encoding="utf-8") as f:
+        expected = f.read().splitlines()
+    lines = bench.replay_conversations()
+    for i, (want, got) in enumerate(zip(expected, lines)):
+        assert got == want, f"#{i} {bench.REPLAY_SCRIPT[i][1]!r}"
+    assert len(lines) == len(expected)
@@ -0,0 +1,32 @@
+import time
+
+import sv94
+
+
+def _reply_with_age(monkeypatch, age, status=200, text="{}"):
+    sent = []
+    monkeypatch.setattr(sv94, "line_transport", lambda path, body, headers, cb, ch: (sent.append(path), cb(status, text)))
+    tk = f"tk-late-{age}-{status}"
+    sv94.register_reply_token({"replyToken": tk, "source": {"userId": "Ulate"}, "_received_at": time.time() - age})
+    sv94.line_reply(tk, "hi")
+    return sent
+
+
+def test_late_token_is_counted_without_fallback(monkeypatch):
+    assert sv94.REPLY_PUSH_FALLBACK is False
+    before = sv94.metrics.get("line_reply_late", 0)
+    assert _reply_with_age(monkeypatch, sv94.REPLY_TOKEN_TTL_SEC) == ["reply"]
+    assert sv94.metrics["line_reply_late"] == before + 1
+    assert _reply_with_age(monkeypatch, 0) == ["reply"]
+    assert sv94.metrics["line_reply_late"] == before + 1
+
+
+def test_invalid_token_is_counted_without_fallback(monkeypatch):
+    before = sv94.metrics.get("line_reply_token_invalid", 0)
+    assert _reply_with_age(monkeypatch, 0, 400, '{"message":"Invalid reply token"}') == ["reply"]
+    assert sv94.metrics["line_reply_token_invalid"] == before + 1
+
+
+def test_late_token_is_pushed_with_fallback(monkeypatch):
+    monkeypatch.setattr(sv94, "REPLY_PUSH_FALLBACK", True)
+    assert _reply_with_age(monkeypatch, sv94.REPLY_TOKEN_TTL_SEC) == ["push"]
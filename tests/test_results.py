@@ -0,0 +1,60 @@
+import threading
+
+import sv94
+
+
+def _run(monkeypatch, uid, messages, coalesce):
+    monkeypatch.setattr(sv94, "line_reply", lambda *a, **kw: None)
+    base = ["莊", "閒", "莊", "莊", "閒", "和", "閒", "莊"] * 4
+    sv94.baccarat_history_dict[uid] = {"百家樂 1": sv94.ShoeHistory(base)}
+    ledger = sv94.ProfitLedger(100)
+    sv94.profit_tracker[uid] = {"unit": 100, "ledger": ledger, "last_prediction": None}
+    try:
+        with sv94.session_lock:
+            sv94.process_results(uid, "tk0", "百家樂 1", ["莊"])
+            if coalesce:
+                flat = [r for m in messages for r in m]
+                sv94.process_results(uid, "tk1", "百家樂 1", flat, [list(m) for m in messages])
+            else:
+                for m in messages:
+                    sv94.process_results(uid, "tk1", "百家樂 1", list(m))
+        return ledger.to_state(), sv94.baccarat_history_dict[uid]["百家樂 1"].encode()
+    finally:
+        sv94.profit_tracker.pop(uid, None)
+        sv94.baccarat_history_dict.pop(uid, None)
+        sv94.room_predictions.pop(uid, None)
+
+
+def test_coalesced_results_score_like_separate_messages(monkeypatch):
+    """合併視窗內的每則訊息都對照「沒有合併時那一則會看到的預測」計算損益"""
+    messages = [["閒"], ["閒", "莊"], ["和"], ["莊"], ["閒"]]
+    assert _run(monkeypatch, "Ucoal1", messages, True) == _run(monkeypatch, "Ucoal2", messages, False)
+
+
+def _lock_free():
+    """從另一條執行緒看 session_lock 是否空著 (RLock 在持有的執行緒內一定拿得到)"""
+    out = []
+
+    def probe():
+        ok = sv94.session_lock._lock.acquire(blocking=False)
+        if ok:
+            sv94.session_lock._lock.release()
+        out.append(ok)
+
+    t = threading.Thread(target=probe)
+    t.start()
+    t.join()
+    return out[0]
+
+
+def test_line_sends_wait_until_lock_is_released(monkeypatch):
+    """同步模式的 HTTPS 往返不能在 session_lock 內進行"""
+    sent = []
+    monkeypatch.setattr(sv94, "line_transport", lambda path, body, headers, cb, ch: sent.append((path, _lock_free())))
+    with sv94.session_lock:
+        with sv94.session_lock:
+            sv94.send_line_request("reply", {"replyToken": "t", "messages": []}, lambda *a: None)
+        assert sent == []
+    assert sent == [("reply", True)]
+    sv94.send_line_request("push", {"to": "U", "messages": []}, lambda *a: None)
+    assert sent[-1] == ("push", True)
@@ -0,0 +1,67 @@
+import os
+
+import sv94
+
+
+def _write(path, name, size, mtime):
+    full = os.path.join(path, name)
+    with open(full, "wb") as f:
+        f.write(b"\0" * size)
+    os.utime(full, (mtime, mtime))
+
+
+def test_evict_seeds_estimate_and_removes_oldest(tmp_path, monkeypatch):
+    monkeypatch.setattr(sv94, "ROAD_IMAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(sv94, "ROAD_IMAGE_DISK_MB", 1)
+    monkeypatch.setattr(sv94, "_road_disk_bytes", None)
+    for i in range(4):
+        _write(tmp_path, f"{i:020x}.png", 400 * 1024, 1000 + i)
+    real_scan = sv94._scan_road_disk
+
+    def scan():
+        assert not sv94.road_image_lock.locked()   # 掃描目錄時不能擋住其他執行緒取圖
+        return real_scan()
+
+    monkeypatch.setattr(sv94, "_scan_road_disk", scan)
+    sv94._evict_road_disk()
+    assert sorted(os.listdir(tmp_path)) == [f"{2:020x}.png", f"{3:020x}.png"]
+    assert sv94._road_disk_bytes == 800 * 1024
+
+
+def test_missing_directory_and_vanished_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(sv94, "ROAD_IMAGE_DIR", str(tmp_path / "missing"))
+    monkeypatch.setattr(sv94, "_road_disk_bytes", None)
+    sv94._evict_road_disk()
+    assert sv94._road_disk_bytes == 0
+
+    # 掃描之後、刪除之前檔案已被其他行程刪掉
+    monkeypatch.setattr(sv94, "ROAD_IMAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(sv94, "ROAD_IMAGE_DISK_MB", 0)
+    monkeypatch.setattr(sv94, "_scan_road_disk", lambda: [(1.0, 10, str(tmp_path / "gone.png"))])
+    sv94._evict_road_disk()
+    assert sv94._road_disk_bytes == 0
+
+
+def test_road_url_is_opaque_and_misses_are_not_rerendered(tmp_path, monkeypatch):
+    monkeypatch.setattr(sv94, "ROAD_IMAGE_DIR", str(tmp_path))
+    hist = "BBPPTB"
+    name = sv94.road_fingerprint(hist) + ".png"
+    assert sv94._valid_road_name(name)
+    assert name[:20] != sv94.hashlib.sha1(f"{sv94.ROAD_IMAGE_VERSION}:{hist}".encode()).hexdigest()[:20]
+    monkeypatch.setattr(sv94, "render_road_png", lambda *a, **kw: b"png")
+    url = sv94.road_image_url({"hist": hist, "grid": None, "derived": None})
+    assert url == f"{sv94.BASE_URL}/roads/{name}" and hist not in url
+
+    client = sv94.app.test_client()
+    assert client.get(f"/roads/{name}").data == b"png"
+    sv94.road_image_cache.clear()
+    os.remove(os.path.join(tmp_path, name))
+    # 快取沒有就 404，不依網址參數重畫
+    assert client.get(f"/roads/{name}?h={hist}").status_code == 404
+
+
+def test_metrics_startup_reports_ai_window(monkeypatch):
+    monkeypatch.setattr(sv94, "admin_api_authorized", lambda: True)
+    startup = sv94.app.test_client().get("/metrics").get_json()["startup"]
+    assert startup["shoe_analysis"] == {"roads": "full_shoe", "shoe_max_hands": sv94.SHOE_MAX_HANDS,
+                                        "ai_window_hands": sv94.AI_WINDOW_HANDS}
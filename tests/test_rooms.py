@@ -0,0 +1,15 @@
+import sv94
+
+
+def test_reporters_are_pruned_outside_window(monkeypatch):
+    monkeypatch.setattr(sv94, "ROOM_REPORTER_WINDOW_SEC", 60)
+    clock = [1000.0]
+    monkeypatch.setattr(sv94.time, "time", lambda: clock[0])
+    stats = sv94.RoomStats()
+    for i in range(50):
+        stats.record_results(f"U{i}", ["莊"], ["莊"], None)
+    assert stats.snapshot("r1")["reporters"] == 50
+    clock[0] += 61
+    stats.record_results("U0", ["莊", "閒"], ["閒"], None)
+    assert stats.snapshot("r1")["reporters"] == 1
+    assert list(stats.reporters) == ["U0"]
@@ -0,0 +1,13 @@
+import sv94
+
+
+def test_non_object_entries_are_rejected():
+    rows, rejected = sv94.parse_slot_feed(b'[1, 2, {"game": "g", "room": "r", "total_bet": 10, "score_rate": 0.5}]')
+    assert rows == [("g", "r", 10.0, 0.5)]
+    assert rejected == 2
+
+
+def test_malformed_shapes_do_not_raise():
+    assert sv94.parse_slot_feed(b'{"rows": 5}') == ([], 1)
+    assert sv94.parse_slot_feed(b'"x"', "application/json") == ([], 1)
+    assert sv94.parse_slot_feed(b"game,room,total_bet,score_rate\ng,r\n") == ([], 1)
@@ -0,0 +1,23 @@
+import sv94
+
+
+def test_speculation_renders_the_trimmed_shoe(monkeypatch):
+    """整靴已達 SHOE_MAX_HANDS：預先渲染的卡要與真正寫入 (丟掉最舊一局) 後的牌路相同"""
+    monkeypatch.setattr(sv94, "SPECULATE_BUDGET_MS", 10 ** 6)
+    base = (["莊", "閒", "閒", "莊", "和"] * sv94.SHOE_MAX_HANDS)[:sv94.SHOE_MAX_HANDS]
+    history = sv94.ShoeHistory(base)
+    totals = {k: base.count(k) for k in ("莊", "閒", "和")}
+    job = {"uid": "Uspec", "room": "百家樂 1", "shoe": history, "n": len(history), "runs": bytes(history.runs),
+           "totals": dict(totals), "order": ["莊"]}
+    monkeypatch.setitem(sv94.baccarat_history_dict, "Uspec", {"百家樂 1": history})
+    sv94.analysis_cache.clear()
+    try:
+        sv94.speculate(job)
+        expected = sv94.ShoeHistory(base)
+        expected.append("莊")
+        expected.trim(sv94.SHOE_MAX_HANDS)
+        totals["莊"] += 1
+        assert (expected.encode(), (totals["莊"], totals["閒"], totals["和"])) in sv94.analysis_cache
+    finally:
+        sv94.speculation_done.pop("Uspec", None)
+        sv94.analysis_cache.clear()